@@ -0,0 +1,128 @@
+"""
+Memory and disk bytes per pending deletion of the DeletionScheduler, and how many
+delete calls a burst of expiring messages costs against fake channels, compared
+with the sleeping task per message it replaced.
+
+    python bench/deletions.py --pending 100000 --channels 50
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+from types import SimpleNamespace
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from discord.utils import time_snowflake  # noqa: E402
+
+from kanobot.deletions import DeletionScheduler  # noqa: E402
+
+
+class FakeChannel:
+    """Counts the calls discord would get"""
+
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.bulk = 0
+        self.single = 0
+
+    async def delete_messages(self, messages):
+        self.bulk += 1
+
+    def get_partial_message(self, message_id):
+
+        async def delete():
+            self.single += 1
+
+        return SimpleNamespace(delete=delete)
+
+
+def fake_messages(count, channels):
+    base = time_snowflake(datetime.now(timezone.utc))
+    return [
+        SimpleNamespace(id=base + i, channel=SimpleNamespace(id=random.randrange(channels) + 1)) for i in range(count)
+    ]
+
+
+def measure_memory(messages, filename):
+    """Bytes per pending deletion, in the heap and on disk"""
+    scheduler = DeletionScheduler(filename, lambda channel_id: None)
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    begin = time.perf_counter()
+    for message in messages:
+        scheduler.schedule(message, random.uniform(5, 120))
+    elapsed = time.perf_counter() - begin
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    scheduler.save()
+    return used / len(messages), os.path.getsize(filename) / len(messages), len(messages) / elapsed
+
+
+async def measure_tasks(messages):
+    """Bytes per pending deletion as one sleeping task each, the old way"""
+
+    async def wait_delete(message, after):
+        await asyncio.sleep(after)
+
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    tasks = [asyncio.ensure_future(wait_delete(message, 60)) for message in messages]
+    await asyncio.sleep(0)
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return used / len(messages)
+
+
+async def measure_calls(messages, channels, filename):
+    """Delete calls when every message falls due at once"""
+    fakes = {x: FakeChannel(x) for x in range(1, channels + 1)}
+    scheduler = DeletionScheduler(filename, fakes.get)
+    for message in messages:
+        scheduler.schedule(message, 0)
+    begin = time.perf_counter()
+    scheduler.start()
+    while len(scheduler):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - begin
+    scheduler.close()
+    return sum(x.bulk for x in fakes.values()), sum(x.single for x in fakes.values()), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pending', type=int, default=100000)
+    parser.add_argument('--channels', type=int, default=50)
+    args = parser.parse_args()
+
+    messages = fake_messages(args.pending, args.channels)
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'pending_deletions.bin')
+        heap_bytes, disk_bytes, rate = measure_memory(messages, filename)
+        task_bytes = asyncio.run(measure_tasks(messages[:min(len(messages), 20000)]))
+        bulk, single, elapsed = asyncio.run(measure_calls(messages, args.channels, os.path.join(tmp, 'calls.bin')))
+
+    print('{} pending deletions over {} channels'.format(args.pending, args.channels))
+    print(
+        '  scheduler      {:7.0f} bytes each in memory, {:.0f} on disk, {:.0f} schedules/sec'.format(
+            heap_bytes, disk_bytes, rate
+        )
+    )
+    print('  task per msg   {:7.0f} bytes each in memory, nothing on disk'.format(task_bytes))
+    print(
+        '  all due at once: {} bulk + {} single delete calls for {} messages in {:.2f}s'.format(
+            bulk, single, args.pending, elapsed
+        )
+    )
+
+
+if __name__ == '__main__':
+    main()
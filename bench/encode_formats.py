@@ -0,0 +1,70 @@
+"""
+Encode time and uploaded bytes of every RENDER_ENCODINGS entry for a template,
+fastest first, to pick ImageEncoding and ImageMaxSize.
+
+    python bench/encode_formats.py
+    python bench/encode_formats.py --image resources/images/magic_cat.png --max-size 256
+"""
+import io
+import os
+import sys
+import time
+import argparse
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kanobot.config import ConfigDefaults  # noqa: E402
+from kanobot.constants import RENDER_ENCODINGS, MAGIC_TEXT_POSITIONS, MAGIC_TEXT_COLOR  # noqa: E402
+from kanobot.render import encode_image  # noqa: E402
+
+
+def measure(image, options, repeat):
+    """[seconds per encode], bytes"""
+    if options['format'] == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    times = []
+    for _ in range(repeat):
+        output = io.BytesIO()
+        start = time.perf_counter()
+        image.save(output, **options)
+        times.append(time.perf_counter() - start)
+    return times, len(output.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--image', default=ConfigDefaults.magic_cat_file)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--max-size', type=int, default=0, help='ImageMaxSize in KB to pick an encoding for')
+    args = parser.parse_args()
+
+    image = Image.open(args.image)
+    image.load()
+    # Captions add a little detail, the default font keeps this independent of FontFile
+    draw = ImageDraw.Draw(image)
+    for position, line in zip(MAGIC_TEXT_POSITIONS, ('love eat,', 'GG')):
+        draw.text(position, line, fill=MAGIC_TEXT_COLOR)
+    print('{} {}x{} {}'.format(args.image, image.width, image.height, image.mode))
+
+    results = []
+    for name, options in RENDER_ENCODINGS.items():
+        times, size = measure(image, options, args.repeat)
+        times.sort()
+        results.append((sum(times) / len(times), times[min(len(times) - 1, int(len(times) * 0.99))], size, name))
+    results.sort()
+    for mean, p99, size, name in results:
+        print('  {:<14} {:7.1f}ms mean {:7.1f}ms p99 {:9.1f}KB'.format(name, mean * 1000, p99 * 1000, size / 1024))
+
+    order = [name for _, _, _, name in results]
+    print('ImageEncoding = {}'.format(', '.join(order)))
+    if args.max_size:
+        data = encode_image(image, order, args.max_size * 1024)
+        fits = [name for _, _, size, name in results if size <= args.max_size * 1024]
+        pick = fits[0] if fits else 'none, smallest'
+        print('ImageMaxSize = {} picks {} ({:.1f}KB)'.format(args.max_size, pick, len(data) / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+Offline benchmark of the image path, stage by stage, so a regression can be
+located: template decode, font load, text layout, draw, encode, and the full
+cmd_magic path through RenderService with a fake channel.
+
+Every stage runs in its own process for a clean peak RSS, reported as the peak
+and the growth over the process after imports (cmd_magic adds its workers).
+Layout is the !meme text fitting on the magic_cat template spec.
+
+    python bench/image_pipeline.py --font resources/fonts/WenQuanYi.ttf
+    python bench/image_pipeline.py --stage encode --caption cjk --encoding jpeg
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import subprocess
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kanobot.config import ConfigDefaults  # noqa: E402
+from kanobot.constants import MAGIC_FONT_SIZE, MAGIC_TEXT_POSITIONS, MAGIC_TEXT_COLOR, RENDER_ENCODINGS  # noqa: E402
+
+STAGES = ('decode', 'font', 'layout', 'draw', 'encode', 'cmd_magic')
+
+CAPTIONS = {
+    'short': 'love eat,GG',
+    'long': 'when the stream starts five minutes late and the chat has already eaten all the snacks,'
+    'we wait anyway because it is worth it every single time',
+    'cjk': '鹿乃ちゃん今日も可愛い,我們今天也一起吃飯吧 好好吃的拉麵和餃子',
+}
+
+
+def rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def stage_decode(args, caption):
+    from PIL import Image
+
+    def run():
+        image = Image.open(args.image)
+        image.load()
+
+    return run
+
+
+def stage_font(args, caption):
+    from PIL import ImageFont
+    return lambda: ImageFont.truetype(args.font, MAGIC_FONT_SIZE)
+
+
+def stage_layout(args, caption):
+    from kanobot.meme import TemplateRegistry, fit_text, split_meme_text
+    from kanobot.render import TemplateCache
+
+    name = os.path.splitext(os.path.basename(args.image))[0]
+    spec = TemplateRegistry(os.path.dirname(args.image), args.font).get(name)
+    if spec is None:
+        sys.exit('No template spec next to {}'.format(args.image))
+    templates = TemplateCache()
+
+    def run():
+        for box, chunk in zip(spec['boxes'], split_meme_text(caption, len(spec['boxes']))):
+            fit_text(templates, spec['font'], box, chunk.strip(), spec['size'], spec['min_size'])
+
+    return run
+
+
+def stage_draw(args, caption):
+    from PIL import ImageDraw
+    from kanobot.render import TemplateCache, split_magic_text
+
+    templates = TemplateCache()
+    font = templates.font(args.font, MAGIC_FONT_SIZE)
+    template = templates.image(args.image)
+    lines = split_magic_text(caption)
+
+    def run():
+        image = template.copy()
+        draw = ImageDraw.Draw(image)
+        for position, line in zip(MAGIC_TEXT_POSITIONS, lines):
+            draw.text(position, line, font=font, fill=MAGIC_TEXT_COLOR)
+
+    return run
+
+
+def stage_encode(args, caption):
+    from PIL import ImageDraw
+    from kanobot.render import TemplateCache, split_magic_text, encode_image
+
+    templates = TemplateCache()
+    image = templates.image(args.image).copy()
+    draw = ImageDraw.Draw(image)
+    for position, line in zip(MAGIC_TEXT_POSITIONS, split_magic_text(caption)):
+        draw.text(position, line, font=templates.font(args.font, MAGIC_FONT_SIZE), fill=MAGIC_TEXT_COLOR)
+    return lambda: encode_image(image, args.encoding, args.max_size * 1024)
+
+
+class FakeChannel:
+    """Takes the upload like message.channel would"""
+
+    def __init__(self):
+        self.sent = 0
+        self.bytes = 0
+
+    async def send(self, content=None, file=None, **kwargs):
+        self.sent += 1
+        if file is not None:
+            self.bytes += len(file.fp.read())
+
+
+def stage_cmd_magic(args, caption):
+    """Kanobot.cmd_magic on a stand-in bot with a real RenderService, every call renders"""
+    from kanobot.bot import Kanobot
+    from kanobot.render import RenderService
+    from kanobot.cache import RenderCache
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    renderer = RenderService(
+        preload=[(args.image, args.font, MAGIC_FONT_SIZE)], cache=RenderCache(0) if args.cache else None
+    )
+    bot = SimpleNamespace(
+        renderer=renderer,
+        magic_cat=args.image,
+        font=args.font,
+        config=SimpleNamespace(image_encodings=tuple(args.encoding), image_max_size=args.max_size * 1024)
+    )
+    message = SimpleNamespace(channel=FakeChannel())
+    guild = SimpleNamespace(id=1)
+
+    def run():
+        loop.run_until_complete(Kanobot.cmd_magic(bot, message, guild, caption))
+
+    def close():
+        renderer.pool.shutdown(wait=True)
+        loop.close()
+
+    run.close = close
+    return run
+
+
+def measure(args):
+    """Child side, runs one stage for one caption and prints its numbers as JSON"""
+    caption = CAPTIONS[args.caption]
+    run = globals()['stage_' + args.stage](args, caption)
+    run()  # warm up, the first call loads what later calls reuse
+    before = rss_mb()
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    if hasattr(run, 'close'):
+        run.close()
+    times.sort()
+    total = sum(times)
+    print(
+        json.dumps({
+            'ops': len(times) / total if total else 0,
+            'mean': total / len(times) * 1000,
+            'p99': times[min(len(times) - 1, int(len(times) * 0.99))] * 1000,
+            'rss': rss_mb(),
+            'growth': rss_mb() - before,
+            'workers': rss_mb(resource.RUSAGE_CHILDREN)
+        })
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--image', default=ConfigDefaults.magic_cat_file)
+    parser.add_argument('--font', default=ConfigDefaults.font_file)
+    parser.add_argument('--stage', choices=STAGES, action='append', help='stages to run, all by default')
+    parser.add_argument('--caption', choices=list(CAPTIONS), action='append', help='captions to run, all by default')
+    parser.add_argument('--repeat', type=int, default=30, help='timed calls per stage and caption')
+    parser.add_argument(
+        '--encoding', action='append', choices=list(RENDER_ENCODINGS), help='ImageEncoding, png by default'
+    )
+    parser.add_argument('--max-size', type=int, default=0, help='ImageMaxSize in KB')
+    parser.add_argument(
+        '--cache', action='store_true', help='keep the RenderCache on for cmd_magic, repeats become hits'
+    )
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.encoding = args.encoding or ['png']
+
+    if not os.path.isfile(args.font):
+        sys.exit('Font {} not found, pass one with --font'.format(args.font))
+    if args.child:
+        args.stage, args.caption = args.stage[0], args.caption[0]
+        return measure(args)
+
+    print('{} {} x{} encoding {}'.format(args.image, args.font, args.repeat, ','.join(args.encoding)))
+    print('{:<10} {:<6} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'stage', 'text', 'ops/sec', 'mean ms', 'p99 ms', 'rss MB', '+rss MB', 'wrk MB'))
+    for stage in args.stage or STAGES:
+        for caption in args.caption or CAPTIONS:
+            command = [
+                sys.executable, os.path.abspath(__file__), '--child', '--stage', stage, '--caption', caption, '--image',
+                args.image, '--font', args.font, '--repeat', str(args.repeat), '--max-size', str(args.max_size)
+            ]
+            for encoding in args.encoding:
+                command += ['--encoding', encoding]
+            if args.cache:
+                command.append('--cache')
+            output = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+            result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+            print('{:<10} {:<6} {ops:10.1f} {mean:9.2f} {p99:9.2f} {rss:9.1f} {growth:9.1f} {workers:9.1f}'.format(
+                stage, caption, **result))
+
+
+if __name__ == '__main__':
+    main()
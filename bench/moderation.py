@@ -0,0 +1,143 @@
+"""
+Bulk moderation throughput against a local stand-in API with request latency and
+a per route rate limit which answers 429s like discord does. Compares kicking one
+member at a time, as cmd_kick used to, with the ModerationExecutor, paced and
+unpaced, and counts the API calls of a role change done per role or in one edit.
+
+    python bench/moderation.py --members 100 --latency 0.15 --rate 10 --burst 10
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kanobot.outbound import TokenBucket  # noqa: E402
+from kanobot.moderation import ModerationExecutor  # noqa: E402
+
+
+class FakeAPI:
+    """Latency per request, a token bucket per route, a 429 waits retry_after and retries like discord.py"""
+
+    def __init__(self, latency, rate, burst):
+        self.latency = latency
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.calls = 0
+        self.limited = 0
+
+    async def request(self, route):
+        bucket = self.buckets.get(route)
+        if bucket is None:
+            bucket = self.buckets[route] = TokenBucket(self.rate, self.burst)
+        while True:
+            await asyncio.sleep(self.latency)
+            self.calls += 1
+            retry_after = bucket.delay()
+            if not retry_after:
+                bucket.take()
+                return
+            self.limited += 1
+            await asyncio.sleep(retry_after)
+
+
+class FakeRole:
+
+    def __init__(self, role_id):
+        self.id = role_id
+
+    def is_default(self):
+        return False
+
+
+class FakeMember:
+
+    def __init__(self, api, member_id, roles):
+        self.api = api
+        self.id = member_id
+        self.guild = SimpleNamespace(id=1)
+        self.roles = list(roles)
+
+    async def kick(self, reason=None):
+        await self.api.request('kick')
+
+    async def edit(self, roles, reason=None):
+        await self.api.request('roles')
+        self.roles = list(roles)
+
+    async def add_roles(self, *roles):
+        await self.api.request('roles')
+        self.roles += roles
+
+    async def remove_roles(self, *roles):
+        await self.api.request('roles')
+        self.roles = [x for x in self.roles if x not in roles]
+
+    def __str__(self):
+        return 'member{}'.format(self.id)
+
+
+async def sequential_kick(members):
+    for member in members:
+        await member.kick()
+
+
+async def per_role(members, add, remove):
+    """One call per role and member, without bulk support"""
+    for member in members:
+        for role in add:
+            await member.add_roles(role)
+        for role in remove:
+            await member.remove_roles(role)
+
+
+async def variant(name, args, run):
+    api = FakeAPI(args.latency, args.rate, args.burst)
+    newbie, member, muted = FakeRole(1), FakeRole(2), FakeRole(3)
+    members = [FakeMember(api, x, [newbie]) for x in range(args.members)]
+    start = time.perf_counter()
+    result = await run(members, newbie, member, muted)
+    elapsed = time.perf_counter() - start
+    failed = len(result.failed) if result is not None else 0
+    print(
+        '  {:<28} {:7.1f} members/sec {:5.1f}s {:5} calls {:5} 429s {:3} failed'.format(
+            name, args.members / elapsed, elapsed, api.calls, api.limited, failed
+        )
+    )
+
+
+async def main(args):
+    rates = {'kick': (args.rate, args.burst), 'ban': (args.rate, args.burst), 'roles': (args.rate, args.burst)}
+    paced = ModerationExecutor(args.concurrency, rates)
+    # Paced by discord.py alone, which the stand-in's 429s and retries model
+    unpaced = ModerationExecutor(args.concurrency)
+    print(
+        '{} members, {:.0f}ms latency, {}/s burst {} per route'.format(
+            args.members, args.latency * 1000, args.rate, args.burst
+        )
+    )
+    await variant('kick one at a time', args, lambda m, *roles: sequential_kick(m))
+    await variant('kick executor, unpaced', args, lambda m, *roles: unpaced.kick(m))
+    await variant('kick executor, paced', args, lambda m, *roles: paced.kick(m))
+    await variant(
+        'roles +2 -1, call per role', args,
+        lambda m, newbie, member, muted: per_role(m, [member, muted], [newbie])
+    )
+    await variant(
+        'roles +2 -1, one edit each', args,
+        lambda m, newbie, member, muted: paced.edit_roles(m, [member, muted], [newbie])
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.15, help='seconds per request')
+    parser.add_argument('--rate', type=float, default=10, help='requests per second the stand-in allows per route')
+    parser.add_argument('--burst', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,300 @@
+"""
+Load generator and end-to-end benchmark of the twitter relay.
+
+Generated (or replayed) v2 stream payloads go through MyStreamingClient.on_data,
+the outbox and WebhookSender into a local stand-in webhook server, which records
+when every tweet link arrives.
+
+    python bench/relay_load.py --tweets 2000 --rate 200 --subscriptions 50
+    python bench/relay_load.py --tweets 5000 --record stream.jsonl
+    python bench/relay_load.py --replay stream.jsonl --subscriptions 500
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from threading import Lock, Event, Thread
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kanobot.twitter import MyStreamingClient, WebhookSender  # noqa: E402
+from kanobot.cache import SeenCache, UserCache  # noqa: E402
+from kanobot.outbox import Outbox  # noqa: E402
+from kanobot.metrics import RelayMetrics  # noqa: E402
+
+TWITTER_EPOCH = 1288834974657
+
+
+def make_snowflake(timestamp, seq):
+    return str(((int(timestamp * 1000) - TWITTER_EPOCH) << 22) | (seq & 0x3FFFFF))
+
+
+def make_user(user_id):
+    return {
+        'id': str(user_id),
+        'name': 'Bench User {}'.format(user_id),
+        'username': 'bench_{}'.format(user_id),
+        'profile_image_url': 'https://pbs.twimg.com/profile_images/{}/avatar_normal.jpg'.format(user_id)
+    }
+
+
+def generate(count, authors, others=1000, reply_ratio=0.2, retweet_ratio=0.2, seed=0):
+    """
+    Yield v2 stream payloads: originals, replies and retweets.
+    Retweets carry the original tweet and its author in includes, like the stream does.
+    @param {Int} count - payloads to generate
+    @param {List} authors - user ids whose tweets are generated
+    @param {Int} others - size of the pool of non followed users that are replied to and retweeted
+    """
+    rnd = random.Random(seed)
+    other_ids = [10**12 + i for i in range(others)]
+    for seq in range(count):
+        now = time.time()
+        author = make_user(rnd.choice(authors))
+        data = {
+            'id': make_snowflake(now, seq),
+            'author_id': author['id'],
+            'text': 'bench tweet {} '.format(seq) + 'x' * rnd.randint(0, 200),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(now))
+        }
+        includes = {'users': [author]}
+        roll = rnd.random()
+        if roll < retweet_ratio:
+            original = make_user(rnd.choice(other_ids))
+            original_id = make_snowflake(now - rnd.randint(1, 3600), seq)
+            data['referenced_tweets'] = [{'type': 'retweeted', 'id': original_id}]
+            data['text'] = 'RT @{}: '.format(original['username']) + data['text']
+            includes['users'].append(original)
+            includes['tweets'] = [{'id': original_id, 'author_id': original['id'], 'text': data['text'][3:]}]
+        elif roll < retweet_ratio + reply_ratio:
+            data['referenced_tweets'] = [{'type': 'replied_to', 'id': make_snowflake(now - rnd.randint(1, 3600), seq)}]
+        yield {'data': data, 'includes': includes, 'matching_rules': [{'id': '1', 'tag': 'kanobot:0'}]}
+
+
+def record(filename, payloads):
+    with open(filename, 'w', encoding='utf-8') as f:
+        for payload in payloads:
+            f.write(json.dumps(payload) + '\n')
+
+
+def replay(filename):
+    """Payloads of a recorded JSON lines file, one raw stream message per line"""
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class WebhookRecorder(ThreadingHTTPServer):
+    """Stand-in for Discord, records the arrival time of every posted tweet link"""
+    daemon_threads = True
+
+    def __init__(self, status=204):
+        super().__init__(('127.0.0.1', 0), WebhookHandler)
+        self.status = status
+        self.arrivals = {}
+        self.posts = 0
+        self._lock = Lock()
+
+    @property
+    def url(self):
+        return 'http://{}:{}/api/webhooks'.format(*self.server_address)
+
+    def record(self, webhook_id, content):
+        now = time.perf_counter()
+        with self._lock:
+            self.posts += 1
+            for link in content.split('\n'):
+                self.arrivals.setdefault((webhook_id, link), now)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        # /api/webhooks/<webhook id>/<token>
+        self.server.record(self.path.split('/')[-2], parse_qs(body).get('content', [''])[0])
+        self.send_response(self.server.status)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_subscriptions(authors, count, url, batch_window=0):
+    """count subscriptions spread over authors, each with its own webhook"""
+    discord = []
+    for i in range(count):
+        author = str(authors[i % len(authors)])
+        discord.append({
+            'twitter_id': author,
+            'twitter_name': 'bench_{}'.format(author),
+            'webhook_url': '{}/{}/token'.format(url, 9 * 10**17 + i),
+            'webhook_id': str(9 * 10**17 + i),
+            'guild_id': str(i),
+            'includeUserReply': i % 2 == 0,
+            'includeRetweet': i % 3 != 0,
+            'batchWindow': batch_window
+        })
+    return {'twitter_ids': sorted({x['twitter_id'] for x in discord}), 'Discord': discord}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(payloads, subscriptions, rate=0, batch_window=0, timeout=30, trace=False):
+    """
+    Feed payloads at rate per second (0 for as fast as possible) and wait for the deliveries.
+    Returns the report as a dict.
+    """
+    server = WebhookRecorder()
+    Thread(target=server.serve_forever, daemon=True).start()
+    workdir = tempfile.mkdtemp(prefix='kanobot-bench-')
+    outbox = Outbox(os.path.join(workdir, 'outbox.log'), os.path.join(workdir, 'dead_letter.jsonl'))
+
+    raws = [json.dumps(payload).encode('utf-8') for payload in payloads]
+    authors = sorted({payload['data']['author_id'] for payload in payloads[:10000]})
+    stream = MyStreamingClient(
+        'bench',
+        dataD=make_subscriptions(authors, subscriptions, server.url, batch_window),
+        seen=SeenCache(),
+        users=UserCache(),
+        sender=WebhookSender(outbox, metrics=RelayMetrics())
+    )
+
+    # (webhook id, tweet link) -> time on_data was called, the fan-out latency starts there
+    sent = {}
+    fed_at = [0.0]
+    done = Event()
+    deliver = stream.deliver
+
+    def traced_deliver(dataDiscord, data, trace=None):
+        sent.setdefault((dataDiscord['webhook_id'], data['content']), fed_at[0])
+        deliver(dataDiscord, data, trace)
+
+    stream.deliver = traced_deliver
+
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    for i, raw in enumerate(raws):
+        if rate:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        fed_at[0] = time.perf_counter()
+        stream.on_data(raw)
+    fed = time.perf_counter() - start
+
+    deadline = time.perf_counter() + timeout + batch_window
+    while time.perf_counter() < deadline and not done.is_set():
+        with server._lock:
+            if all(key in server.arrivals for key in sent):
+                done.set()
+        done.wait(0.05)
+    total = time.perf_counter() - start
+    peak_traced = tracemalloc.get_traced_memory()[1] if trace else None
+    if trace:
+        tracemalloc.stop()
+
+    with server._lock:
+        latencies = [
+            (server.arrivals[key] - fed_time) * 1000 for key, fed_time in sent.items() if key in server.arrivals
+        ]
+        posts = server.posts
+    # The last outbox acknowledgements trail the responses slightly
+    for _ in range(20):
+        if not len(outbox):
+            break
+        time.sleep(0.05)
+    server.shutdown()
+    server.server_close()
+    outbox.close()
+
+    return {
+        'tweets': len(raws),
+        'subscriptions': subscriptions,
+        'feed_seconds': fed,
+        'tweets_per_sec': len(raws) / fed if fed else 0.0,
+        'deliveries': len(sent),
+        'delivered': len(latencies),
+        'webhook_posts': posts,
+        'deliveries_per_sec': len(latencies) / total if total else 0.0,
+        'latency_ms': {pct: percentile(latencies, pct) for pct in (50, 90, 99)},
+        'latency_max_ms': max(latencies) if latencies else 0.0,
+        'outbox_pending': len(outbox),
+        'stages': stream.metrics.stats()['stages'],
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_traced_mb': peak_traced / 1024 / 1024 if peak_traced is not None else None
+    }
+
+
+def print_report(report):
+    print('tweets           {tweets} fed in {feed_seconds:.2f}s, {tweets_per_sec:.0f} tweets/sec'.format(**report))
+    print('subscriptions    {subscriptions}'.format(**report))
+    print(
+        'deliveries       {delivered}/{deliveries} in {webhook_posts} posts, {deliveries_per_sec:.0f}/sec, '
+        '{outbox_pending} left in outbox'.format(**report)
+    )
+    print(
+        'fan-out latency  p50 {:.1f}ms  p90 {:.1f}ms  p99 {:.1f}ms  max {:.1f}ms'.format(
+            report['latency_ms'][50], report['latency_ms'][90], report['latency_ms'][99], report['latency_max_ms']
+        )
+    )
+    for name, stage in report['stages'].items():
+        if name != 'skew':
+            print('  {:<14} p50 {p50:.0f}ms  p99 {p99:.0f}ms  max {max:.1f}ms'.format(name, **stage))
+    print('peak memory      {:.1f}MB RSS'.format(report['peak_rss_mb']), end='')
+    if report['peak_traced_mb'] is not None:
+        print(', {:.1f}MB traced python allocations'.format(report['peak_traced_mb']), end='')
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tweets', type=int, default=1000, help='payloads to generate')
+    parser.add_argument('--authors', type=int, default=20, help='followed accounts to generate tweets for')
+    parser.add_argument('--subscriptions', type=int, default=50, help='subscriptions spread over the authors')
+    parser.add_argument('--rate', type=float, default=100, help='payloads per second, 0 for as fast as possible')
+    parser.add_argument('--reply-ratio', type=float, default=0.2)
+    parser.add_argument('--retweet-ratio', type=float, default=0.2)
+    parser.add_argument('--batch-window', type=int, default=0, help='batchWindow of every subscription')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record', metavar='FILE', help='write the generated payloads as JSON lines and exit')
+    parser.add_argument('--replay', metavar='FILE', help='replay recorded payloads instead of generating')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for the last deliveries')
+    parser.add_argument('--tracemalloc', action='store_true', help='also report peak python allocations (slower)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.replay:
+        payloads = list(replay(args.replay))
+    else:
+        authors = [10**9 + i for i in range(args.authors)]
+        payloads = list(
+            generate(
+                args.tweets, authors, reply_ratio=args.reply_ratio, retweet_ratio=args.retweet_ratio, seed=args.seed
+            )
+        )
+    if args.record:
+        record(args.record, payloads)
+        print('Recorded {} payloads to {}'.format(len(payloads), args.record))
+        return
+
+    print_report(run(payloads, args.subscriptions, args.rate, args.batch_window, args.timeout, args.tracemalloc))
+
+
+if __name__ == '__main__':
+    main()
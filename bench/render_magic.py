@@ -0,0 +1,68 @@
+"""
+Renders/sec of !magic: loading the template and font on every call, as cmd_magic
+used to, against the cached TemplateCache path.
+
+    python bench/render_magic.py --font resources/fonts/WenQuanYi.ttf
+"""
+import io
+import os
+import sys
+import time
+import argparse
+
+from PIL import Image, ImageDraw, ImageFont
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kanobot.config import ConfigDefaults  # noqa: E402
+from kanobot.render import TemplateCache, render_magic  # noqa: E402
+
+CAPTION = 'love eat,GG'
+
+
+def render_uncached(image_file, font_file, text):
+    """cmd_magic before the template cache"""
+    img = Image.open(image_file)
+    font = ImageFont.truetype(font_file, 48)
+    draw = ImageDraw.Draw(img)
+    if (',' in text):
+        str1, str2 = text.split(',', 1)
+    else:
+        str1 = text
+        str2 = ''
+    draw.text((455, 400), str1, font=font, fill=(0, 0, 0))
+    draw.text((455, 450), str2, font=font, fill=(0, 0, 0))
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format='PNG')
+    return img_byte_arr.getvalue()
+
+
+def renders_per_sec(func, seconds):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        func()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--image', default=ConfigDefaults.magic_cat_file)
+    parser.add_argument('--font', default=ConfigDefaults.font_file)
+    parser.add_argument('--text', default=CAPTION)
+    parser.add_argument('--seconds', type=float, default=5, help='time spent on each variant')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.font):
+        sys.exit('Font {} not found, pass one with --font'.format(args.font))
+
+    templates = TemplateCache()
+    before = renders_per_sec(lambda: render_uncached(args.image, args.font, args.text), args.seconds)
+    after = renders_per_sec(lambda: render_magic(templates, args.image, args.font, args.text), args.seconds)
+    print('uncached  {:8.1f} renders/sec'.format(before))
+    print('cached    {:8.1f} renders/sec  ({:+.0%})'.format(after, after / before - 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark of the MyStreamingClient.on_data fast path on recorded or generated
+stream data. That it only skips payloads the full parse would drop as well is
+fuzzed by tests/test_twitter.py.
+
+    python bench/stream_parse.py --tweets 20000 --followed 0.1
+    python bench/stream_parse.py --replay stream.jsonl
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kanobot.twitter import MyStreamingClient  # noqa: E402
+from relay_load import generate, replay  # noqa: E402
+
+
+def full_parse_drops(stream, rawdata):
+    """What on_data did before the fast path: decode everything, then check the author"""
+    payload = json.loads(rawdata.decode('utf-8'))
+    return 'data' in payload and not stream.subscriptions.get(payload['data']['author_id'])
+
+
+def make_stream(twitter_ids):
+    discord = [{'twitter_id': str(x), 'webhook_url': '', 'webhook_id': '0'} for x in twitter_ids]
+    return MyStreamingClient('bench', dataD={'twitter_ids': [str(x) for x in twitter_ids], 'Discord': discord})
+
+
+def bench(raws, stream, repeat=3):
+    """Best of repeat seconds spent per payload by the old full parse and by the fast path"""
+    results = {}
+    for name, func in (('full parse', lambda raw: full_parse_drops(stream, raw)), ('fast path', stream.skip)):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for raw in raws:
+                func(raw)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best / len(raws)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tweets', type=int, default=20000, help='payloads to generate')
+    parser.add_argument('--authors', type=int, default=200, help='authors tweeting in the generated stream')
+    parser.add_argument('--followed', type=float, default=0.1, help='share of the authors that are subscribed')
+    parser.add_argument('--replay', metavar='FILE', help='recorded payloads instead of generated ones')
+    args = parser.parse_args()
+
+    if args.replay:
+        payloads = list(replay(args.replay))
+    else:
+        payloads = list(generate(args.tweets, [10**9 + i for i in range(args.authors)]))
+    authors = sorted({payload['data']['author_id'] for payload in payloads if 'data' in payload})
+    followed = authors[:max(1, int(len(authors) * args.followed))]
+    stream = make_stream(followed)
+    raws = [json.dumps(payload).encode('utf-8') for payload in payloads]
+
+    kept = sum(not stream.skip(raw) for raw in raws)
+    print(
+        '{} payloads, {} authors, {} followed, {} pass the fast path'.format(
+            len(raws), len(authors), len(followed), kept
+        )
+    )
+    results = bench(raws, stream)
+    for name, seconds in results.items():
+        print('  {:<12} {:8.2f}us/payload  {:10.0f} payloads/sec'.format(name, seconds * 10**6, 1 / seconds))
+    # Kept payloads pay for both, the fast path check and the full parse
+    mixed = (len(raws) * results['fast path'] + kept * results['full parse']) / len(raws)
+    print('  on_data decode cost {:.2f}us -> {:.2f}us per payload'.format(results['full parse'] * 10**6, mixed * 10**6))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import discord
 import asyncio
 import logging
+import os
 import sys
 import colorlog
 import inspect
@@ -10,22 +11,32 @@ import random
 import math
 import time
 import shlex
-from threading import Thread
 
-from datetime import datetime
+from datetime import datetime, timezone
 
 from functools import wraps
 from textwrap import dedent
 
-from .twitter import MyStreamingClient
-from tweepy import Client as TwitterClient, StreamRule
+from .twitter import followed_ids
+from .relay import TwitterRelay, RelayClient
+from tweepy import Client as TwitterClient
 from . import exceptions
 from .config import Config, ConfigDefaults
 from .constructs import Response
-from .constants import DISCORD_MSG_CHAR_LIMIT
+from .constants import (
+    DISCORD_MSG_CHAR_LIMIT, TWITTER_MAX_BATCH_WINDOW, TWITTER_USERS_LOOKUP_LIMIT, TWITTER_USER_FIELDS, MAGIC_FONT_SIZE,
+    PURGE_MAX_RANGE, RESPONSE_CACHE_PROFILE_TTL
+)
 from .jsonIO import JsonIO
-
-from PIL import Image, ImageDraw, ImageFont
+from .cache import UserCache, RenderCache, ResponseCache
+from .filters import parse_filters
+
+from .render import RenderService, render_magic, render_key, split_magic_text, image_extension
+from .meme import TemplateRegistry, render_meme
+from .outbound import OutboundQueue
+from .deletions import DeletionScheduler
+from .purge import PurgeFilter, PurgeJob, parse_time
+from .moderation import ModerationExecutor, select_members, role_changes
 import io
 
 LOG = logging.getLogger(__name__)
@@ -46,6 +57,16 @@ def _get_variable(name):
         del stack
 
 
+def _paginate(lines, limit=DISCORD_MSG_CHAR_LIMIT):
+    """Join lines into as few pages as fit in limit chars each"""
+    pages = ['']
+    for line in lines:
+        if pages[-1] and len(pages[-1]) + len(line) > limit:
+            pages.append('')
+        pages[-1] += line
+    return pages
+
+
 class Bot(discord.Client):
 
     def __init__(self, config_file=None):
@@ -59,11 +80,20 @@ class Bot(discord.Client):
         self.init_ok = False
         self.timeout = self.config.timeout
         self.twitter = None
-        self.twitter_stream = None
+        self.twitter_relay = None
+        self.twitter_users = UserCache()
         self.role_manager = self.jsonIO.get(self.config.role_manager_file)
         self.reply_message = self.jsonIO.get(self.config.reply_file)
         self.magic_cat = self.config.magic_cat_file
         self.font = self.config.font_file
+        self.render_cache = RenderCache(self.config.render_cache_size, self.config.render_cache_dir)
+        self.renderer = RenderService(preload=[(self.magic_cat, self.font, MAGIC_FONT_SIZE)], cache=self.render_cache)
+        self.templates = TemplateRegistry(self.config.template_dir, self.font)
+        self.outbound = OutboundQueue(self.config.send_queue_size, self.config.send_queue_drop)
+        self.deletions = DeletionScheduler(self.config.deletions_file, self._deletion_channel)
+        self.purges = {}
+        self.moderation = ModerationExecutor(self.config.moderation_concurrency, self.config.moderation_rates)
+        self.response_cache = ResponseCache()
         
         self._setup_logging()
 
@@ -92,8 +122,11 @@ class Bot(discord.Client):
 
     def _cleanup(self):
         try:
-            if self.twitter_stream:
-                self.twitter_stream.disconnect()
+            if self.twitter_relay:
+                self.twitter_relay.close()
+            self.renderer.close()
+            self.outbound.close()
+            self.deletions.close()
             self.loop.run_until_complete(self.logout())
         except Exception:
             pass
@@ -184,9 +217,9 @@ class Bot(discord.Client):
         return discord.utils.oauth_url(self.cached_app_info.id, permissions=permissions, guild=guild)
 
     async def change_kano_avatar(self):
-        kano_obj = self.twitter.get_user(username='kano_2525', user_fields=["profile_image_url"])
-        url = kano_obj.data.profile_image_url.replace("_normal", "")
         try:
+            kano = await self.loop.run_in_executor(None, self._get_twitter_user, None, 'kano_2525')
+            url = kano['profile_image_url'].replace("_normal", "")
             async with aiohttp.request("GET", url, timeout=aiohttp.ClientTimeout(total=self.timeout)) as res:
                 await self.user.edit(avatar=await res.read())
             LOG.info("Avatar change succeeded")
@@ -199,44 +232,69 @@ class Bot(discord.Client):
         await self.config.async_validate(self)
         if self.config.twitter_token:
             self.twitter = TwitterClient(bearer_token=self.config.twitter_token)
-            Thread(target=self._start_twitter, daemon=True).start()
+            if self.config.twitter_relay_mode == 'external':
+                self.twitter_relay = RelayClient(self.config.twitter_relay_address, self.config.twitter_relay_token)
+            else:
+                self.twitter_relay = TwitterRelay(self.config, users=self.twitter_users)
+            self.twitter_relay.start()
             if self.config.enable_change_avatar:
                 await self.change_kano_avatar()
 
-    def _start_twitter(self):
-        data = self.jsonIO.get(self.config.webhook_file)
-        self.twitter_stream = MyStreamingClient(self.config.twitter_token, dataD=data)
-        while True:
-            data = self.jsonIO.get(self.config.webhook_file)
-            self.twitter_stream.reset(data)
-
-            if data.get('twitter_ids', []):
-                try:
-                    self._sync_twitter_id_rule(data.get('twitter_ids'))
-                    self.twitter_stream.filter(
-                        expansions=["author_id"], user_fields=["username", "id", "profile_image_url"], tweet_fields=["referenced_tweets"]
-                    )
-                except Exception as err:
-                    LOG.debug(f"Twitter stream raise Exception {err}")
-                    self.twitter_stream.disconnect()
+    async def _update_twitter(self):
+        """Let the relay apply subscription changes without reconnecting"""
+        await self.loop.run_in_executor(None, self.twitter_relay.update)
+
+    def _get_twitter_user(self, user_id=None, username=None):
+        """Single profile through the user cache, None when the user does not exist"""
+        user = self.twitter_users.get(user_id=user_id, username=username)
+        if user:
+            self.twitter_users.record(0, 1)
+            return user
+        response = self.twitter.get_user(id=user_id, username=username, user_fields=TWITTER_USER_FIELDS)
+        self.twitter_users.record(1, 0)
+        return self.twitter_users.put(response.data.data) if response.data else None
+
+    def _lookup_twitter_users(self, twitter_ids):
+        """Resolve twitter ids through the user cache, misses use batched get_users calls, returns {id: user}"""
+        users = {}
+        missing = []
+        for twitter_id in twitter_ids:
+            user = self.twitter_users.get(user_id=twitter_id)
+            if user:
+                users[twitter_id] = user
             else:
-                time.sleep(60)
-
-    def _sync_twitter_id_rule(self, twitter_id_list):
-        response = self.twitter_stream.get_rules()
-        rules = response.data
-        if response.meta['result_count'] != 0:
-            self.twitter_stream.delete_rules(rules)
+                missing.append(twitter_id)
 
-        rules_list = []
-        for id in twitter_id_list:
-            rules_list.append(f"from:{id}")
-
-        if rules_list:
-            self.twitter_stream.add_rules(StreamRule(value=" OR ".join(rules_list)))
+        calls = math.ceil(len(missing) / TWITTER_USERS_LOOKUP_LIMIT)
+        self.twitter_users.record(calls, math.ceil(len(twitter_ids) / TWITTER_USERS_LOOKUP_LIMIT) - calls)
+        for i in range(0, len(missing), TWITTER_USERS_LOOKUP_LIMIT):
+            response = self.twitter.get_users(
+                ids=missing[i:i + TWITTER_USERS_LOOKUP_LIMIT], user_fields=TWITTER_USER_FIELDS
+            )
+            for user in response.data or []:
+                users[str(user.id)] = self.twitter_users.put(user.data)
+        return users
 
     async def _reload_twitter(self):
-        self.twitter_stream.disconnect()
+        await self.loop.run_in_executor(None, self.twitter_relay.reconnect)
+
+    def _permission_tier(self, author):
+        if author.id == self.config.owner_id:
+            return 'owner'
+        if isinstance(author, discord.Member) and author.guild_permissions.administrator:
+            return 'admin'
+        return 'user'
+
+    def _response_key(self, command, handler, message, args):
+        """Response cache key of a command marked pure, None for the others"""
+        options = getattr(handler, 'response_cache', None)
+        if options is None:
+            return None
+        _, per_author, _ = options
+        return (
+            command, message.guild.id if message.guild else None,
+            self._permission_tier(message.author), message.author.id if per_author else None, args
+        )
 
     def _get_owner(self, *, guild=None):
         return discord.utils.find(lambda m: m.id == self.config.owner_id, guild.members if guild else self.get_all_members())
@@ -247,16 +305,19 @@ class Bot(discord.Client):
         expire_in = kwargs.pop('expire_in', 0)
         allow_none = kwargs.pop('allow_none', True)
         also_delete = kwargs.pop('also_delete', None)
+        # Text may be joined with other text queued for the same channel and expiry,
+        # only for callers which do not reuse the returned message
+        coalesce = kwargs.pop('coalesce', False)
 
         msg = None
         lfunc = LOG.debug if quiet else LOG.warning
 
         try:
             if content is not None or allow_none:
-                if isinstance(content, discord.Embed):
-                    msg = await dest.send(embed=content)
-                else:
-                    msg = await dest.send(content, tts=tts)
+                msg = await self.outbound.send(dest, content, tts=tts, coalesce=(expire_in or 0) if coalesce else None)
+
+        except exceptions.MessageDropped:
+            lfunc("Dropped message to \"%s\", send queue is full", dest)
 
         except discord.Forbidden:
             lfunc("Cannot send message to \"%s\", no permission", dest.name)
@@ -273,16 +334,15 @@ class Bot(discord.Client):
 
         finally:
             if msg and expire_in:
-                asyncio.ensure_future(self._wait_delete_msg(msg, expire_in))
+                self.deletions.schedule(msg, expire_in)
 
             if also_delete and isinstance(also_delete, discord.Message):
-                asyncio.ensure_future(self._wait_delete_msg(also_delete, expire_in))
+                self.deletions.schedule(also_delete, expire_in)
 
         return msg
 
-    async def _wait_delete_msg(self, message, after):
-        await asyncio.sleep(after)
-        await self.safe_delete_message(message, quiet=True)
+    def _deletion_channel(self, channel_id):
+        return self.get_channel(channel_id) or self.get_partial_messageable(channel_id)
 
     async def safe_delete_message(self, message, *, quiet=False):
         lfunc = LOG.debug if quiet else LOG.warning
@@ -300,7 +360,7 @@ class Bot(discord.Client):
         lfunc = LOG.debug if quiet else LOG.warning
 
         try:
-            return await message.edit(new)
+            return await message.edit(content=new)
 
         except discord.NotFound:
             lfunc("Cannot edit message \"{}\", message not found".format(message.clean_content))
@@ -330,6 +390,8 @@ class Bot(discord.Client):
             return
 
         await self._on_ready_sanity_checks()
+        # Channels are cached now, deletions due while the bot was down go first
+        self.deletions.start()
         print()
 
         LOG.info('Connected!   -   KanoBot\n')
@@ -437,6 +499,7 @@ class Bot(discord.Client):
             return
 
         command, *args = shlex.split(message_content)
+        raw_args = tuple(args)
         command = command[len(self.config.command_prefix):].lower().strip()
         handler = getattr(self, 'cmd_' + command, None)
         if not handler:
@@ -446,7 +509,7 @@ class Bot(discord.Client):
                 try:
                     rtv_msg = rtv_msg.format(*args) if len(args) > 0 else rtv_msg
                     rtv_msg = rtv_msg.replace('{}', '').strip()
-                    await self.safe_send_message(message.channel, rtv_msg)
+                    await self.safe_send_message(message.channel, rtv_msg, coalesce=True)
                 except Exception:
                     pass
             return
@@ -523,12 +586,21 @@ class Bot(discord.Client):
                     docs = 'Usage: {}{} {}'.format(self.config.command_prefix, command, ' '.join(args_expected))
 
                 docs = dedent(docs)
-                content = '```\n{}\n```'.format(docs.format(command_prefix=self.config.command_prefix))
-                await self.safe_send_message(message.channel, content, expire_in=60)
+                content = '```\n{}\n```'.format(
+                    docs.format(command_prefix=self.config.command_prefix, max_window=TWITTER_MAX_BATCH_WINDOW)
+                )
+                await self.safe_send_message(message.channel, content, expire_in=60, coalesce=True)
                 return
 
-            await self.send_typing(message.channel)
-            response = await handler(**handler_kwargs)
+            cache_key = self._response_key(command, handler, message, raw_args)
+            response = self.response_cache.get(cache_key) if cache_key is not None else None
+            if response is None:
+                await self.send_typing(message.channel)
+                response = await handler(**handler_kwargs)
+                if cache_key is not None and isinstance(response, Response):
+                    tags, _, ttl = handler.response_cache
+                    guild_id = message.guild.id if message.guild else None
+                    self.response_cache.put(cache_key, response, [(tag, guild_id) for tag in tags], ttl)
             if response and isinstance(response, Response):
                 if not isinstance(response.content, discord.Embed) and self.config.embeds and response.embed:
                     content = self._gen_embed()
@@ -547,7 +619,8 @@ class Bot(discord.Client):
                     message.channel,
                     content,
                     expire_in=response.delete_after if self.config.delete_messages else 0,
-                    also_delete=message if self.config.delete_invoking else None
+                    also_delete=message if self.config.delete_invoking else None,
+                    coalesce=True
                 )
 
         except (exceptions.CommandError, exceptions.HelpfulError) as e:
@@ -562,7 +635,9 @@ class Bot(discord.Client):
             else:
                 content = '```\n{}\n```'.format(e.message)
 
-            await self.safe_send_message(message.channel, content, expire_in=expirein, also_delete=alsodelete)
+            await self.safe_send_message(
+                message.channel, content, expire_in=expirein, also_delete=alsodelete, coalesce=True
+            )
         except exceptions.Signal:
             raise
         except Exception:
@@ -655,6 +730,19 @@ class Kanobot(Bot):
         wrapper.dev_cmd = True
         return wrapper
 
+    def pure(*tags, per_author=False, ttl=None):
+        """
+        Mark a read-only command, on_message answers it from the response cache.
+        Answers are kept per command, guild, permission tier and arguments, and per
+        author with per_author, until a tag is invalidated for the guild or ttl passes.
+        """
+
+        def decorator(func):
+            func.response_cache = (tags, per_author, ttl)
+            return func
+
+        return decorator
+
     def require_twitter(func):
 
         @wraps(func)
@@ -689,37 +777,77 @@ class Kanobot(Bot):
             )
 
     @admin_only
-    async def cmd_purge(self, message, channel, author, user_mentions, search_range=50, user=None):
+    async def cmd_purge(self, message, channel, user_mentions, leftover_args, search_range=50):
         """
         Usage:
-            {command_prefix}purge range [user]
-        Removes up to [range] messages the bot has posted in chat.
-        Default: 50, Max: 1000
-        e.g. {command_prefix}purge
-             {command_prefix}purge 80
-        user is optionaly, must be string or @name
-        e.g. {command_prefix}purge 30 bots
+            {command_prefix}purge [range] [filters]
+            {command_prefix}purge stop
+        Removes messages among the last [range] in this channel, in the background.
+        Default: 50, Max: 100000
+        Filters, all given must match:
+            @user or name       by these users
+            after:30m           newer than 30 minutes, also s, h, d, w or a date like 2024-01-31
+            before:2d           older than 2 days
+            match:regex         content matches the regex
+            has:attachments     with attachments, -has:attachments without
+        e.g. {command_prefix}purge 80
+             {command_prefix}purge 30 bots
+             {command_prefix}purge 5000 @spammer after:1h
+             {command_prefix}purge 2000 match:nitro has:attachments
+        stop: Cancel the purge running in this channel.
         """
+        if search_range == 'stop':
+            task = self.purges.get(channel.id)
+            if task is None:
+                return Response('No purge is running in this channel', reply=True, delete_after=8)
+            task.cancel()
+            return
+
         try:
-            float(search_range)  # lazy check
-            search_range = min(int(search_range), 1000)
-        except Exception:
+            search_range = min(int(search_range), PURGE_MAX_RANGE)
+        except ValueError:
             return Response("Enter a number.  NUMBER.  That means digits. `15`.  Etc.", reply=True, delete_after=8)
+        if channel.id in self.purges:
+            return Response(
+                'A purge is already running in this channel, `purge stop` cancels it', reply=True, delete_after=8
+            )
+        try:
+            purge_filter = PurgeFilter(leftover_args, user_mentions)
+        except ValueError as err:
+            raise exceptions.CommandError(str(err), expire_in=20)
 
-        def check_user(m):
-            if m.pinned:
-                return False
-
-            if not user_mentions:
-                return m.author.name == user if user else True
-            else:
-                for u in user_mentions:
-                    if m.author == u:
-                        return True
-                return False
+        status = await self.safe_send_message(
+            channel, 'Purging {} of the last {} messages...'.format(purge_filter.describe(), search_range)
+        )
+        if status is None:
+            return
+        job = PurgeJob(
+            channel,
+            purge_filter.compile(exclude={status.id}),
+            search_range,
+            after=purge_filter.after,
+            before=purge_filter.before,
+            progress=lambda job: self.safe_edit_message(
+                status, 'Purging {}: {}'.format(purge_filter.describe(), job.summary()), quiet=True
+            )
+        )
+        self.purges[channel.id] = asyncio.ensure_future(self._run_purge(job, status))
 
-        deleted = await channel.purge(limit=search_range, check=check_user, bulk=True)
-        return Response('successfully deleted {} messages from this channel!'.format(len(deleted)), reply=True, delete_after=8)
+    async def _run_purge(self, job, status):
+        try:
+            await job.run()
+            result = 'Purge done: {}'.format(job.summary())
+        except asyncio.CancelledError:
+            result = 'Purge cancelled: {}'.format(job.summary())
+        except discord.Forbidden:
+            result = 'Purge stopped, missing Manage Messages permission: {}'.format(job.summary())
+        except Exception:
+            LOG.error('Purge in {} failed'.format(job.channel), exc_info=True)
+            result = 'Purge failed: {}'.format(job.summary())
+        finally:
+            self.purges.pop(job.channel.id, None)
+        await self.safe_edit_message(status, result, quiet=True)
+        self.deletions.schedule(status, 30)
 
     @owner_only
     async def cmd_restart(self, channel):
@@ -786,6 +914,7 @@ class Kanobot(Bot):
 
         return Response("\n:ok_hand:", delete_after=20)
 
+    @pure(per_author=True, ttl=RESPONSE_CACHE_PROFILE_TTL)
     async def cmd_id(self, author, user_mentions):
         """
         Usage:
@@ -798,6 +927,7 @@ class Kanobot(Bot):
             usr = user_mentions[0]
             return Response('**{0}**\'s ID is `{1}`'.format(usr.name, usr.id), reply=True, delete_after=35)
 
+    @pure('help')
     async def cmd_help(self, author, command=None):
         """
         Usage:
@@ -811,7 +941,12 @@ class Kanobot(Bot):
         if command:
             cmd = getattr(self, 'cmd_' + command, None)
             if cmd and not hasattr(cmd, 'dev_cmd'):
-                return Response("```\n{}```".format(dedent(cmd.__doc__)).format(command_prefix=self.config.command_prefix), embed=False)
+                return Response(
+                    "```\n{}```".format(dedent(cmd.__doc__)).format(
+                        command_prefix=self.config.command_prefix, max_window=TWITTER_MAX_BATCH_WINDOW
+                    ),
+                    embed=False
+                )
             else:
                 return Response("No such command", delete_after=10)
 
@@ -843,48 +978,115 @@ class Kanobot(Bot):
                 .format(self.config.command_prefix)
         return Response(helpmsg, reply=True, embed=False)
 
+    def _get_webhooks(self):
+        """The webhook file with its keys filled in"""
+        data = self.jsonIO.get(self.config.webhook_file)
+        if not data.get('Discord', None):
+            data['Discord'] = []
+            data['twitter_ids'] = []
+            data['Category_ids'] = {}
+        return data
+
+    async def _twitter_show_pages(self, guild):
+        """Subscriptions of guild as message pages"""
+        data = self.jsonIO.get(self.config.webhook_file)
+        if not data.get('Discord', None):
+            return ['No subscribed twitter!']
+        subscribed = [dataD for dataD in data['Discord'] if dataD['guild_id'] == guild.id]
+        if not subscribed:
+            return ['No subscribed users!']
+
+        twitter_ids = list(dict.fromkeys(dataD['twitter_id'] for dataD in subscribed))
+        try:
+            users = await self.loop.run_in_executor(None, self._lookup_twitter_users, twitter_ids)
+        except Exception as err:
+            LOG.warning(f"Twitter users lookup failed {err}")
+            users = {}
+
+        lines = []
+        for dataD in subscribed:
+            user = users.get(dataD['twitter_id'])
+            if user:
+                lines.append(
+                    '{}(@{}) \nhttps://twitter.com/{} \n'.format(user['name'], user['username'], user['username'])
+                )
+            else:
+                # Saved at subscribe time, costs no api call
+                lines.append('@{} \nhttps://twitter.com/{} \n'.format(dataD['twitter_name'], dataD['twitter_name']))
+            if dataD.get('filters'):
+                lines[-1] += 'filters: {}\n'.format(' '.join(shlex.quote(x) for x in dataD['filters']))
+        return _paginate(lines)
+
     @admin_only
     @require_twitter
-    async def cmd_twitter(self, guild, action, name=None, channel_name=None, includeUserReply=None, includeRetweet=None):
+    async def cmd_twitter(
+        self,
+        guild,
+        channel,
+        leftover_args,
+        action,
+        name=None,
+        channel_name=None,
+        includeUserReply=None,
+        includeRetweet=None,
+        batchWindow=None
+    ):
         """
         Usage:
-            {command_prefix}twitter [+, -, show, reload]
-            {command_prefix}twitter + [name] [channel_name] | boolean [Reply] [Retweet]
+            {command_prefix}twitter [+, -, filter, show, reload]
+            {command_prefix}twitter + [name] [channel_name] | boolean [Reply] [Retweet] | seconds [BatchWindow]
+                | [filters...]
             {command_prefix}twitter + [name] [channel_name] False True True
+            {command_prefix}twitter + [name] [channel_name] False True 10 has:media #art -spoiler
             {command_prefix}twitter - [name]
+            {command_prefix}twitter filter [name] [filters...]
             {command_prefix}twitter show
             {command_prefix}twitter reload
         +,-: Add or delete subscribed user of Twitter, will create a text channel to subscribe.
-        show: Show subscribed users, Warning: show command will block bot one moment.
-        reload: Reload twitter Streaming
+        BatchWindow: Combine tweets posted within these seconds into one message (0-{max_window}, default 0).
+        filters: has:media, has:links, #hashtag, keyword, or -has:media, -has:links, -keyword to exclude.
+            Tweets must have every has:, one of the hashtags or keywords and none of the excluded.
+            Keywords ignore case and match whole words, cat does not match concatenate.
+        filter: Replace the filters of a subscription, give none to remove them.
+        show: Show subscribed users.
+        reload: Reconnect twitter Streaming, +,- apply without it
         """
 
-        actions = ['+', '-', 'show', 'reload']
+        actions = ['+', '-', 'filter', 'show', 'reload']
         if action not in actions:
-            return Response('Invalid action must be +,-,show,reload', reply=True, delete_after=10)
+            return Response('Invalid action must be +,-,filter,show,reload', reply=True, delete_after=10)
 
         if action == 'show':
-            data = self.jsonIO.get(self.config.webhook_file)
-            if not data.get('Discord', None):
-                return Response('No subscribed twitter!')
-            subscribed = []
-            for dataD in data['Discord']:
-                if dataD['guild_id'] == guild.id:
-                    user_obj = self.twitter.get_user(id=dataD['twitter_id'])
-                    if user_obj.data:
-                        subscribed.append(user_obj.data)
-            text = ''
-            for user in subscribed:
-                text += '{}(@{}) \nhttps://twitter.com/{} \n'.format(user.name, user.username, user.username)
-            if text == '':
-                return Response('No subscribed users!')
-            else:
-                return Response(text, embed=False)
+            # The relay prunes dead webhooks from the file, maybe in another process, its mtime catches that
+            try:
+                mtime = os.stat(self.config.webhook_file).st_mtime_ns
+            except OSError:
+                mtime = None
+            cache_key = ('twitter show', guild.id, mtime)
+            pages = self.response_cache.get(cache_key)
+            if pages is None:
+                pages = await self._twitter_show_pages(guild)
+                pages = self.response_cache.put(cache_key, pages, [('twitter', guild.id)], RESPONSE_CACHE_PROFILE_TTL)
+            for page in pages[:-1]:
+                await self.safe_send_message(channel, page)
+            return Response(pages[-1], embed=False)
 
         if action == 'reload':
             await self._reload_twitter()
             return Response(':ok_hand:\n Twitter Disconnected, It will reconnect in few minutes!')
 
+        if action == 'filter':
+            # Everything after the name is a filter
+            filters = [x for x in (channel_name, includeUserReply, includeRetweet, batchWindow) if x is not None]
+            filters += leftover_args
+        else:
+            filters = leftover_args
+        try:
+            parse_filters(filters)
+        except ValueError as err:
+            return Response('Invalid filter, {}'.format(err), reply=True, delete_after=20)
+        filters = [x.strip().lower() for x in filters]
+
         if includeUserReply and str(includeUserReply).lower()[0] == 't':
             includeUserReply = True
         else:
@@ -895,18 +1097,26 @@ class Kanobot(Bot):
         else:
             includeRetweet = False
 
+        if action == '+':
+            try:
+                batchWindow = float(batchWindow) if batchWindow else 0
+            except ValueError:
+                return Response('Invalid batch window, must be seconds. e.g. 10', reply=True, delete_after=20)
+            if not 0 <= batchWindow <= TWITTER_MAX_BATCH_WINDOW:
+                return Response(
+                    'Invalid batch window, Must be between 0 and {}'.format(TWITTER_MAX_BATCH_WINDOW),
+                    reply=True,
+                    delete_after=20
+                )
+
         try:
-            user_obj = self.twitter.get_user(username=name, user_fields=["id"])
-            user = user_obj.data
+            user = await self.loop.run_in_executor(None, self._get_twitter_user, None, name)
         except Exception:
             return Response('Invalid twitter id, name. e.g. kano_2525', reply=True)
+        if not user and action == '+':
+            return Response('Invalid twitter id, name. e.g. kano_2525', reply=True)
 
-        data = self.jsonIO.get(self.config.webhook_file)
-        if not data.get('Discord', None):
-            data['Discord'] = []
-            data['twitter_ids'] = []
-            data['Category_ids'] = {}
-
+        data = self._get_webhooks()
         category_id = data['Category_ids'].get(str(guild.id), None)
 
         subscribed = False
@@ -914,12 +1124,12 @@ class Kanobot(Bot):
             if subscribe['guild_id'] != guild.id:
                 continue
 
-            if user and subscribe['twitter_id'] == str(user.id):
+            if user and subscribe['twitter_id'] == str(user['id']):
                 subscribed = subscribe
 
         if action == '+':
             if subscribed:
-                return Response('Already subscribed \n{}\n'.format(user.name))
+                return Response('Already subscribed \n{}\n'.format(user['name']))
 
             if not channel_name or (len(channel_name) > 32 or len(channel_name) < 2):
                 return Response('Invalid channel name, Must be between 2 and 32 in length', reply=True, delete_after=20)
@@ -927,7 +1137,7 @@ class Kanobot(Bot):
             try:
                 if category_id is None or guild.get_channel(category_id) is None:
                     overwrites = {guild.default_role: discord.PermissionOverwrite(send_messages=False)}
-                    data['Category_ids'][str(guild.id)] = category_id = (await guild.create_category_channel('twitter', overwrites=overwrites)).id
+                    category_id = (await guild.create_category_channel('twitter', overwrites=overwrites)).id
 
                 category = guild.get_channel(category_id)
 
@@ -941,49 +1151,158 @@ class Kanobot(Bot):
             except Exception as e:
                 raise exceptions.CommandError(e, expire_in=30)
 
-            data['Discord'].append({
-                'guild_id': guild.id,
-                'channel_id': channel.id,
-                'webhook_url': webhook_obj.url,
-                'webhook_id': webhook_obj.id,
-                'twitter_id': str(user.id),
-                'twitter_name': user.username,
-                'includeUserReply': includeUserReply,
-                'includeRetweet': includeRetweet
-            })
-            data['twitter_ids'].append(str(user.id))
-            data['twitter_ids'] = data['twitter_ids']
-            self.jsonIO.save(self.config.webhook_file, data)
+            # The relay prunes gone webhooks from the same file, edit what is there now
+            with self.jsonIO.lock(self.config.webhook_file):
+                data = self._get_webhooks()
+                data['Category_ids'][str(guild.id)] = category_id
+                data['Discord'].append({
+                    'guild_id': guild.id,
+                    'channel_id': channel.id,
+                    'webhook_url': webhook_obj.url,
+                    'webhook_id': webhook_obj.id,
+                    'twitter_id': str(user['id']),
+                    'twitter_name': user['username'],
+                    'includeUserReply': includeUserReply,
+                    'includeRetweet': includeRetweet,
+                    'batchWindow': batchWindow,
+                    'filters': filters
+                })
+                data['twitter_ids'] = followed_ids(data)
+                self.jsonIO.save(self.config.webhook_file, data)
+            self.response_cache.invalidate(('twitter', guild.id))
+        elif action == 'filter':
+            if not subscribed:
+                return Response('{} did not subscribe'.format(user['name'] if user else name))
+            with self.jsonIO.lock(self.config.webhook_file):
+                data = self._get_webhooks()
+                for dataD in data['Discord']:
+                    if dataD['guild_id'] == guild.id and dataD['twitter_id'] == subscribed['twitter_id']:
+                        dataD['filters'] = filters
+                self.jsonIO.save(self.config.webhook_file, data)
+            self.response_cache.invalidate(('twitter', guild.id))
+            await self._update_twitter()
+            quoted = ' '.join(shlex.quote(x) for x in filters) or 'none'
+            return Response("Filters of {} :ok_hand:\n\n{}\n".format(user['name'], quoted), embed=False)
         else:
             if not subscribed:
-                return Response('{} did not subscribe'.format(user.name if user else name))
-            data['Discord'].remove(subscribed)
-            data['twitter_ids'].remove(subscribed['twitter_id'])
-            self.jsonIO.save(self.config.webhook_file, data)
+                return Response('{} did not subscribe'.format(user['name'] if user else name))
+            with self.jsonIO.lock(self.config.webhook_file):
+                data = self._get_webhooks()
+                data['Discord'] = [
+                    dataD for dataD in data['Discord']
+                    if dataD['guild_id'] != guild.id or dataD['twitter_id'] != subscribed['twitter_id']
+                ]
+                data['twitter_ids'] = followed_ids(data)
+                self.jsonIO.save(self.config.webhook_file, data)
+            self.response_cache.invalidate(('twitter', guild.id))
             try:
                 # await (await self.get_webhook_info(subscribe['webhook_id'])).delete()
                 await guild.get_channel(subscribed['channel_id']).delete()
             except Exception:
                 raise exceptions.CommandError('Delete channel failed', expire_in=20)
 
-        await self._reload_twitter()
-        return Response("{} :ok_hand:\n\n{}\n".format("Subscribe" if action == '+' else "Unsubscribe", user.name))
+        await self._update_twitter()
+        return Response("{} :ok_hand:\n\n{}\n".format("Subscribe" if action == '+' else "Unsubscribe", user['name']))
+
+    async def _bulk_moderate(self, guild, channel, author, user_mentions, tokens, act):
+        """Select members by the tokens, leave out the invoker, the owner and the bot, then act on them"""
+        dry = 'dry' in tokens
+        try:
+            members = select_members(guild, [x for x in tokens if x != 'dry'], user_mentions)
+        except ValueError as err:
+            raise exceptions.CommandError(str(err), expire_in=20)
+        members = [x for x in members if x.id not in (author.id, guild.owner_id, self.user.id)]
+        if not members:
+            return Response('No member selected', reply=True, delete_after=15)
+        if dry:
+            names = ', '.join(str(x) for x in members[:50])
+            more = ' and {} more'.format(len(members) - 50) if len(members) > 50 else ''
+            return Response('{} members selected: {}{}'.format(len(members), names, more), delete_after=60, embed=False)
+
+        async def progress(result):
+            await self.safe_edit_message(status, result.summary(), quiet=True)
+
+        status = await self.safe_send_message(channel, 'Working on {} members...'.format(len(members)))
+        result = await act(members, progress if status is not None else None)
+        if status is not None:
+            await self.safe_delete_message(status, quiet=True)
+        LOG.info('{} by {}: {}'.format(result.action, author, result.report()))
+        return Response(result.report(), codeblock=True, embed=False)
 
     @admin_only
-    async def cmd_kick(self, user_mentions):
+    async def cmd_kick(self, guild, channel, author, user_mentions, leftover_args):
         """
         Usage:
-            {command_prefix}kick @user
-        Kick user from server.
+            {command_prefix}kick [@user ...] [role:name] [joined:30m] [dry]
+        Kick members from server, mentioned ones and those matching all selectors.
+            role:name or @role  members with this role
+            joined:30m          joined within the last 30 minutes, also s, h, d, w
+            joined-before:date  joined-after:date
+            dry                 only list who would be kicked
+        e.g. {command_prefix}kick @user
+             {command_prefix}kick joined:10m role:Newbie dry
         """
-        users = []
-        if not user_mentions:
+        if not user_mentions and not leftover_args:
             return Response("No user mentioned!")
-        for user in user_mentions:
-            await user.kick()
-            users.append(user.name)
+        return await self._bulk_moderate(
+            guild, channel, author, user_mentions, leftover_args,
+            lambda members, progress: self.moderation.kick(
+                members, reason='kick by {}'.format(author), progress=progress
+            )
+        )
+
+    @admin_only
+    async def cmd_ban(self, guild, channel, author, user_mentions, leftover_args):
+        """
+        Usage:
+            {command_prefix}ban [@user ...] [role:name] [joined:30m] [clean:1d] [dry]
+        Ban members from server, selected like kick.
+            clean:1d            also delete their messages of the last day, at most 7d
+        e.g. {command_prefix}ban joined:15m clean:1h
+        """
+        clean = [x for x in leftover_args if x.lower().startswith('clean:')]
+        tokens = [x for x in leftover_args if x not in clean]
+        if not user_mentions and not tokens:
+            return Response("No user mentioned!")
+        seconds = 0
+        if clean:
+            try:
+                seconds = int((datetime.now(timezone.utc) - parse_time(clean[-1].partition(':')[2])).total_seconds())
+            except ValueError:
+                raise exceptions.CommandError('clean takes a duration like 1h or 1d', expire_in=20)
+            seconds = min(max(seconds, 0), 7 * 24 * 60 * 60)
+        return await self._bulk_moderate(
+            guild, channel, author, user_mentions, tokens,
+            lambda members, progress: self.moderation.ban(
+                members, reason='ban by {}'.format(author), delete_message_seconds=seconds, progress=progress
+            )
+        )
 
-        return Response('successfully kicked {} from this server!'.format(", ".join(users)))
+    @admin_only
+    async def cmd_roles(self, guild, channel, author, user_mentions, leftover_args):
+        """
+        Usage:
+            {command_prefix}roles +role -role [@user ...] [role:name] [joined:30m] [dry]
+        Add and remove roles of members in one edit each, selected like kick.
+        e.g. {command_prefix}roles +Muted joined:10m
+             {command_prefix}roles +Member -Newbie role:Newbie
+        """
+        changes = [x for x in leftover_args if x[:1] in ('+', '-')]
+        tokens = [x for x in leftover_args if x not in changes]
+        try:
+            add, remove = role_changes(guild, changes)
+        except ValueError as err:
+            raise exceptions.CommandError(str(err), expire_in=20)
+        if not add and not remove:
+            return Response('No role change given, e.g. +Muted or -Newbie', reply=True, delete_after=15)
+        if not user_mentions and not tokens:
+            return Response("No user mentioned!")
+        return await self._bulk_moderate(
+            guild, channel, author, user_mentions, tokens,
+            lambda members, progress: self.moderation.edit_roles(
+                members, add, remove, reason='roles by {}'.format(author), progress=progress
+            )
+        )
 
     async def cmd_rps(self, message):
         """
@@ -1246,6 +1565,7 @@ class Kanobot(Bot):
 
         self.reply_message[str(guild.id)][certain_text].append(reply_message)
         self.jsonIO.save(self.config.reply_file, self.reply_message)
+        self.response_cache.invalidate(('replies', guild.id))
         return Response(f'{certain_text} Reply successfully added!', reply=True, embed=False)
 
     @admin_only
@@ -1273,9 +1593,11 @@ class Kanobot(Bot):
                 return Response('Not found')
 
         self.jsonIO.save(self.config.reply_file, self.reply_message)
+        self.response_cache.invalidate(('replies', guild.id))
         return Response('Reply successfully deleted!', delete_after=15, embed=False)
 
     @admin_only
+    @pure('replies')
     async def cmd_show_reply(self, guild, certain_text=None):
         """
         Usage:
@@ -1288,21 +1610,16 @@ class Kanobot(Bot):
            {command_prefix}show_reply lol
                 :joy:
         """
-        if not self.reply_message.get(str(guild.id), None):
+        replies = self.reply_message.get(str(guild.id), None)
+        if not replies:
             return Response("Nothing here")
-        text = "\n"
-
-        if isinstance(certain_text, str):
-            certain_text = certain_text.lower().strip()
 
-        for key, item in self.reply_message[str(guild.id)].items():
-            if certain_text is None:
-                text += f"{key}\n"
-            elif certain_text == key:
-                for index, _item in enumerate(item):
-                    text += f"{index+1}. {_item}\n"
-
-        return Response(text)
+        if certain_text is None:
+            lines = list(replies)
+        else:
+            found = replies.get(certain_text.lower().strip(), ())
+            lines = ['{}. {}'.format(index + 1, item) for index, item in enumerate(found)]
+        return Response('\n' + ''.join(line + '\n' for line in lines))
 
     @owner_only
     async def cmd_change_presence(self, activity=None):
@@ -1314,6 +1631,124 @@ class Kanobot(Bot):
         await self.change_presence(status=None, activity=game)
         return Response('success change presence!', delete_after=10, embed=False)
 
+    @owner_only
+    async def cmd_stats(self, channel):
+        """
+        Usage:
+            {command_prefix}stats
+        Show bot runtime statistics.
+        """
+        relay = await self.loop.run_in_executor(None, self.twitter_relay.stats) if self.twitter_relay else {}
+        pages = self._stats_pages(relay)
+        for page in pages[:-1]:
+            await self.safe_send_message(channel, '```\n{}\n```'.format(page))
+        return Response(pages[-1], codeblock=True, embed=False)
+
+    def _stats_pages(self, relay):
+        """Statistics lines split into code blocks which fit in a message each"""
+        lines = []
+        if relay.get('seen'):
+            lines.append(
+                'Tweet de-dup: {size}/{capacity} cached, {hits} hits, {misses} misses ({hit_rate:.1%})'.format(
+                    **relay['seen']
+                )
+            )
+        if relay.get('stream'):
+            stream = relay['stream']
+            lines.append(
+                'Twitter stream: {}, {} connects, {} reconnects, {} errors, {} failing, {} skipped unparsed'.format(
+                    'connected' if stream['running'] else 'disconnected', stream['connects'], stream['reconnects'],
+                    stream['errors'], stream['failures'], stream.get('skipped', 0)
+                )
+            )
+            if stream['last_error']:
+                lines.append(
+                    '  last error {:.0f}s ago: {}'.format(time.time() - stream['last_error_at'], stream['last_error'])
+                )
+        elif self.twitter_relay:
+            lines.append('Twitter stream: not started')
+        if relay.get('latency'):
+            latency = relay['latency']
+            lines.append('Delivery latency (ms, bucket upper bounds):')
+            for name, stage in latency['stages'].items():
+                lines.append(
+                    '  {:<8} {count:>6} samples, p50 {p50:.0f}, p90 {p90:.0f}, p99 {p99:.0f}, max {max:.0f}'.format(
+                        name, **stage
+                    )
+                )
+            for webhook_id, errors in sorted(latency['webhook_errors'].items(), key=lambda x: -x[1]['errors'])[:5]:
+                lines.append(
+                    '  webhook {} failed {} times, last {}'.format(webhook_id, errors['errors'], errors['last'])
+                )
+            for entry in latency['slowest']:
+                stages = ', '.join('{} {:.0f}'.format(x, y) for x, y in entry['stages'].items())
+                lines.append('  slow tweet {} to webhook {}: {}'.format(entry['tweet_id'], entry['webhook_id'], stages))
+        renders = self.renderer.stats()
+        lines.append(
+            'Renders: {done} done, {failed} failed, {rejected} busy, {waiting} waiting, '
+            '{running}/{workers} running'.format(**renders)
+        )
+        for name in ('wait', 'render'):
+            lines.append('  {:<8} p50 {p50:.0f}ms, p99 {p99:.0f}ms, max {max:.0f}ms'.format(name, **renders[name]))
+        cache = renders['cache']
+        lines.append(
+            'Render cache: {size} images, {:.1f}/{:.0f}MB, {hits} hits, {disk_hits} from disk, '
+            '{misses} misses ({hit_rate:.1%})'.format(
+                cache['bytes'] / 1024 / 1024, cache['max_bytes'] / 1024 / 1024, **cache
+            )
+        )
+        if cache['disk_bytes'] is not None:
+            lines.append('  {:.1f}MB on disk'.format(cache['disk_bytes'] / 1024 / 1024))
+        lines.append(
+            'Send queue: {sent} sent, {coalesced} coalesced, {dropped} dropped, {delayed} rate limited, '
+            '{waiting} waiting in {channels} channels'.format(**self.outbound.stats())
+        )
+        responses = self.response_cache.stats()
+        lines.append(
+            'Response cache: {size}/{capacity} cached, {hits} hits, {misses} misses ({hit_rate:.1%}), '
+            '{invalidated} invalidated'.format(**responses)
+        )
+        for command, counts in sorted(responses['commands'].items()):
+            lines.append('  {:<12} {hits} hits, {misses} misses ({hit_rate:.1%})'.format(command, **counts))
+        deletions = self.deletions.stats()
+        lines.append(
+            'Scheduled deletions: {pending} pending, {deleted} deleted in {bulk_calls} bulk '
+            'and {single_calls} single calls, {failed} failed'.format(**deletions)
+        )
+        users = self.twitter_users.stats()
+        lines.append(
+            'Twitter users: {size}/{capacity} cached, {hits} hits, {misses} misses ({hit_rate:.1%}), '
+            '{api_calls} api calls, {api_saved} saved'.format(**users)
+        )
+        pages = _paginate([line + '\n' for line in lines], DISCORD_MSG_CHAR_LIMIT - len('```\n\n```'))
+        return [page.rstrip('\n') for page in pages]
+
+    @owner_only
+    @require_twitter
+    async def cmd_outbox(self, action=None):
+        """
+        Usage:
+            {command_prefix}outbox
+            {command_prefix}outbox clear
+        Show twitter webhook posts waiting for delivery and the latest dead letters.
+        clear: Remove all dead letters.
+        """
+        dead_letters = await self.loop.run_in_executor(None, self.twitter_relay.dead_letters)
+        if action == 'clear':
+            await self.loop.run_in_executor(None, self.twitter_relay.clear_dead_letters)
+            return Response('Removed {} dead letters'.format(len(dead_letters)), delete_after=15)
+
+        relay = await self.loop.run_in_executor(None, self.twitter_relay.stats)
+        lines = ['{} pending, {} dead letters\n'.format(relay.get('outbox', '?'), len(dead_letters))]
+        for dead in dead_letters[-10:]:
+            lines.append(
+                '{} webhook {} after {} attempts: {}\n  {}\n'.format(
+                    datetime.utcfromtimestamp(dead['time']).strftime('%Y-%m-%d %H:%M'),
+                    dead['url'].split('/')[-2], dead['attempts'], dead['error'], dead['data'].get('content', '')
+                )
+            )
+        return Response(''.join(lines), codeblock=True, embed=False)
+
     async def cmd_ping(self):
         """
         Usage:
@@ -1336,26 +1771,75 @@ class Kanobot(Bot):
                         -    GG          - 
                         ------------------
         """
-        # open image and front files
-        img = Image.open(self.magic_cat)
-        font = ImageFont.truetype(self.font, 48)
-        draw = ImageDraw.Draw(img)
-        # split input to two string 
-        if (',' in certain_text):
-            str1, str2 = certain_text.split(',', 1)
-        else:
-            str1 = certain_text
-            str2 = ''
-        # position of first string
-        x1 = 455
-        y1 = 400
-        draw.text((x1, y1), str1, font=font, fill=(0, 0, 0))
-        # position of second string
-        x1 = 455
-        y1 = 450
-        draw.text((x1, y1), str2, font=font, fill=(0, 0, 0))
-        
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        await message.channel.send(file=discord.File(img_byte_arr, self.magic_cat))
\ No newline at end of file
+        try:
+            image = await self.renderer.render(
+                guild.id if guild else None,
+                render_magic,
+                self.magic_cat,
+                self.font,
+                certain_text,
+                self.config.image_encodings,
+                self.config.image_max_size,
+                key=render_key(
+                    self.magic_cat, self.font, split_magic_text(certain_text), ','.join(self.config.image_encodings),
+                    self.config.image_max_size
+                )
+            )
+        except exceptions.RenderBusy as e:
+            return Response(e.message, reply=True, delete_after=e.expire_in)
+        img_byte_arr = io.BytesIO(image)
+        filename = '{}.{}'.format(os.path.splitext(os.path.basename(self.magic_cat))[0], image_extension(image))
+        await message.channel.send(file=discord.File(img_byte_arr, filename))
+
+    async def cmd_meme(self, message, guild, template=None, text=None):
+        """
+        Usage:
+            {command_prefix}meme
+            {command_prefix}meme template "text"
+            Reply the template with text drawn in its text boxes, ',' moves on to the next box
+            Text is wrapped and shrunk to fit its box, without a template the templates are listed
+        example:
+            {command_prefix}meme magic_cat "love eat,GG"
+        """
+        names = await self.loop.run_in_executor(None, self.templates.names)
+        if template is None:
+            return Response('Templates: {}'.format(', '.join(sorted(names)) or 'none'), delete_after=30)
+        spec = await self.loop.run_in_executor(None, self.templates.get, template)
+        if spec is None:
+            raise exceptions.CommandError(
+                'Unknown template {}, templates: {}'.format(template, ', '.join(sorted(names))), expire_in=20
+            )
+        if not text:
+            raise exceptions.CommandError('Text is required', expire_in=20)
+
+        encodings = spec['encoding'] or self.config.image_encodings
+        max_size = spec['max_size'] or self.config.image_max_size
+        try:
+            image = await self.renderer.render(
+                guild.id if guild else None,
+                render_meme,
+                spec,
+                text,
+                encodings,
+                max_size,
+                key=render_key(spec['image'], spec['font'], [text], ','.join(encodings), max_size, spec)
+            )
+        except exceptions.RenderBusy as e:
+            return Response(e.message, reply=True, delete_after=e.expire_in)
+        filename = '{}.{}'.format(os.path.splitext(os.path.basename(spec['image']))[0], image_extension(image))
+        await message.channel.send(file=discord.File(io.BytesIO(image), filename))
+
+    @owner_only
+    async def cmd_reload_images(self):
+        """
+        Usage:
+            {command_prefix}reload_images
+        Re-read ImageFile, FontFile and TemplateDir from the config, the next render loads them again.
+        """
+        config = Config(self.config.config_file)
+        self.config.magic_cat_file = self.magic_cat = config.magic_cat_file
+        self.config.font_file = self.font = config.font_file
+        self.config.template_dir = self.templates.directory = config.template_dir
+        self.templates.reload(self.font)
+        self.renderer.reload([(self.magic_cat, self.font, MAGIC_FONT_SIZE)])
+        return Response(':ok_hand:', delete_after=15)
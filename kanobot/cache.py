@@ -0,0 +1,352 @@
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from .constants import (
+    TWITTER_SEEN_CAPACITY, TWITTER_SEEN_TTL, TWITTER_USER_CACHE_CAPACITY, TWITTER_USER_CACHE_TTL,
+    RENDER_CACHE_MAX_BYTES, RENDER_CACHE_MAX_DISK_BYTES, RESPONSE_CACHE_CAPACITY
+)
+
+
+class SeenCache:
+    """
+    Bounded LRU/TTL set of (webhook id, tweet id) pairs which were delivered.
+    Shared by the stream thread and the bot, so every access holds the lock.
+    changes counts the pairs added, a saver compares it to skip unchanged dumps.
+    """
+
+    def __init__(self, capacity=TWITTER_SEEN_CAPACITY, ttl=TWITTER_SEEN_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.changes = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def seen(self, webhook_id, tweet_id):
+        """
+        Return True when the pair was seen before, otherwise remember it.
+        @param {String|Int} webhook_id
+        @param {String|Int} tweet_id
+        """
+        key = (int(webhook_id), int(tweet_id))
+        now = time.time()
+        with self._lock:
+            expire_at = self._entries.get(key)
+            if expire_at is not None and expire_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+
+            self._entries[key] = now + self.ttl
+            self._entries.move_to_end(key)
+            self.misses += 1
+            self.changes += 1
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+            return False
+
+    def dump(self):
+        """Unexpired entries as [webhook id, tweet id, expire at], oldest first"""
+        now = time.time()
+        with self._lock:
+            return [
+                [webhook_id, tweet_id, expire_at] for (webhook_id, tweet_id), expire_at in self._entries.items()
+                if expire_at > now
+            ]
+
+    def load(self, entries):
+        """Restore entries produced by dump"""
+        now = time.time()
+        with self._lock:
+            for webhook_id, tweet_id, expire_at in entries[-self.capacity:]:
+                if expire_at > now:
+                    self._entries[(int(webhook_id), int(tweet_id))] = expire_at
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+
+class UserCache:
+    """
+    Bounded TTL cache of twitter user profiles, looked up by id or username.
+    Filled by REST lookups and by includes.users of every streamed tweet.
+    """
+
+    def __init__(self, capacity=TWITTER_USER_CACHE_CAPACITY, ttl=TWITTER_USER_CACHE_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+        self.api_saved = 0
+        self._users = OrderedDict()
+        self._usernames = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._users)
+
+    def put(self, user):
+        """
+        Cache a user profile and return it.
+        @param {Dict} user - raw v2 user object with id, name, username
+        """
+        user_id = str(user['id'])
+        with self._lock:
+            old = self._users.pop(user_id, None)
+            if old:
+                self._usernames.pop(old[1]['username'].lower(), None)
+            self._users[user_id] = (time.time() + self.ttl, user)
+            self._usernames[user['username'].lower()] = user_id
+            while len(self._users) > self.capacity:
+                _, (_, evicted) = self._users.popitem(last=False)
+                self._usernames.pop(evicted['username'].lower(), None)
+        return user
+
+    def get(self, user_id=None, username=None):
+        """Cached profile by id or username, None when missing or expired"""
+        with self._lock:
+            if user_id is None and username is not None:
+                user_id = self._usernames.get(username.lower())
+            entry = self._users.get(str(user_id)) if user_id is not None else None
+            if entry and entry[0] > time.time():
+                self._users.move_to_end(str(user_id))
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def record(self, calls, saved):
+        """Count api calls made and avoided by a lookup through the cache"""
+        with self._lock:
+            self.api_calls += calls
+            self.api_saved += saved
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._users),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'api_calls': self.api_calls,
+            'api_saved': self.api_saved
+        }
+
+
+class RenderCache:
+    """
+    Bounded LRU of rendered images by content key, evicting by total bytes.
+    With disk_dir set, entries are also written there and read back on a memory miss,
+    so they survive restarts. The disk tier is bounded by max_disk_bytes, oldest files first.
+    """
+
+    def __init__(self, max_bytes=RENDER_CACHE_MAX_BYTES, disk_dir=None, max_disk_bytes=RENDER_CACHE_MAX_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self.disk_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.disk_bytes = sum(entry.stat().st_size for entry in os.scandir(disk_dir) if entry.is_file())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Bytes from memory, None on a miss"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return data
+
+    def load(self, key):
+        """Bytes from the disk tier, promoted into memory. Blocking, run it in an executor"""
+        if not self.disk_dir:
+            return None
+        try:
+            with open(os.path.join(self.disk_dir, key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        self._remember(key, data)
+        with self._lock:
+            self.disk_hits += 1
+        return data
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def put(self, key, data):
+        """Remember data, and write it to the disk tier. Blocking when disk_dir is set"""
+        self._remember(key, data)
+        if not self.disk_dir:
+            return
+        filename = os.path.join(self.disk_dir, key)
+        if os.path.isfile(filename):
+            return
+        try:
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(filename + '.tmp', filename)
+        except OSError:
+            return
+        with self._lock:
+            self.disk_bytes += len(data)
+            over = self.disk_bytes > self.max_disk_bytes
+        if over:
+            self._trim_disk()
+
+    def _remember(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._entries[key] = data
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def _trim_disk(self):
+        entries = sorted(
+            (entry for entry in os.scandir(self.disk_dir) if entry.is_file()), key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in entries:
+            with self._lock:
+                if self.disk_bytes <= self.max_disk_bytes * 0.9:
+                    return
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            with self._lock:
+                self.disk_bytes -= size
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'disk_bytes': self.disk_bytes if self.disk_dir else None,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / total if total else 0.0
+            }
+
+
+class ResponseCache:
+    """
+    Answers of read-only commands, keyed by command, guild, permission tier and arguments.
+    Every entry carries tags naming the data it was built from, e.g. ('replies', guild_id),
+    and invalidate(tag) drops exactly the entries built from it. Entries may also expire.
+    Per command hit and miss counts are kept for stats.
+    Only touched from the event loop, so it needs no locking.
+    """
+
+    def __init__(self, capacity=RESPONSE_CACHE_CAPACITY):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self.commands = {}
+        self._entries = OrderedDict()
+        self._tags = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Cached value or None, key[0] is the command"""
+        entry = self._entries.get(key)
+        counts = self.commands.setdefault(key[0], [0, 0])
+        if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            counts[0] += 1
+            return entry[2]
+        if entry is not None:
+            self._drop(key)
+        self.misses += 1
+        counts[1] += 1
+        return None
+
+    def put(self, key, value, tags=(), ttl=None):
+        self._drop(key)
+        self._entries[key] = (time.monotonic() + ttl if ttl else None, tuple(tags), value)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.capacity:
+            self._drop(next(iter(self._entries)))
+        return value
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[1]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, tag):
+        """Drop every entry built from tag"""
+        keys = self._tags.pop(tag, ())
+        for key in list(keys):
+            self._drop(key)
+        self.invalidated += len(keys)
+
+    def clear(self):
+        self._entries.clear()
+        self._tags.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'invalidated': self.invalidated,
+            'commands': dict(
+                (
+                    command, {
+                        'hits': hits,
+                        'misses': misses,
+                        'hit_rate': hits / (hits + misses) if hits + misses else 0.0
+                    }
+                ) for command, (hits, misses) in self.commands.items()
+            )
+        }
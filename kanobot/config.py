@@ -1,14 +1,51 @@
 import os
 import sys
+import ipaddress
 import configparser
 import shutil
 import logging
 
 from .exceptions import HelpfulError
+from .constants import (
+    TWITTER_RULE_MAX_LENGTH, TWITTER_BACKFILL_MAX_AGE, TWITTER_RECENT_SEARCH_MAX_AGE, RENDER_CACHE_MAX_BYTES,
+    RENDER_ENCODINGS, RENDER_DEFAULT_ENCODINGS, SEND_QUEUE_DEPTH, MODERATION_CONCURRENCY, MODERATION_ROUTES
+)
 
 LOG = logging.getLogger(__name__)
 
 
+def is_loopback(host):
+    """True for localhost and loopback ips, other names may resolve anywhere"""
+    if host.lower() == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host.strip('[]')).is_loopback
+    except ValueError:
+        return False
+
+
+def parse_moderation_rates(value):
+    """
+    ModerationRates "kick:1/5, roles:2" -> {'kick': (1.0, 5), 'roles': (2.0, 1)},
+    requests per second and burst per route, invalid entries are left out.
+    """
+    rates = {}
+    for entry in value.replace(',', ' ').lower().split():
+        route, _, rate = entry.partition(':')
+        rate, _, burst = rate.partition('/')
+        try:
+            rate, burst = float(rate), int(burst or 1)
+        except ValueError:
+            rate = burst = 0
+        if route not in MODERATION_ROUTES or rate <= 0 or burst < 1:
+            LOG.warning(
+                "Invalid ModerationRates entry %s, use route:rate/burst, routes %s", entry, ', '.join(MODERATION_ROUTES)
+            )
+            continue
+        rates[route] = (rate, burst)
+    return rates
+
+
 class Config:
 
     def __init__(self, config_file):
@@ -47,16 +84,55 @@ class Config:
         self.timeout = config.getfloat('Bot', 'Timeout', fallback=ConfigDefaults.timeout)
         self.twitter_token = config.get('Bot', 'TwitterBearerToken', fallback=ConfigDefaults.twitter_token)
         self.enable_change_avatar = config.get('Bot', 'EnableChangeAvatar', fallback=ConfigDefaults.enable_change_avatar)
+        self.twitter_rule_max_length = config.getint(
+            'Bot', 'TwitterRuleMaxLength', fallback=ConfigDefaults.twitter_rule_max_length
+        )
+        self.twitter_backfill_max_age = config.getint(
+            'Bot', 'TwitterBackfillMaxAge', fallback=ConfigDefaults.twitter_backfill_max_age
+        )
+        self.twitter_relay_mode = config.get('Bot', 'TwitterRelayMode', fallback=ConfigDefaults.twitter_relay_mode)
+        self.twitter_relay_address = config.get(
+            'Bot', 'TwitterRelayAddress', fallback=ConfigDefaults.twitter_relay_address
+        )
+        self.twitter_relay_token = config.get('Bot', 'TwitterRelayToken', fallback=ConfigDefaults.twitter_relay_token)
+        self.render_cache_size = config.getint('Bot', 'RenderCacheSize', fallback=ConfigDefaults.render_cache_size)
+        self.render_cache_dir = config.get('Bot', 'RenderCacheDir', fallback=ConfigDefaults.render_cache_dir)
+        self.image_encodings = config.get('Bot', 'ImageEncoding', fallback=ConfigDefaults.image_encodings)
+        self.image_max_size = config.getint('Bot', 'ImageMaxSize', fallback=ConfigDefaults.image_max_size)
+        self.send_queue_size = config.getint('Bot', 'SendQueueSize', fallback=ConfigDefaults.send_queue_size)
+        self.send_queue_drop = config.get('Bot', 'SendQueueDrop', fallback=ConfigDefaults.send_queue_drop)
+        self.moderation_concurrency = config.getint(
+            'Bot', 'ModerationConcurrency', fallback=ConfigDefaults.moderation_concurrency
+        )
+        self.moderation_rates = config.get('Bot', 'ModerationRates', fallback=ConfigDefaults.moderation_rates)
         self.blacklist_file = config.get('Files', 'BlacklistFile', fallback=ConfigDefaults.blacklist_file)
         self.banned_file = config.get('Files', 'BannedFile', fallback=ConfigDefaults.banned_file)
         self.webhook_file = config.get('Files', 'WebhookFile', fallback=ConfigDefaults.webhook_file)
         self.role_manager_file = config.get('Files', 'RoleManagerFile', fallback=ConfigDefaults.role_manager_file)
         self.reply_file = config.get('Files', 'ReplyFile', fallback=ConfigDefaults.reply_file)
+        self.seen_file = config.get('Files', 'SeenFile', fallback=ConfigDefaults.seen_file)
+        self.checkpoint_file = config.get('Files', 'CheckpointFile', fallback=ConfigDefaults.checkpoint_file)
+        self.outbox_file = config.get('Files', 'OutboxFile', fallback=ConfigDefaults.outbox_file)
+        self.dead_letter_file = config.get('Files', 'DeadLetterFile', fallback=ConfigDefaults.dead_letter_file)
         self.magic_cat_file = config.get('Files', 'ImageFile', fallback=ConfigDefaults.magic_cat_file)
         self.font_file = config.get('Files', 'FontFile', fallback=ConfigDefaults.font_file)
+        self.template_dir = config.get('Files', 'TemplateDir', fallback=ConfigDefaults.template_dir)
+        self.deletions_file = config.get('Files', 'DeletionsFile', fallback=ConfigDefaults.deletions_file)
 
         self.run_checks()
 
+    def check_relay_token(self):
+        """The relay control socket needs a token unless it only listens on loopback"""
+        if not self.twitter_relay_token and not is_loopback(self.twitter_relay_address[0]):
+            # Its dead letters hold webhook urls, which carry the webhook tokens
+            raise HelpfulError(
+                "TwitterRelayAddress {} is reachable from other machines without a TwitterRelayToken.".format(
+                    self.twitter_relay_address[0]
+                ),
+                "Set TwitterRelayToken to the same secret for the bot and the relay, or use 127.0.0.1",
+                preface=self._confpreface2
+            )
+
     def run_checks(self):
         """
         Validation logic for bot settings.
@@ -108,6 +184,49 @@ class Config:
 
             self.block_channels = set(int(item.replace(',', ' ').strip()) for item in self.block_channels)
 
+        # minutes in config, seconds from here on
+        self.twitter_backfill_max_age *= 60
+        if self.twitter_backfill_max_age > TWITTER_RECENT_SEARCH_MAX_AGE:
+            LOG.warning("TwitterBackfillMaxAge is over the 7 days of recent search, using 7 days")
+            self.twitter_backfill_max_age = TWITTER_RECENT_SEARCH_MAX_AGE
+
+        self.twitter_relay_mode = self.twitter_relay_mode.lower()
+        if self.twitter_relay_mode not in ('internal', 'external'):
+            LOG.warning("Invalid TwitterRelayMode option %s given, falling back to internal", self.twitter_relay_mode)
+            self.twitter_relay_mode = 'internal'
+
+        try:
+            host, port = self.twitter_relay_address.rsplit(':', 1)
+            self.twitter_relay_address = (host, int(port))
+        except ValueError:
+            raise HelpfulError(
+                "An invalid TwitterRelayAddress was set: {}".format(self.twitter_relay_address),
+                "Use host:port, e.g. 127.0.0.1:8765",
+                preface=self._confpreface
+            )
+        if self.twitter_relay_mode == 'external':
+            self.check_relay_token()
+
+        # MB in config, bytes from here on
+        self.render_cache_size = max(self.render_cache_size, 0) * 1024 * 1024
+
+        encodings = [x for x in self.image_encodings.replace(',', ' ').lower().split() if x]
+        for encoding in [x for x in encodings if x not in RENDER_ENCODINGS]:
+            LOG.warning("Unknown ImageEncoding %s, must be one of %s", encoding, ', '.join(RENDER_ENCODINGS))
+            encodings.remove(encoding)
+        self.image_encodings = tuple(encodings) or RENDER_DEFAULT_ENCODINGS
+        # KB in config, bytes from here on
+        self.image_max_size = max(self.image_max_size, 0) * 1024
+
+        self.send_queue_size = max(self.send_queue_size, 1)
+        self.send_queue_drop = self.send_queue_drop.lower()
+        if self.send_queue_drop not in ('newest', 'oldest'):
+            LOG.warning("Invalid SendQueueDrop option %s given, falling back to newest", self.send_queue_drop)
+            self.send_queue_drop = 'newest'
+
+        self.moderation_concurrency = max(self.moderation_concurrency, 1)
+        self.moderation_rates = parse_moderation_rates(self.moderation_rates)
+
         if hasattr(logging, self.debug_level.upper()):
             self.debug_level = getattr(logging, self.debug_level.upper())
         else:
@@ -211,6 +330,19 @@ class ConfigDefaults:
     delete_messages = True
     twitter_token = None
     enable_change_avatar = False
+    twitter_rule_max_length = TWITTER_RULE_MAX_LENGTH
+    twitter_backfill_max_age = TWITTER_BACKFILL_MAX_AGE // 60
+    twitter_relay_mode = 'internal'
+    twitter_relay_address = '127.0.0.1:8765'
+    twitter_relay_token = None
+    render_cache_size = RENDER_CACHE_MAX_BYTES // 1024 // 1024
+    render_cache_dir = None
+    image_encodings = ','.join(RENDER_DEFAULT_ENCODINGS)
+    image_max_size = 0
+    send_queue_size = SEND_QUEUE_DEPTH
+    send_queue_drop = 'newest'
+    moderation_concurrency = MODERATION_CONCURRENCY
+    moderation_rates = ''
 
     blacklist_file = 'config/blacklist.txt'
     banned_file = 'config/banned.txt'
@@ -219,5 +351,11 @@ class ConfigDefaults:
     webhook_file = 'config/webhook.json'
     role_manager_file = 'config/role_manager.json'
     reply_file = 'config/reply_file.json'
+    seen_file = 'config/seen_tweets.json'
+    checkpoint_file = 'config/twitter_checkpoint.json'
+    outbox_file = 'config/outbox.log'
+    dead_letter_file = 'config/dead_letter.jsonl'
     magic_cat_file = 'resources/images/magic_cat.png'
-    font_file = 'resources/fonts/WenQuanYi.ttf'
\ No newline at end of file
+    font_file = 'resources/fonts/WenQuanYi.ttf'
+    template_dir = 'resources/images'
+    deletions_file = 'config/pending_deletions.bin'
\ No newline at end of file
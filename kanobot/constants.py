@@ -1 +1,70 @@
 DISCORD_MSG_CHAR_LIMIT = 2000
+# Links of one message, discord previews only the first five
+DISCORD_WEBHOOK_BATCH_LIMIT = 5
+# Messages per second and burst of one channel, discord allows 5 per 5 seconds
+DISCORD_SEND_RATE = 1
+DISCORD_SEND_BURST = 5
+SEND_QUEUE_DEPTH = 50
+DISCORD_BULK_DELETE_LIMIT = 100
+DISCORD_BULK_DELETE_MAX_AGE = 14 * 24 * 60 * 60
+DELETION_SAVE_INTERVAL = 30
+# Seconds a deletion may run early to share a bulk delete with others
+DELETION_BATCH_WINDOW = 1
+PURGE_MAX_RANGE = 100000
+PURGE_SINGLE_DELETE_INTERVAL = 1.2
+PURGE_PROGRESS_INTERVAL = 5
+MODERATION_CONCURRENCY = 5
+MODERATION_ROUTES = ('kick', 'ban', 'roles')
+# Tries of a member whose request stays rate limited after discord.py's own retries
+MODERATION_RETRIES = 3
+MODERATION_PROGRESS_INTERVAL = 5
+RESPONSE_CACHE_CAPACITY = 1000
+# Seconds answers built from discord or twitter profiles, which nothing invalidates, are kept
+RESPONSE_CACHE_PROFILE_TTL = 10 * 60
+TWITTER_MAX_BATCH_WINDOW = 60
+TWITTER_RULE_MAX_LENGTH = 512
+TWITTER_RULE_TAG_PREFIX = 'kanobot:'
+TWITTER_SEEN_CAPACITY = 10000
+TWITTER_SEEN_TTL = 3 * 24 * 60 * 60
+TWITTER_BACKFILL_MAX_AGE = 60 * 60
+TWITTER_BACKFILL_MAX_PAGES = 10
+TWITTER_RECENT_SEARCH_MAX_AGE = 7 * 24 * 60 * 60
+TWITTER_STATE_SAVE_INTERVAL = 5 * 60
+TWITTER_USERS_LOOKUP_LIMIT = 100
+TWITTER_USER_CACHE_CAPACITY = 1000
+TWITTER_USER_CACHE_TTL = 6 * 60 * 60
+TWITTER_USER_FIELDS = ["username", "id", "profile_image_url"]
+TWITTER_EXPANSIONS = ["author_id", "referenced_tweets.id.author_id"]
+TWITTER_TWEET_FIELDS = ["referenced_tweets", "author_id", "created_at", "attachments", "entities"]
+TWITTER_IDLE_POLL = 60
+TWITTER_WATCH_INTERVAL = 10
+TWITTER_RECONNECT_BASE = 2
+TWITTER_RECONNECT_CAP = 5 * 60
+TWITTER_OUTBOX_MAX_ATTEMPTS = 5
+TWITTER_OUTBOX_REPLAY_WORKERS = 4
+TWITTER_OUTBOX_COMPACT_SIZE = 1024 * 1024
+TWITTER_RELAY_TIMEOUT = 5
+TWITTER_LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000, 300000)
+TWITTER_SLOWEST_DELIVERIES = 5
+MAGIC_FONT_SIZE = 48
+MAGIC_TEXT_POSITIONS = ((455, 400), (455, 450))
+MAGIC_TEXT_COLOR = (0, 0, 0)
+RENDER_WORKERS = 2
+RENDER_QUEUE_SIZE = 16
+RENDER_CACHE_MAX_BYTES = 32 * 1024 * 1024
+RENDER_CACHE_MAX_DISK_BYTES = 256 * 1024 * 1024
+# Output encodings for rendered images, name -> Pillow save options
+RENDER_ENCODINGS = {
+    'png': {'format': 'PNG'},
+    'png-fast': {'format': 'PNG', 'compress_level': 1},
+    'png-small': {'format': 'PNG', 'optimize': True},
+    'webp': {'format': 'WEBP', 'quality': 80},
+    'webp-fast': {'format': 'WEBP', 'quality': 80, 'method': 0},
+    'webp-lossless': {'format': 'WEBP', 'lossless': True},
+    'jpeg': {'format': 'JPEG', 'quality': 85},
+    'jpeg-small': {'format': 'JPEG', 'quality': 70, 'optimize': True},
+}
+RENDER_DEFAULT_ENCODINGS = ('png', )
+RENDER_TEMPLATE_CACHE_BYTES = 64 * 1024 * 1024
+MEME_MIN_FONT_SIZE = 12
+MEME_LINE_SPACING = 1.1
@@ -0,0 +1,188 @@
+import os
+import time
+import heapq
+import struct
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+import discord
+
+from .constants import (
+    DISCORD_BULK_DELETE_LIMIT, DISCORD_BULK_DELETE_MAX_AGE, DELETION_SAVE_INTERVAL, DELETION_BATCH_WINDOW
+)
+
+LOG = logging.getLogger(__name__)
+
+# due (unix time), channel id, message id
+RECORD = struct.Struct('<dQQ')
+
+
+def bulk_deletable(message_id, now=None):
+    """Discord only bulk deletes messages younger than 14 days, a minute of margin for clock skew"""
+    now = now or datetime.now(timezone.utc)
+    return discord.utils.snowflake_time(message_id) > now - timedelta(seconds=DISCORD_BULK_DELETE_MAX_AGE - 60)
+
+
+class DeletionScheduler:
+    """
+    Pending message deletions (expire_in, delete_after) in one heap, worked off by a
+    single task instead of a sleeping task per message.
+    Deletions falling due within DELETION_BATCH_WINDOW are grouped per channel into delete_messages calls
+    of up to 100 messages, messages too old for that or channels without the permission
+    fall back to single deletes, which discord.py paces per route.
+    The heap is written to filename as fixed size records (RECORD, 24 bytes each) at most
+    every save_interval seconds and on close, deletions due while the bot was down run
+    right after it starts again.
+    Only touched from the event loop, except close.
+    """
+
+    def __init__(self, filename, resolve, save_interval=DELETION_SAVE_INTERVAL):
+        """
+        @param {String} filename
+        @param {Function} resolve - channel id -> channel to delete in, None when it is gone
+        """
+        self.filename = filename
+        self.resolve = resolve
+        self.save_interval = save_interval
+        self._heap = []
+        self._wakeup = None
+        self._task = None
+        self._dirty = False
+        self._saved_at = 0
+        self.deleted = 0
+        self.bulk_calls = 0
+        self.single_calls = 0
+        self.failed = 0
+        self._load()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _load(self):
+        if not os.path.isfile(self.filename):
+            return
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        # A torn tail from a crash is dropped, whole records before it are kept
+        usable = len(data) - len(data) % RECORD.size
+        self._heap = list(RECORD.iter_unpack(data[:usable]))
+        heapq.heapify(self._heap)
+        LOG.debug('Loaded {} pending deletions'.format(len(self._heap)))
+
+    def dump(self):
+        return b''.join(RECORD.pack(*entry) for entry in self._heap)
+
+    def save(self, data=None):
+        """Blocking, rewrites the whole file"""
+        data = self.dump() if data is None else data
+        if os.path.dirname(self.filename):
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with open(self.filename + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def schedule(self, message, after):
+        """
+        Delete message after seconds.
+        @param {discord.Message} message
+        @param {Number} after
+        """
+        entry = (time.time() + max(after or 0, 0), message.channel.id, message.id)
+        heapq.heappush(self._heap, entry)
+        self._dirty = True
+        if self._wakeup is not None and self._heap[0] is entry:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = time.time()
+            due = {}
+            while self._heap and self._heap[0][0] <= now + DELETION_BATCH_WINDOW:
+                _, channel_id, message_id = heapq.heappop(self._heap)
+                due.setdefault(channel_id, []).append(message_id)
+            if due:
+                self._dirty = True
+                for channel_id, message_ids in due.items():
+                    try:
+                        await self._delete(channel_id, message_ids)
+                    except Exception:
+                        LOG.error('Deleting messages in channel {} failed'.format(channel_id), exc_info=True)
+
+            if self._dirty and time.monotonic() - self._saved_at >= self.save_interval:
+                self._dirty = False
+                self._saved_at = time.monotonic()
+                try:
+                    await loop.run_in_executor(None, self.save, self.dump())
+                except OSError as err:
+                    LOG.warning('Saving pending deletions failed: {}'.format(err))
+
+            timeout = self.save_interval
+            if self._heap:
+                timeout = min(timeout, max(self._heap[0][0] - time.time(), 0))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _delete(self, channel_id, message_ids):
+        channel = self.resolve(channel_id)
+        if channel is None:
+            self.failed += len(message_ids)
+            return
+        single = message_ids
+        if hasattr(channel, 'delete_messages') and len(message_ids) > 1:
+            now = datetime.now(timezone.utc)
+            young = [x for x in message_ids if bulk_deletable(x, now)]
+            single = [x for x in message_ids if not bulk_deletable(x, now)]
+            for i in range(0, len(young), DISCORD_BULK_DELETE_LIMIT):
+                chunk = young[i:i + DISCORD_BULK_DELETE_LIMIT]
+                try:
+                    self.bulk_calls += 1
+                    await channel.delete_messages([discord.Object(id=x) for x in chunk])
+                    self.deleted += len(chunk)
+                except discord.Forbidden:
+                    # No Manage Messages, the bot can still delete its own messages one by one
+                    single.extend(young[i:])
+                    break
+                except discord.HTTPException as err:
+                    LOG.debug('Bulk delete in {} failed: {}'.format(channel_id, err))
+                    single.extend(chunk)
+
+        for message_id in single:
+            try:
+                self.single_calls += 1
+                await channel.get_partial_message(message_id).delete()
+                self.deleted += 1
+            except discord.NotFound:
+                pass
+            except discord.HTTPException as err:
+                self.failed += 1
+                LOG.debug('Cannot delete message {} in {}: {}'.format(message_id, channel_id, err))
+
+    def stats(self):
+        return {
+            'pending': len(self._heap),
+            'next': self._heap[0][0] - time.time() if self._heap else None,
+            'deleted': self.deleted,
+            'bulk_calls': self.bulk_calls,
+            'single_calls': self.single_calls,
+            'failed': self.failed
+        }
+
+    def close(self):
+        """Stop and persist what is still pending, callable after the loop is gone"""
+        try:
+            self.save()
+        except OSError as err:
+            LOG.warning('Saving pending deletions failed: {}'.format(err))
+        if self._task is not None and not self._task.get_loop().is_closed():
+            self._task.cancel()
+        self._task = None
@@ -39,6 +39,18 @@ class PermissionsError(CommandError):
         return "You don't have permission to use that command.\nReason: " + self._message
 
 
+# The render queue is full, answered right away instead of waiting
+class RenderBusy(CommandError):
+    """ TODO """
+    pass
+
+
+# The send queue of a channel is full and dropped the message
+class MessageDropped(BotException):
+    """ TODO """
+    pass
+
+
 # Error with pretty formatting for hand-holding users through various errors
 class HelpfulError(BotException):
     """ TODO """
@@ -0,0 +1,156 @@
+import re
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# Tweet feature bits, hashtag and keyword terms take the bits above them
+REPLY = 1 << 0
+RETWEET = 1 << 1
+MEDIA = 1 << 2
+LINKS = 1 << 3
+TERM_SHIFT = 4
+
+HAS_FILTERS = {'media': MEDIA, 'links': LINKS}
+HASHTAG_PATTERN = re.compile(r'#(\w+)')
+# Word characters of scripts which separate words by spaces, CJK text has no word boundaries
+SPACED_WORD = r'[^\W\u2e80-\uffff]'
+
+
+def keyword_pattern(keyword):
+    """
+    Regex of one keyword, matching whole words: cat matches "a cat!" but not "concatenate".
+    Edges in CJK scripts match anywhere, e.g. 猫 matches "子猫".
+    """
+    pattern = re.escape(keyword)
+    if re.match(SPACED_WORD, keyword[0]):
+        pattern = '(?<!{}){}'.format(SPACED_WORD, pattern)
+    if re.match(SPACED_WORD, keyword[-1]):
+        pattern = '{}(?!{})'.format(pattern, SPACED_WORD)
+    return pattern
+
+
+def parse_filters(tokens):
+    """
+    Parse subscription filter expressions, raises ValueError on an invalid one.
+        has:media, has:links     only tweets with media / links
+        -has:media, -has:links   only tweets without
+        #tag                     only tweets with one of these hashtags
+        word                     only tweets containing one of these keywords
+        -word                    no tweets containing this keyword
+    Keywords are case insensitive and match whole words, see keyword_pattern.
+    @param {List} tokens - filter expressions, e.g. ['has:media', '#art', '-spoiler']
+    """
+    spec = {'required': 0, 'forbidden': 0, 'hashtags': set(), 'keywords': set(), 'exclude': set()}
+    for token in tokens:
+        token = token.strip().lower()
+        negate = token.startswith('-')
+        term = token[1:] if negate else token
+        if not term:
+            raise ValueError('Empty filter {!r}'.format(token))
+        if term.startswith('has:'):
+            bit = HAS_FILTERS.get(term[4:])
+            if bit is None:
+                choices = ', '.join('has:' + x for x in HAS_FILTERS)
+                raise ValueError('Unknown filter {}, must be one of {}'.format(token, choices))
+            spec['forbidden' if negate else 'required'] |= bit
+        elif term.startswith('#'):
+            if negate or not HASHTAG_PATTERN.fullmatch(term):
+                raise ValueError('Invalid hashtag filter {}'.format(token))
+            spec['hashtags'].add(term[1:])
+        else:
+            spec['exclude' if negate else 'keywords'].add(term)
+    return spec
+
+
+class TweetMatcher:
+    """
+    The subscriptions of one twitter account compiled into a single matcher.
+    A tweet is reduced to a bitmask once (reply, retweet, media, links and every
+    hashtag or keyword any subscriber filters on, whole word keywords found by one
+    combined regex), subscribers are grouped by their (required, forbidden, any of) masks,
+    so matching costs a few integer operations per distinct filter.
+    """
+
+    def __init__(self, subscriptions):
+        self.hashtag_bits = {}
+        self.keyword_bits = {}
+        groups = {}
+        for dataDiscord in subscriptions:
+            try:
+                spec = parse_filters(dataDiscord.get('filters', []))
+            except ValueError as err:
+                LOG.warning(
+                    'Ignoring filters of @{} in guild {}: {}'.format(
+                        dataDiscord.get('twitter_name'), dataDiscord.get('guild_id'), err
+                    )
+                )
+                spec = parse_filters([])
+
+            required, forbidden, any_of = spec['required'], spec['forbidden'], 0
+            if not dataDiscord.get('includeUserReply'):
+                forbidden |= REPLY
+            if not dataDiscord.get('includeRetweet'):
+                forbidden |= RETWEET
+            for tag in spec['hashtags']:
+                any_of |= self._bit(self.hashtag_bits, tag)
+            for keyword in spec['keywords']:
+                any_of |= self._bit(self.keyword_bits, keyword)
+            for keyword in spec['exclude']:
+                forbidden |= self._bit(self.keyword_bits, keyword)
+            groups.setdefault((required, forbidden, any_of), []).append(dataDiscord)
+        self.groups = list(groups.items())
+
+        patterns = {keyword: keyword_pattern(keyword) for keyword in self.keyword_bits}
+        # A match also hits every keyword inside it, e.g. "black cat" hits "cat"
+        self.contained = {
+            keyword: sum(
+                bit for other, bit in self.keyword_bits.items() if re.search(patterns[other], keyword, re.IGNORECASE)
+            )
+            for keyword in self.keyword_bits
+        }
+        self.keywords_pattern = None
+        if self.keyword_bits:
+            # Zero width lookahead so overlapping keywords are all found, longest first per position
+            alternatives = '|'.join(patterns[x] for x in sorted(self.keyword_bits, key=len, reverse=True))
+            self.keywords_pattern = re.compile('(?=({}))'.format(alternatives), re.IGNORECASE)
+
+    def _bit(self, bits, term):
+        if term not in bits:
+            bits[term] = 1 << (TERM_SHIFT + len(self.hashtag_bits) + len(self.keyword_bits))
+        return bits[term]
+
+    def features(self, data):
+        """Bitmask of one tweet"""
+        features = 0
+        referenced = data.get('referenced_tweets')
+        if referenced:
+            if referenced[0]['type'] == 'replied_to':
+                features |= REPLY
+            elif referenced[0]['type'] == 'retweeted':
+                features |= RETWEET
+        if data.get('attachments', {}).get('media_keys'):
+            features |= MEDIA
+        entities = data.get('entities', {})
+        if entities.get('urls'):
+            features |= LINKS
+
+        if self.hashtag_bits:
+            if 'hashtags' in entities:
+                tags = (x['tag'] for x in entities['hashtags'])
+            else:
+                tags = HASHTAG_PATTERN.findall(data.get('text', ''))
+            for tag in tags:
+                features |= self.hashtag_bits.get(tag.lower(), 0)
+        if self.keywords_pattern:
+            for keyword in set(self.keywords_pattern.findall(data.get('text', ''))):
+                features |= self.contained.get(keyword.lower(), 0)
+        return features
+
+    def match(self, data):
+        """Subscriptions which want this tweet"""
+        features = self.features(data)
+        targets = []
+        for (required, forbidden, any_of), subscriptions in self.groups:
+            if features & required == required and not features & forbidden and (not any_of or features & any_of):
+                targets.extend(subscriptions)
+        return targets
@@ -1,8 +1,20 @@
 import os
 import json
+from threading import Lock
+from contextlib import contextmanager
 from functools import wraps
 from random import randint
 
+try:
+    import fcntl
+except ImportError:
+    # Windows, the lock only keeps threads of this process apart
+    fcntl = None
+
+# filename -> Lock, shared by every JsonIO of the process
+_FILE_LOCKS = {}
+_FILE_LOCKS_LOCK = Lock()
+
 
 class InvalidJsonFile(Exception):
     pass
@@ -22,6 +34,28 @@ class JsonIO(dict):
         """
         return self.save_json(filename, data)
 
+    @contextmanager
+    def lock(self, filename):
+        """
+        Hold filename for a read-modify-write, against other threads and processes
+        locking it too. Plain get and save do not wait for it.
+        @param {String} filename - The filename.
+        """
+        with _FILE_LOCKS_LOCK:
+            thread_lock = _FILE_LOCKS.setdefault(os.path.abspath(filename), Lock())
+        with thread_lock:
+            if fcntl is None:
+                yield
+                return
+            if os.path.dirname(filename):
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename + '.lock', 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
     # pylint: disable=E0213
     # pylint: disable=E1102
     def _save(func):
@@ -0,0 +1,177 @@
+import os
+import json
+import logging
+from threading import Lock
+
+from PIL import ImageDraw
+
+from .render import encode_image
+from .constants import MEME_MIN_FONT_SIZE, MEME_LINE_SPACING, RENDER_ENCODINGS
+
+LOG = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.gif')
+
+
+class TemplateRegistry:
+    """
+    Meme templates found in a directory, an image plus a sidecar spec of the same name:
+        magic_cat.png
+        magic_cat.json  {"size": 48, "color": [0, 0, 0], "boxes": [{"x": 455, "y": 400, "width": 380, "height": 50}]}
+    Spec keys: boxes (x, y, width, height, optional wrap, align), font, size, min_size, color,
+    encoding and max_size (KB). Missing font, encoding and max_size fall back to the config,
+    as do encodings of which no name is in RENDER_ENCODINGS.
+    Only specs are read here, images are decoded by the render workers on first use.
+    The directory is scanned again when its mtime changes.
+    """
+
+    def __init__(self, directory, font_file):
+        self.directory = directory
+        self.font_file = font_file
+        self._specs = {}
+        self._mtime = None
+        self._lock = Lock()
+
+    def _scan(self):
+        try:
+            mtime = os.path.getmtime(self.directory)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        specs = {}
+        for entry in sorted(os.listdir(self.directory)):
+            name, ext = os.path.splitext(entry)
+            if ext.lower() not in IMAGE_EXTENSIONS:
+                continue
+            sidecar = os.path.join(self.directory, name + '.json')
+            if not os.path.isfile(sidecar):
+                continue
+            try:
+                with open(sidecar, encoding='utf-8') as f:
+                    specs[name.lower()] = self._normalize(os.path.join(self.directory, entry), json.load(f))
+            except (OSError, ValueError, KeyError, TypeError) as err:
+                LOG.warning('Skipping meme template {}: {}'.format(sidecar, err))
+        self._specs = specs
+        self._mtime = mtime
+
+    def _normalize(self, image_file, spec):
+        size = int(spec.get('size', 48))
+        boxes = []
+        for box in spec['boxes']:
+            boxes.append({
+                'x': int(box['x']),
+                'y': int(box['y']),
+                'width': int(box['width']),
+                'height': int(box['height']),
+                'wrap': int(box.get('wrap', box['width'])),
+                'align': box.get('align', 'left')
+            })
+        if not boxes:
+            raise ValueError('no text boxes')
+        encodings = [x.lower() for x in spec.get('encoding') or []]
+        for encoding in [x for x in encodings if x not in RENDER_ENCODINGS]:
+            LOG.warning(
+                'Unknown encoding %s of meme template %s, must be one of %s', encoding, image_file,
+                ', '.join(RENDER_ENCODINGS)
+            )
+            encodings.remove(encoding)
+        return {
+            'image': image_file,
+            'font': spec.get('font') or self.font_file,
+            'size': size,
+            'min_size': min(int(spec.get('min_size', MEME_MIN_FONT_SIZE)), size),
+            'color': tuple(spec.get('color', (0, 0, 0))),
+            'boxes': boxes,
+            'encoding': tuple(encodings) or None,
+            'max_size': int(spec['max_size']) * 1024 if spec.get('max_size') else None
+        }
+
+    def names(self):
+        with self._lock:
+            self._scan()
+            return list(self._specs)
+
+    def get(self, name):
+        """Spec of a template, None when there is no such template"""
+        with self._lock:
+            self._scan()
+            return self._specs.get(name.lower())
+
+    def reload(self, font_file=None):
+        with self._lock:
+            if font_file:
+                self.font_file = font_file
+            self._mtime = None
+
+
+def font_sizes(size, min_size):
+    """Sizes tried while fitting, about 10% apart so few fonts get loaded"""
+    sizes = [size]
+    while sizes[-1] > min_size:
+        sizes.append(max(min_size, min(sizes[-1] - 1, int(sizes[-1] * 0.9))))
+    return sizes
+
+
+def wrap_text(templates, font_file, size, text, width):
+    """
+    Greedy wrap by words, words wider than width are broken between characters,
+    which also wraps CJK text that has no spaces.
+    """
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split(' '):
+            candidate = line + ' ' + word if line else word
+            if templates.text_width(font_file, size, candidate) <= width:
+                line = candidate
+                continue
+            if line:
+                lines.append(line)
+            line = ''
+            for char in word:
+                if line and templates.text_width(font_file, size, line + char) > width:
+                    lines.append(line)
+                    line = ''
+                line += char
+        lines.append(line)
+    return lines
+
+
+def fit_text(templates, font_file, box, text, size, min_size):
+    """Largest size whose wrapped lines fit the box, returns (size, lines, line height)"""
+    for size in font_sizes(size, min_size):
+        lines = wrap_text(templates, font_file, size, text, box['wrap'])
+        height = templates.line_height(font_file, size)
+        line_height = int(height * MEME_LINE_SPACING)
+        if (len(lines) - 1) * line_height + height <= box['height']:
+            break
+    return size, lines, line_height
+
+
+def split_meme_text(text, boxes):
+    """',' moves on to the next text box, the last box takes the rest"""
+    return text.split(',', max(boxes - 1, 0))
+
+
+def render_meme(templates, spec, text, encodings, max_bytes):
+    """
+    Draw text into the boxes of a template spec and return the encoded bytes.
+    @param {TemplateCache} templates
+    @param {Dict} spec - from TemplateRegistry.get
+    """
+    image = templates.image(spec['image']).copy()
+    draw = ImageDraw.Draw(image)
+    for box, chunk in zip(spec['boxes'], split_meme_text(text, len(spec['boxes']))):
+        chunk = chunk.strip()
+        if not chunk:
+            continue
+        size, lines, line_height = fit_text(templates, spec['font'], box, chunk, spec['size'], spec['min_size'])
+        font = templates.font(spec['font'], size)
+        for i, line in enumerate(lines):
+            x = box['x']
+            if box['align'] != 'left':
+                free = box['width'] - templates.text_width(spec['font'], size, line)
+                x += int(free / 2 if box['align'] == 'center' else free)
+            draw.text((x, box['y'] + i * line_height), line, font=font, fill=spec['color'])
+    return encode_image(image, spec['encoding'] or encodings, spec['max_size'] or max_bytes)
@@ -0,0 +1,156 @@
+import heapq
+import logging
+from bisect import bisect_left
+from datetime import datetime
+from threading import Lock
+
+from .constants import TWITTER_LATENCY_BUCKETS, TWITTER_SLOWEST_DELIVERIES
+
+LOG = logging.getLogger(__name__)
+
+# Stage name -> (start, end) fields of a DeliveryTrace
+STAGES = (
+    ('skew', ('created_at', 'received')),
+    ('parse', ('received', 'matched')),
+    ('enqueue', ('matched', 'enqueued')),
+    ('wait', ('enqueued', 'send_start')),
+    ('http', ('send_start', 'response')),
+    ('total', ('received', 'response')),
+)
+
+
+def parse_created_at(created_at):
+    """Epoch seconds of a v2 created_at like 2022-01-01T12:00:00.000Z, None when missing"""
+    if not created_at:
+        return None
+    try:
+        return datetime.fromisoformat(created_at.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+
+class Histogram:
+    """
+    Fixed bucket latency histogram in milliseconds, memory does not grow with samples.
+    Percentiles are answered with the upper bound of their bucket, capped at the max.
+    """
+
+    def __init__(self, bounds=TWITTER_LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0.0
+        rank = self.count * pct / 100
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max
+        }
+
+
+class DeliveryTrace:
+    """Wall clock timestamps of one tweet delivered to one webhook"""
+    __slots__ = ('tweet_id', 'webhook_id', 'created_at', 'received', 'matched', 'enqueued', 'send_start', 'response')
+
+    def __init__(self, tweet_id, webhook_id, created_at, received, matched):
+        self.tweet_id = tweet_id
+        self.webhook_id = webhook_id
+        self.created_at = created_at
+        self.received = received
+        self.matched = matched
+        self.enqueued = None
+        self.send_start = None
+        self.response = None
+
+    def breakdown(self):
+        """Milliseconds spent in each stage, stages without both timestamps are left out"""
+        stages = {}
+        for name, (start, end) in STAGES:
+            start, end = getattr(self, start), getattr(self, end)
+            if start is not None and end is not None:
+                stages[name] = (end - start) * 1000
+        return stages
+
+
+class RelayMetrics:
+    """
+    Per stage latency histograms of webhook deliveries, per webhook error counters
+    and the slowest deliveries since they were last logged.
+    """
+
+    def __init__(self, slowest=TWITTER_SLOWEST_DELIVERIES):
+        self.histograms = {name: Histogram() for name, _ in STAGES}
+        self.webhook_errors = {}
+        self.slowest_size = slowest
+        self._slowest = []
+        self._lock = Lock()
+
+    def record(self, trace):
+        """Account a delivered trace"""
+        stages = trace.breakdown()
+        with self._lock:
+            for name, value in stages.items():
+                self.histograms[name].observe(value)
+            if 'total' in stages:
+                entry = (stages['total'], trace.tweet_id, trace.webhook_id, stages)
+                if len(self._slowest) < self.slowest_size:
+                    heapq.heappush(self._slowest, entry)
+                elif entry[0] > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, entry)
+
+    def error(self, webhook_id, status):
+        """Count a failed attempt of webhook_id, status is the HTTP status or the exception"""
+        with self._lock:
+            errors = self.webhook_errors.setdefault(str(webhook_id), {'errors': 0, 'last': None})
+            errors['errors'] += 1
+            errors['last'] = str(status)
+
+    def slowest(self):
+        """Slowest deliveries, slowest first"""
+        with self._lock:
+            return [{
+                'tweet_id': tweet_id,
+                'webhook_id': webhook_id,
+                'stages': stages
+            } for _, tweet_id, webhook_id, stages in sorted(self._slowest, key=lambda x: x[0], reverse=True)]
+
+    def log_slowest(self):
+        """Log the slowest deliveries with their stage breakdown and start a new window"""
+        for entry in self.slowest():
+            stages = ', '.join('{} {:.0f}ms'.format(x, y) for x, y in entry['stages'].items())
+            LOG.info(
+                'Slow delivery of tweet {} to webhook {}: {}'.format(entry['tweet_id'], entry['webhook_id'], stages)
+            )
+        with self._lock:
+            self._slowest = []
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'stages': {name: histogram.stats() for name, histogram in self.histograms.items()},
+                'webhook_errors': {x: dict(y) for x, y in self.webhook_errors.items()}
+            }
+        stats['slowest'] = self.slowest()
+        return stats
@@ -0,0 +1,246 @@
+import re
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+import discord
+
+from .outbound import TokenBucket
+from .purge import parse_time, MENTION_PATTERN
+from .constants import MODERATION_CONCURRENCY, MODERATION_PROGRESS_INTERVAL, MODERATION_RETRIES
+
+LOG = logging.getLogger(__name__)
+
+ROLE_MENTION_PATTERN = re.compile(r'^<@&(\d+)>$')
+
+
+def find_role(guild, value):
+    """Role by mention, id or name (case insensitive), None when there is none"""
+    match = ROLE_MENTION_PATTERN.match(value)
+    if match or value.isdigit():
+        return guild.get_role(int(match.group(1) if match else value))
+    value = value.lower()
+    return discord.utils.find(lambda r: r.name.lower() == value, guild.roles)
+
+
+def select_members(guild, tokens, mentions=(), now=None):
+    """
+    Members a bulk action applies to, from the command's selector tokens:
+        @user                   these members
+        role:name  @role        members with this role
+        joined:30m              joined within the last 30 minutes, also s, h, d, w
+        joined-after:date  joined-before:date
+    Mentioned members are always included, the other selectors narrow down the
+    guild's members together. Raises ValueError for tokens it does not know.
+    @param {discord.Guild} guild
+    @param {List} mentions - mentioned members
+    """
+    now = now or datetime.now(timezone.utc)
+    members = dict((x.id, x) for x in mentions if x is not None)
+    roles = []
+    after = before = None
+    for token in tokens:
+        key, _, value = token.partition(':')
+        key = key.lower()
+        if MENTION_PATTERN.match(token):
+            continue
+        elif ROLE_MENTION_PATTERN.match(token) or (key == 'role' and value):
+            role = find_role(guild, value if key == 'role' else token)
+            if role is None:
+                raise ValueError('No role {}'.format(value or token))
+            roles.append(role)
+        elif key in ('joined', 'joined-after') and value:
+            after = parse_time(value, now)
+        elif key == 'joined-before' and value:
+            before = parse_time(value, now)
+        else:
+            raise ValueError('Unknown selector {}'.format(token))
+
+    if roles or after or before:
+        role_ids = set(x.id for x in roles)
+        for member in guild.members:
+            if role_ids and not role_ids.issubset(x.id for x in member.roles):
+                continue
+            if after and (member.joined_at is None or member.joined_at < after):
+                continue
+            if before and (member.joined_at is None or member.joined_at > before):
+                continue
+            members[member.id] = member
+    return list(members.values())
+
+
+def role_changes(guild, tokens):
+    """+role and -role tokens -> (roles to add, roles to remove), raises ValueError"""
+    add, remove = [], []
+    for token in tokens:
+        if token[:1] not in ('+', '-') or len(token) < 2:
+            raise ValueError('Role changes look like +role or -role, not {}'.format(token))
+        role = find_role(guild, token[1:])
+        if role is None:
+            raise ValueError('No role {}'.format(token[1:]))
+        (add if token[0] == '+' else remove).append(role)
+    return add, remove
+
+
+def retry_after(err):
+    """Seconds a rate limit error asks to wait, None for any other error"""
+    if isinstance(err, discord.RateLimited):
+        return err.retry_after
+    if isinstance(err, discord.HTTPException) and err.status == 429:
+        try:
+            return float(err.response.headers.get('Retry-After', 1))
+        except (AttributeError, ValueError):
+            return 1.0
+    return None
+
+
+class ModerationResult:
+    """Members a bulk action was done for, needed nothing for, or failed for and why"""
+
+    def __init__(self, action, total=0):
+        self.action = action
+        self.total = total
+        self.done = []
+        self.unchanged = []
+        self.failed = []
+        self.started = time.monotonic()
+        self.seconds = 0
+
+    def report(self, limit=20):
+        lines = [
+            '{} {}/{} members in {:.1f}s'.format(
+                self.action, len(self.done), len(self.done) + len(self.failed) + len(self.unchanged), self.seconds
+            )
+        ]
+        if self.unchanged:
+            lines.append('{} already had the roles'.format(len(self.unchanged)))
+        if self.failed:
+            lines.append('{} failed:'.format(len(self.failed)))
+            lines.extend('  {} ({})'.format(member, reason) for member, reason in self.failed[:limit])
+            if len(self.failed) > limit:
+                lines.append('  ... and {} more'.format(len(self.failed) - limit))
+        return '\n'.join(lines)
+
+    def summary(self):
+        return '{} {}/{} members{} in {:.0f}s'.format(
+            self.action, len(self.done), self.total, ', {} failed'.format(len(self.failed)) if self.failed else '',
+            time.monotonic() - self.started
+        )
+
+
+class ModerationExecutor:
+    """
+    Runs one action over many members, at most concurrency requests at a time.
+    discord.py already waits out the X-RateLimit headers and retries 429s, a 429
+    it gives up on pauses the route (kick, ban, roles) of the guild for its
+    retry_after and the member is tried again. Routes in route_rates are also
+    paced by a token bucket of (requests per second, burst).
+    Failures are collected per member, the others go on.
+    progress(result) is awaited at most every MODERATION_PROGRESS_INTERVAL seconds.
+    """
+
+    def __init__(self, concurrency=MODERATION_CONCURRENCY, route_rates=None):
+        self.concurrency = concurrency
+        self.route_rates = route_rates or {}
+        self._buckets = {}
+        # (route, guild id) -> loop time a 429 asked to wait for
+        self._paused = {}
+
+    async def _acquire(self, route, guild_id):
+        # Discord limits these routes per guild
+        loop = asyncio.get_running_loop()
+        while loop.time() < self._paused.get((route, guild_id), 0):
+            await asyncio.sleep(self._paused[(route, guild_id)] - loop.time())
+        rate = self.route_rates.get(route)
+        if rate is None:
+            return
+        bucket = self._buckets.get((route, guild_id))
+        if bucket is None:
+            bucket = self._buckets[(route, guild_id)] = TokenBucket(*rate)
+        while True:
+            delay = bucket.delay()
+            if not delay:
+                bucket.take()
+                return
+            await asyncio.sleep(delay)
+
+    def _pause(self, route, guild_id, seconds):
+        key = (route, guild_id)
+        self._paused[key] = max(self._paused.get(key, 0), asyncio.get_running_loop().time() + seconds)
+
+    async def run(self, action, route, members, call, progress=None):
+        """
+        @param {String} action - name used in the report
+        @param {String} route - key of route_rates
+        @param {Function} call - async member -> False when nothing had to be done
+        @param {Function} progress - async ModerationResult -> None
+        @return {ModerationResult}
+        """
+        result = ModerationResult(action, len(members))
+        semaphore = asyncio.Semaphore(self.concurrency)
+        reported = result.started
+
+        async def attempt(member):
+            for tries in range(1, MODERATION_RETRIES + 1):
+                try:
+                    return await call(member, lambda: self._acquire(route, member.guild.id))
+                except (discord.RateLimited, discord.HTTPException) as err:
+                    seconds = retry_after(err)
+                    if seconds is None or tries == MODERATION_RETRIES:
+                        raise
+                    LOG.warning('{} of {} rate limited, retrying in {:.1f}s'.format(action, member, seconds))
+                    self._pause(route, member.guild.id, seconds)
+
+        async def one(member):
+            nonlocal reported
+            async with semaphore:
+                try:
+                    if await attempt(member) is False:
+                        result.unchanged.append(member)
+                    else:
+                        result.done.append(member)
+                except discord.Forbidden:
+                    result.failed.append((member, 'missing permission or role too high'))
+                except discord.NotFound:
+                    result.failed.append((member, 'left the server'))
+                except discord.RateLimited as err:
+                    result.failed.append((member, 'rate limited for {:.0f}s'.format(err.retry_after)))
+                except discord.HTTPException as err:
+                    result.failed.append((member, err.text or err.status))
+            if progress is not None and time.monotonic() - reported >= MODERATION_PROGRESS_INTERVAL:
+                reported = time.monotonic()
+                await progress(result)
+
+        await asyncio.gather(*(one(x) for x in members))
+        result.seconds = time.monotonic() - result.started
+        return result
+
+    async def kick(self, members, reason=None, progress=None):
+        async def call(member, acquire):
+            await acquire()
+            await member.kick(reason=reason)
+
+        return await self.run('Kicked', 'kick', members, call, progress)
+
+    async def ban(self, members, reason=None, delete_message_seconds=0, progress=None):
+        async def call(member, acquire):
+            await acquire()
+            await member.ban(reason=reason, delete_message_seconds=delete_message_seconds)
+
+        return await self.run('Banned', 'ban', members, call, progress)
+
+    async def edit_roles(self, members, add=(), remove=(), reason=None, progress=None):
+        """All changes of a member in one member.edit call, members needing none are skipped"""
+        remove_ids = set(x.id for x in remove)
+
+        async def call(member, acquire):
+            current = [x for x in member.roles if not x.is_default()]
+            roles = [x for x in current if x.id not in remove_ids]
+            roles += [x for x in add if x.id not in set(r.id for r in roles)]
+            if set(x.id for x in roles) == set(x.id for x in current):
+                return False
+            await acquire()
+            await member.edit(roles=roles, reason=reason)
+
+        return await self.run('Updated roles of', 'roles', members, call, progress)
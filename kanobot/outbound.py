@@ -0,0 +1,166 @@
+import asyncio
+import logging
+from collections import deque
+
+import discord
+
+from .exceptions import MessageDropped
+from .constants import DISCORD_MSG_CHAR_LIMIT, DISCORD_SEND_RATE, DISCORD_SEND_BURST, SEND_QUEUE_DEPTH
+
+LOG = logging.getLogger(__name__)
+
+DROP_POLICIES = ('newest', 'oldest')
+
+
+class TokenBucket:
+    """rate tokens per second up to burst, the bucket starts full"""
+
+    def __init__(self, rate=DISCORD_SEND_RATE, burst=DISCORD_SEND_BURST, clock=None):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock or asyncio.get_running_loop().time
+        self.tokens = burst
+        self.updated = self.clock()
+
+    def delay(self):
+        """Seconds until a token is available"""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Pending:
+    __slots__ = ['dest', 'content', 'tts', 'group', 'futures']
+
+    def __init__(self, dest, content, tts, group, future):
+        self.dest = dest
+        self.content = content
+        self.tts = tts
+        self.group = group
+        self.futures = [future]
+
+
+class _Channel:
+    __slots__ = ['pending', 'bucket', 'worker']
+
+    def __init__(self, bucket):
+        self.pending = deque()
+        self.bucket = bucket
+        self.worker = None
+
+
+class OutboundQueue:
+    """
+    One queue per channel in front of dest.send, drained by a worker which waits on
+    a token bucket per channel instead of running into 429s.
+    Text sent with a coalesce group joins the message queued just before it when both
+    have the same group and the result stays within DISCORD_MSG_CHAR_LIMIT, all callers
+    then get the same Message. When max_depth messages wait in a channel the newest one
+    or the oldest waiting one is dropped, its caller gets MessageDropped.
+    Only touched from the event loop, so it needs no locking.
+    """
+
+    def __init__(self, max_depth=SEND_QUEUE_DEPTH, drop='newest', rate=DISCORD_SEND_RATE, burst=DISCORD_SEND_BURST):
+        self.max_depth = max_depth
+        self.drop = drop
+        self.rate = rate
+        self.burst = burst
+        self._channels = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.delayed = 0
+
+    def send(self, dest, content, *, tts=False, coalesce=None):
+        """
+        Queue a message, returns a future of the sent Message.
+        @param {discord.abc.Messageable} dest
+        @param {String|discord.Embed} content
+        @param {Any} coalesce - group key, text of the same group may be joined, None never joins
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        channel = self._channels.get(dest.id)
+        if channel is None:
+            channel = self._channels[dest.id] = _Channel(TokenBucket(self.rate, self.burst, loop.time))
+
+        if coalesce is not None and channel.pending and isinstance(content, str):
+            last = channel.pending[-1]
+            mergeable = last.group == coalesce and isinstance(last.content, str) and not tts and not last.tts
+            if mergeable and len(last.content) + 1 + len(content) <= DISCORD_MSG_CHAR_LIMIT:
+                last.content += '\n' + content
+                last.futures.append(future)
+                self.coalesced += 1
+                return future
+
+        if len(channel.pending) >= self.max_depth:
+            self.dropped += 1
+            if self.drop == 'newest':
+                future.set_exception(MessageDropped('Send queue of {} is full'.format(dest)))
+                return future
+            dropped = channel.pending.popleft()
+            for waiter in dropped.futures:
+                if not waiter.done():
+                    waiter.set_exception(MessageDropped('Send queue of {} is full'.format(dest)))
+
+        channel.pending.append(_Pending(dest, content, tts, coalesce, future))
+        if channel.worker is None:
+            channel.worker = loop.create_task(self._drain(dest.id, channel))
+        return future
+
+    async def _drain(self, channel_id, channel):
+        try:
+            while channel.pending:
+                delay = channel.bucket.delay()
+                if delay:
+                    self.delayed += 1
+                    await asyncio.sleep(delay)
+                    continue
+                item = channel.pending.popleft()
+                channel.bucket.take()
+                try:
+                    if isinstance(item.content, discord.Embed):
+                        msg = await item.dest.send(embed=item.content)
+                    else:
+                        msg = await item.dest.send(item.content, tts=item.tts)
+                except Exception as err:
+                    for future in item.futures:
+                        if not future.done():
+                            future.set_exception(err)
+                else:
+                    self.sent += 1
+                    for future in item.futures:
+                        if not future.done():
+                            future.set_result(msg)
+        finally:
+            channel.worker = None
+            # The bucket is full again by then, forgetting it earlier would allow an extra burst
+            asyncio.get_running_loop().call_later(self.burst / self.rate, self._forget, channel_id, channel)
+
+    def _forget(self, channel_id, channel):
+        if channel.worker is None and not channel.pending and self._channels.get(channel_id) is channel:
+            del self._channels[channel_id]
+
+    def stats(self):
+        return {
+            'channels': len(self._channels),
+            'waiting': sum(len(x.pending) for x in self._channels.values()),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'delayed': self.delayed
+        }
+
+    def close(self):
+        for channel in self._channels.values():
+            if channel.worker is not None:
+                channel.worker.cancel()
+            for item in channel.pending:
+                for future in item.futures:
+                    if not future.done():
+                        future.cancel()
+        self._channels.clear()
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import logging
+from threading import Lock
+
+from .constants import TWITTER_OUTBOX_MAX_ATTEMPTS, TWITTER_OUTBOX_COMPACT_SIZE
+
+LOG = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Append-only, disk backed log of webhook deliveries.
+    One record per line, tab separated:
+        P <id> <url> <json data>    queued before the first attempt
+        F <id>                      one failed attempt
+        D <id>                      delivered, pruned or dead lettered
+    Records still pending when the bot starts are replayed, records failing
+    max_attempts times are moved to the dead letter file (JSON lines).
+    """
+
+    def __init__(self, filename, dead_letter_file, max_attempts=TWITTER_OUTBOX_MAX_ATTEMPTS):
+        self.filename = filename
+        self.dead_letter_file = dead_letter_file
+        self.max_attempts = max_attempts
+        self._lock = Lock()
+        self._pending = {}
+        self._seq = 0
+        self._load()
+        self._file = open(self.filename, 'a', encoding='utf-8')
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _load(self):
+        """Read the segment back and rewrite it with only the pending records"""
+        if os.path.dirname(self.filename):
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        if os.path.isfile(self.filename):
+            with open(self.filename, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        kind, record_id, *rest = line.rstrip('\n').split('\t', 3)
+                        record_id = int(record_id)
+                        self._seq = max(self._seq, record_id)
+                        if kind == 'P':
+                            self._pending[record_id] = [rest[0], json.loads(rest[1]), 0]
+                        elif kind == 'F' and record_id in self._pending:
+                            self._pending[record_id][2] += 1
+                        elif kind == 'D':
+                            self._pending.pop(record_id, None)
+                    except (ValueError, IndexError):
+                        # Torn write from a crash, nothing after it was acknowledged
+                        LOG.warning("Skipping damaged outbox record: %r", line)
+
+        tmp_file = self.filename + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for record_id, (url, data, attempts) in self._pending.items():
+                f.write(self._format('P', record_id, url, json.dumps(data, ensure_ascii=False)))
+                f.write(self._format('F', record_id) * attempts)
+        os.replace(tmp_file, self.filename)
+
+    @staticmethod
+    def _format(kind, record_id, *fields):
+        return '\t'.join((kind, str(record_id)) + fields) + '\n'
+
+    def _write(self, line):
+        if self._file.closed:
+            # Shutting down, the record stays pending and is replayed next start
+            return
+        self._file.write(line)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def append(self, url, data):
+        """Persist a delivery before it is attempted, returns its record id"""
+        with self._lock:
+            self._seq += 1
+            self._pending[self._seq] = [url, data, 0]
+            self._write(self._format('P', self._seq, url, json.dumps(data, ensure_ascii=False)))
+            return self._seq
+
+    def done(self, record_id):
+        """Mark a record as finished"""
+        with self._lock:
+            if self._pending.pop(record_id, None) is None:
+                return
+            self._write(self._format('D', record_id))
+            if not self._pending and self._file.tell() > TWITTER_OUTBOX_COMPACT_SIZE:
+                self._file.truncate(0)
+
+    def failed(self, record_id, error):
+        """
+        Count a failed attempt.
+        Returns the attempts so far, or None once the record was dead lettered.
+        """
+        with self._lock:
+            record = self._pending.get(record_id)
+            if record is None:
+                return None
+            record[2] += 1
+            if record[2] < self.max_attempts:
+                self._write(self._format('F', record_id))
+                return record[2]
+
+            url, data, attempts = self._pending.pop(record_id)
+            with open(self.dead_letter_file, 'a', encoding='utf-8') as f:
+                letter = {'url': url, 'data': data, 'attempts': attempts, 'error': str(error), 'time': time.time()}
+                f.write(json.dumps(letter) + '\n')
+            self._write(self._format('D', record_id))
+            return None
+
+    def pending(self):
+        """[(record id, url, data)] waiting for delivery, oldest first"""
+        with self._lock:
+            return [(record_id, url, data) for record_id, (url, data, _) in self._pending.items()]
+
+    def dead_letters(self):
+        if not os.path.isfile(self.dead_letter_file):
+            return []
+        with open(self.dead_letter_file, encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def clear_dead_letters(self):
+        if os.path.isfile(self.dead_letter_file):
+            os.remove(self.dead_letter_file)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,210 @@
+import re
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+import discord
+
+from .constants import (
+    DISCORD_BULK_DELETE_LIMIT, DISCORD_BULK_DELETE_MAX_AGE, PURGE_SINGLE_DELETE_INTERVAL, PURGE_PROGRESS_INTERVAL
+)
+
+LOG = logging.getLogger(__name__)
+
+DURATION_PATTERN = re.compile(r'^(\d+)([smhdw])$')
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+MENTION_PATTERN = re.compile(r'^<@!?(\d+)>$')
+
+
+def parse_time(value, now=None):
+    """A duration ago (30m, 2h, 7d) or an ISO date/time, as an aware datetime"""
+    now = now or datetime.now(timezone.utc)
+    match = DURATION_PATTERN.match(value.lower())
+    if match:
+        return now - timedelta(seconds=int(match.group(1)) * DURATION_UNITS[match.group(2)])
+    moment = datetime.fromisoformat(value)
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+class PurgeFilter:
+    """
+    Which messages a purge deletes, from the command's filter tokens:
+        @user / <@id>           by these authors
+        name                    by authors with this name
+        after:30m  before:2h    time window, a duration ago or an ISO date
+        match:regex             content matches
+        has:attachments         with attachments, -has:attachments without
+    Pinned messages are never deleted.
+    """
+
+    __slots__ = ['author_ids', 'labels', 'names', 'after', 'before', 'pattern', 'attachments']
+
+    def __init__(self, tokens=(), authors=()):
+        """
+        @param {List} tokens - filter arguments of the command
+        @param {List} authors - mentioned members
+        """
+        self.author_ids = set(x.id for x in authors if x is not None)
+        self.labels = dict((x.id, str(x)) for x in authors if x is not None)
+        self.names = set()
+        self.after = None
+        self.before = None
+        self.pattern = None
+        self.attachments = None
+        for token in tokens:
+            key, _, value = token.partition(':')
+            key = key.lower()
+            mention = MENTION_PATTERN.match(token)
+            if mention:
+                self.author_ids.add(int(mention.group(1)))
+            elif key in ('after', 'before') and value:
+                try:
+                    setattr(self, key, parse_time(value))
+                except ValueError:
+                    raise ValueError('{} is neither a duration like 30m, 2h, 7d nor a date'.format(value))
+            elif key in ('match', 'regex') and value:
+                try:
+                    self.pattern = re.compile(value, re.IGNORECASE)
+                except re.error as err:
+                    raise ValueError('Invalid regex {}: {}'.format(value, err))
+            elif key in ('has', '-has') and value.lower() in ('attachments', 'attachment', 'files', 'file'):
+                self.attachments = key == 'has'
+            else:
+                self.names.add(token)
+
+    def compile(self, exclude=()):
+        """
+        One predicate over a message with only the checks this filter needs,
+        cheapest first. The time window is left to history().
+        @param {Set} exclude - message ids to keep, e.g. the status message
+        """
+        checks = []
+        exclude = frozenset(exclude)
+        if exclude:
+            checks.append(lambda m: m.id not in exclude)
+        if self.attachments is not None:
+            attachments = self.attachments
+            checks.append(lambda m: bool(m.attachments) is attachments)
+        if self.author_ids and self.names:
+            author_ids, names = frozenset(self.author_ids), frozenset(self.names)
+            checks.append(lambda m: m.author.id in author_ids or m.author.name in names)
+        elif self.author_ids:
+            author_ids = frozenset(self.author_ids)
+            checks.append(lambda m: m.author.id in author_ids)
+        elif self.names:
+            names = frozenset(self.names)
+            checks.append(lambda m: m.author.name in names)
+        if self.pattern is not None:
+            search = self.pattern.search
+            checks.append(lambda m: search(m.content) is not None)
+
+        if not checks:
+            return lambda m: not m.pinned
+        if len(checks) == 1:
+            check, = checks
+            return lambda m: not m.pinned and check(m)
+        return lambda m: not m.pinned and all(check(m) for check in checks)
+
+    def describe(self):
+        parts = []
+        if self.author_ids or self.names:
+            authors = [self.labels.get(x, str(x)) for x in sorted(self.author_ids)] + sorted(self.names)
+            parts.append('by ' + ', '.join(authors))
+        if self.after:
+            parts.append('after {:%Y-%m-%d %H:%M} UTC'.format(self.after))
+        if self.before:
+            parts.append('before {:%Y-%m-%d %H:%M} UTC'.format(self.before))
+        if self.pattern is not None:
+            parts.append('matching `{}`'.format(self.pattern.pattern))
+        if self.attachments is not None:
+            parts.append('with attachments' if self.attachments else 'without attachments')
+        return ', '.join(parts) or 'all'
+
+
+class PurgeJob:
+    """
+    Streams channel history newest first, page by page, and deletes what the
+    predicate matches. Messages younger than 14 days go in bulk deletes of 100,
+    older ones, which come last, one by one every PURGE_SINGLE_DELETE_INTERVAL seconds.
+    progress(job) is awaited at most every PURGE_PROGRESS_INTERVAL seconds.
+    Cancel the task running run() to stop it, what was deleted stays deleted.
+    """
+
+    def __init__(self, channel, predicate, limit, after=None, before=None, progress=None):
+        self.channel = channel
+        self.predicate = predicate
+        self.limit = limit
+        self.after = after
+        self.before = before
+        self.progress = progress
+        self.scanned = 0
+        self.matched = 0
+        self.deleted = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self._reported = self.started
+
+    async def run(self):
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=DISCORD_BULK_DELETE_MAX_AGE - 60)
+        batch = []
+        history = self.channel.history(limit=self.limit, after=self.after, before=self.before, oldest_first=False)
+        async for message in history:
+            self.scanned += 1
+            if self.predicate(message):
+                self.matched += 1
+                if message.created_at > cutoff:
+                    batch.append(message)
+                    if len(batch) >= DISCORD_BULK_DELETE_LIMIT:
+                        await self._bulk(batch)
+                        batch = []
+                else:
+                    if batch:
+                        await self._bulk(batch)
+                        batch = []
+                    await self._single(message)
+            await self._report()
+        if batch:
+            await self._bulk(batch)
+        return self
+
+    async def _bulk(self, messages):
+        if len(messages) == 1:
+            return await self._single(messages[0], pace=False)
+        try:
+            await self.channel.delete_messages(messages)
+            self.deleted += len(messages)
+        except discord.NotFound:
+            # Someone deleted one of them meanwhile, the rest go one by one
+            for message in messages:
+                await self._single(message, pace=False)
+        except discord.Forbidden:
+            raise
+        except discord.HTTPException as err:
+            LOG.warning('Bulk delete of {} messages in {} failed: {}'.format(len(messages), self.channel, err))
+            self.failed += len(messages)
+
+    async def _single(self, message, pace=True):
+        try:
+            await message.delete()
+            self.deleted += 1
+        except discord.NotFound:
+            pass
+        except discord.Forbidden:
+            raise
+        except discord.HTTPException as err:
+            LOG.debug('Cannot delete message {}: {}'.format(message.id, err))
+            self.failed += 1
+        if pace:
+            await asyncio.sleep(PURGE_SINGLE_DELETE_INTERVAL)
+
+    async def _report(self):
+        if self.progress is not None and time.monotonic() - self._reported >= PURGE_PROGRESS_INTERVAL:
+            self._reported = time.monotonic()
+            await self.progress(self)
+
+    def summary(self):
+        return '{} scanned, {} matched, {} deleted{} in {:.0f}s'.format(
+            self.scanned, self.matched, self.deleted, ', {} failed'.format(self.failed) if self.failed else '',
+            time.monotonic() - self.started
+        )
@@ -0,0 +1,317 @@
+import os
+import hmac
+import json
+import time
+import socket
+import logging
+import socketserver
+from threading import Thread, Lock, Event
+
+from tweepy import Client as TwitterClient, StreamingClient
+
+from .twitter import MyStreamingClient, WebhookSender, sync_rules, reconnect_delay, followed_ids
+from .cache import SeenCache, UserCache
+from .outbox import Outbox
+from .metrics import RelayMetrics
+from .jsonIO import JsonIO
+from .constants import (
+    TWITTER_USER_FIELDS, TWITTER_TWEET_FIELDS, TWITTER_EXPANSIONS, TWITTER_IDLE_POLL, TWITTER_WATCH_INTERVAL,
+    TWITTER_STATE_SAVE_INTERVAL, TWITTER_RELAY_TIMEOUT
+)
+
+LOG = logging.getLogger(__name__)
+
+
+class TwitterRelay:
+    """
+    Twitter stream plus webhook delivery.
+    Runs inside the bot, or on its own through relay.py and a RelayServer.
+    """
+
+    def __init__(self, config, users=None):
+        self.config = config
+        self.jsonIO = JsonIO()
+        self.seen = SeenCache()
+        self.users = users if users is not None else UserCache()
+        self.outbox = None
+        self.stream = None
+        self.metrics = RelayMetrics()
+        # Separate client, the stream's own session is busy with the connection
+        self.rules_client = StreamingClient(config.twitter_token, wait_on_rate_limit=True)
+        self.backfill_client = TwitterClient(
+            bearer_token=config.twitter_token, return_type=dict, wait_on_rate_limit=True
+        )
+        self._rules_lock = Lock()
+        self._save_lock = Lock()
+        self._saved_seen = None
+        self._saved_checkpoints = None
+        self._changed = Event()
+        self._closed = Event()
+        self._webhook_mtime = None
+
+    def start(self):
+        """Run the relay in a daemon thread"""
+        Thread(target=self.serve_forever, name='Twitter relay', daemon=True).start()
+
+    def serve_forever(self):
+        Thread(target=self._maintain, name='Twitter relay maintenance', daemon=True).start()
+        self.run()
+
+    def run(self):
+        """Stream forever, reconnecting with backoff"""
+        self.seen.load(self.jsonIO.get(self.config.seen_file).get('entries', []))
+        self._saved_seen = self.seen.changes
+        self.outbox = Outbox(self.config.outbox_file, self.config.dead_letter_file)
+        sender = WebhookSender(self.outbox, on_gone=self.prune_webhook, metrics=self.metrics)
+        Thread(target=sender.replay, args=(self.outbox.pending(), ), daemon=True).start()
+        data = self.jsonIO.get(self.config.webhook_file)
+        self.stream = MyStreamingClient(
+            self.config.twitter_token,
+            dataD=data,
+            seen=self.seen,
+            users=self.users,
+            checkpoints=self.jsonIO.get(self.config.checkpoint_file),
+            backfill_client=self.backfill_client,
+            backfill_max_age=self.config.twitter_backfill_max_age,
+            sender=sender,
+            on_connected=self._connected
+        )
+        self._saved_checkpoints = self.stream.dump_checkpoints()
+        while not self._closed.is_set():
+            self._changed.clear()
+            self._webhook_mtime = self._get_webhook_mtime()
+            data = self.jsonIO.get(self.config.webhook_file)
+            self.stream.reset(data)
+
+            if not data.get('twitter_ids', []):
+                # Woken by update() or the webhook file watcher
+                self._changed.wait(TWITTER_IDLE_POLL)
+                continue
+
+            try:
+                self._sync_rules(data.get('twitter_ids'))
+                self.stream.filter(
+                    expansions=TWITTER_EXPANSIONS, user_fields=TWITTER_USER_FIELDS, tweet_fields=TWITTER_TWEET_FIELDS
+                )
+            except Exception as err:
+                LOG.debug(f"Twitter stream raise Exception {err}")
+                self.stream.record_error(err)
+                self.stream.disconnect()
+
+            delay = reconnect_delay(self.stream.failures)
+            if delay:
+                LOG.info(f"Twitter stream reconnect in {delay:.1f} seconds")
+                time.sleep(delay)
+
+    def _maintain(self):
+        """Pick up webhook file edits made elsewhere and save state periodically"""
+        last_save = time.time()
+        while not self._closed.wait(TWITTER_WATCH_INTERVAL):
+            if not self.stream:
+                continue
+            try:
+                if self._get_webhook_mtime() != self._webhook_mtime:
+                    LOG.info("Webhook file changed, reloading twitter subscriptions")
+                    self.update()
+                if time.time() - last_save > TWITTER_STATE_SAVE_INTERVAL:
+                    last_save = time.time()
+                    self.save_state()
+                    self.metrics.log_slowest()
+            except Exception as err:
+                LOG.warning(f"Twitter relay maintenance failed {err}")
+
+    def _get_webhook_mtime(self):
+        try:
+            return os.path.getmtime(self.config.webhook_file)
+        except OSError:
+            return None
+
+    def _sync_rules(self, twitter_ids):
+        with self._rules_lock:
+            self.stream.rule_shards = sync_rules(self.rules_client, twitter_ids, self.config.twitter_rule_max_length)
+
+    def save_state(self):
+        """Write the seen cache and checkpoints, each only when it changed since the last save"""
+        if not self.stream:
+            return
+        with self._save_lock:
+            changes = self.seen.changes
+            if changes != self._saved_seen:
+                self.jsonIO.save(self.config.seen_file, {'entries': self.seen.dump()})
+                self._saved_seen = changes
+            checkpoints = self.stream.dump_checkpoints()
+            if checkpoints != self._saved_checkpoints:
+                self.jsonIO.save(self.config.checkpoint_file, checkpoints)
+                self._saved_checkpoints = checkpoints
+
+    def update(self):
+        """
+        Apply the webhook file to the running stream without reconnecting.
+        Otherwise run() reads it before connecting, or _connected applies it
+        when it came after that read.
+        """
+        self._webhook_mtime = self._get_webhook_mtime()
+        self._changed.set()
+        if not self.stream or not self.stream.running:
+            return
+        self._apply()
+
+    def _connected(self):
+        """Called by the stream once connected, catches updates made while it was connecting"""
+        if self._changed.is_set():
+            self._changed.clear()
+            LOG.info("Twitter subscriptions changed while connecting, applying them")
+            self._apply()
+
+    def _apply(self):
+        data = self.jsonIO.get(self.config.webhook_file)
+        self.stream.reset(data)
+        if not data.get('twitter_ids', []):
+            # Nothing left to follow, run() waits for the next change instead of streaming
+            self.stream.disconnect()
+            return
+        try:
+            self._sync_rules(data.get('twitter_ids'))
+        except Exception as err:
+            LOG.warning(f"Twitter stream rules sync failed {err}")
+
+    def reconnect(self):
+        if self.stream:
+            self.stream.disconnect()
+
+    def prune_webhook(self, url):
+        """
+        Called from delivery threads when Discord answers 404 for a webhook.
+        Holds the webhook file lock, the bot edits the same file for !twitter.
+        """
+        with self.jsonIO.lock(self.config.webhook_file):
+            data = self.jsonIO.get(self.config.webhook_file)
+            gone = [dataD for dataD in data.get('Discord', []) if dataD['webhook_url'] == url]
+            if not gone:
+                return
+            for dataD in gone:
+                data['Discord'].remove(dataD)
+                LOG.info(
+                    "Removed twitter subscription @{} of deleted webhook in guild {}".format(
+                        dataD['twitter_name'], dataD['guild_id']
+                    )
+                )
+            # An account stays followed while other subscriptions use it
+            data['twitter_ids'] = followed_ids(data)
+            self.jsonIO.save(self.config.webhook_file, data)
+        self.update()
+
+    def stats(self):
+        return {
+            'stream': self.stream.stats() if self.stream else None,
+            'seen': self.seen.stats(),
+            'users': self.users.stats(),
+            'outbox': len(self.outbox) if self.outbox is not None else 0,
+            'latency': self.metrics.stats()
+        }
+
+    def dead_letters(self):
+        return self.outbox.dead_letters() if self.outbox is not None else []
+
+    def clear_dead_letters(self):
+        if self.outbox is not None:
+            self.outbox.clear_dead_letters()
+
+    def close(self):
+        """Stop streaming and flush everything to disk"""
+        self._closed.set()
+        self._changed.set()
+        if self.stream:
+            self.stream.disconnect()
+            self.stream.batcher.flush_all()
+            self.save_state()
+        if self.outbox is not None:
+            self.outbox.close()
+
+
+class RelayServer(socketserver.ThreadingTCPServer):
+    """
+    Local control socket of a standalone relay, one JSON request per line:
+        {"cmd": "update" | "reconnect" | "stats" | "dead_letters" | "clear_dead_letters", "token": ...}
+    answered by one JSON line {"result": ...} or {"error": ...}.
+    With a token, requests without the same token are refused.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    commands = ('update', 'reconnect', 'stats', 'dead_letters', 'clear_dead_letters')
+
+    def __init__(self, relay, address, token=None):
+        self.relay = relay
+        self.token = token
+        super().__init__(address, RelayRequestHandler)
+
+    def authorized(self, request):
+        if not self.token:
+            return True
+        token = request.get('token')
+        return isinstance(token, str) and hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8'))
+
+
+class RelayRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not self.server.authorized(request):
+                    LOG.warning('Relay control request from {} with a wrong token'.format(self.client_address[0]))
+                    self.wfile.write(json.dumps({'error': 'Unauthorized'}).encode('utf-8') + b'\n')
+                    return
+                cmd = request['cmd']
+                if cmd not in self.server.commands:
+                    raise ValueError('Unknown command {}'.format(cmd))
+                response = {'result': getattr(self.server.relay, cmd)()}
+            except Exception as err:
+                response = {'error': str(err)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class RelayClient:
+    """
+    Talks to a standalone relay with the same methods as TwitterRelay.
+    The relay being down only costs a warning, it re-reads the webhook file on start.
+    """
+
+    def __init__(self, address, token=None, timeout=TWITTER_RELAY_TIMEOUT):
+        self.address = address
+        self.token = token
+        self.timeout = timeout
+
+    def start(self):
+        pass
+
+    def _request(self, cmd, default=None):
+        try:
+            with socket.create_connection(self.address, timeout=self.timeout) as conn:
+                conn.sendall(json.dumps({'cmd': cmd, 'token': self.token}).encode('utf-8') + b'\n')
+                response = json.loads(conn.makefile('rb').readline())
+        except (OSError, ValueError) as err:
+            LOG.warning("Twitter relay at {}:{} unreachable: {}".format(*self.address, err))
+            return default
+        if 'error' in response:
+            LOG.warning("Twitter relay {} failed: {}".format(cmd, response['error']))
+            return default
+        return response['result']
+
+    def update(self):
+        self._request('update')
+
+    def reconnect(self):
+        self._request('reconnect')
+
+    def stats(self):
+        return self._request('stats', {})
+
+    def dead_letters(self):
+        return self._request('dead_letters', [])
+
+    def clear_dead_letters(self):
+        self._request('clear_dead_letters')
+
+    def close(self):
+        pass
@@ -0,0 +1,336 @@
+import io
+import os
+import json
+import time
+import hashlib
+import asyncio
+import logging
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+from PIL import Image, ImageDraw, ImageFont
+
+from .exceptions import RenderBusy
+from .metrics import Histogram
+from .constants import (
+    MAGIC_FONT_SIZE, MAGIC_TEXT_POSITIONS, MAGIC_TEXT_COLOR, RENDER_WORKERS, RENDER_QUEUE_SIZE, RENDER_ENCODINGS,
+    RENDER_DEFAULT_ENCODINGS, RENDER_TEMPLATE_CACHE_BYTES
+)
+
+LOG = logging.getLogger(__name__)
+
+
+class TemplateCache:
+    """
+    Decoded template images and loaded fonts, kept after their first use.
+    Images are evicted least recently used once they take more than max_bytes decoded.
+    Renders draw on a copy, the cached images stay pristine.
+    Glyph advances and line heights are cached per font and size for text fitting.
+    """
+
+    def __init__(self, max_bytes=RENDER_TEMPLATE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._images = OrderedDict()
+        self._fonts = {}
+        self._advances = {}
+        self._lock = Lock()
+
+    def image(self, filename):
+        with self._lock:
+            image = self._images.get(filename)
+            if image is not None:
+                self._images.move_to_end(filename)
+                return image
+            image = Image.open(filename)
+            image.load()
+            self._images[filename] = image
+            self.bytes += self._size(image)
+            while self.bytes > self.max_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self.bytes -= self._size(evicted)
+            LOG.debug('Loaded template image {}'.format(filename))
+            return image
+
+    @staticmethod
+    def _size(image):
+        return image.width * image.height * len(image.getbands())
+
+    def font(self, filename, size):
+        with self._lock:
+            font = self._fonts.get((filename, size))
+            if font is None:
+                font = self._fonts[(filename, size)] = ImageFont.truetype(filename, size)
+                LOG.debug('Loaded font {} size {}'.format(filename, size))
+            return font
+
+    def text_width(self, filename, size, text):
+        """Width of text from cached glyph advances, kerning is ignored"""
+        font = self.font(filename, size)
+        advances = self._advances.setdefault((filename, size), {})
+        width = 0
+        for char in text:
+            advance = advances.get(char)
+            if advance is None:
+                advance = advances[char] = font.getlength(char)
+            width += advance
+        return width
+
+    def line_height(self, filename, size):
+        ascent, descent = self.font(filename, size).getmetrics()
+        return ascent + descent
+
+    def reload(self):
+        """Forget everything, the next render loads the files again"""
+        with self._lock:
+            self._images.clear()
+            self._fonts.clear()
+            self._advances.clear()
+            self.bytes = 0
+
+
+def file_identity(filename):
+    """Path, size and mtime, a changed file gives new render keys"""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return [filename]
+    return [filename, stat.st_size, stat.st_mtime_ns]
+
+
+def render_key(image_file, font_file, lines, fmt, *extra):
+    """
+    Content key of a render, a hash of everything the output depends on.
+    @param {List} lines - text lines as drawn
+    @param {String} fmt - output format, e.g. PNG
+    """
+    material = [file_identity(image_file), file_identity(font_file), list(lines), fmt, *extra]
+    return hashlib.sha256(json.dumps(material, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def encode_image(image, encodings=RENDER_DEFAULT_ENCODINGS, max_bytes=0):
+    """
+    Encode with the first of encodings whose output fits in max_bytes, so list them fastest first.
+    Every call starts from the first, the output size depends on the content as much as on the
+    image size. Returns the smallest output when none fits.
+    @param {List} encodings - names of RENDER_ENCODINGS
+    @param {Int} max_bytes - target size, 0 takes the first encoding
+    """
+    smallest = None
+    for name in encodings:
+        options = dict(RENDER_ENCODINGS[name])
+        output = io.BytesIO()
+        if options['format'] == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(output, **options)
+        data = output.getvalue()
+        if not max_bytes or len(data) <= max_bytes:
+            return data
+        if smallest is None or len(data) < len(smallest):
+            smallest = data
+    return smallest
+
+
+def image_extension(data):
+    """File extension for encoded image bytes"""
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[:2] == b'\xff\xd8':
+        return 'jpg'
+    return 'png'
+
+
+def split_magic_text(text):
+    """Input can use ',' to new line, the template has room for two"""
+    if ',' in text:
+        return text.split(',', 1)
+    return [text, '']
+
+
+def render_magic(templates, image_file, font_file, text, encodings=RENDER_DEFAULT_ENCODINGS, max_bytes=0):
+    """
+    Draw text on the magic cat template and return the encoded bytes.
+    @param {TemplateCache} templates
+    @param {String} text - caption, ',' starts the second line
+    """
+    image = templates.image(image_file).copy()
+    font = templates.font(font_file, MAGIC_FONT_SIZE)
+    draw = ImageDraw.Draw(image)
+    for position, line in zip(MAGIC_TEXT_POSITIONS, split_magic_text(text)):
+        draw.text(position, line, font=font, fill=MAGIC_TEXT_COLOR)
+    return encode_image(image, encodings, max_bytes)
+
+
+# TemplateCache of a render worker process
+_worker_templates = None
+
+
+def _init_worker(preload):
+    global _worker_templates
+    _worker_templates = TemplateCache()
+    for image_file, font_file, size in preload:
+        try:
+            _worker_templates.image(image_file)
+            _worker_templates.font(font_file, size)
+        except OSError as err:
+            LOG.warning('Preloading {} and {} failed {}'.format(image_file, font_file, err))
+
+
+def _run_render(func, args):
+    """Worker side, returns the rendered bytes and the seconds spent"""
+    start = time.perf_counter()
+    data = func(_worker_templates, *args)
+    return data, time.perf_counter() - start
+
+
+class RenderService:
+    """
+    Renders images in a process pool, off the event loop.
+    Requests wait in one queue per guild and are handed to the workers round robin,
+    so a single guild spamming cannot starve the others. When max_queue requests
+    wait already, render raises RenderBusy right away.
+    Renders with a key are answered from the RenderCache when possible, identical
+    renders in flight are shared.
+    A worker dying breaks the pool, its renders fail and a new pool takes the next ones.
+    Only touched from the event loop, so it needs no locking.
+    """
+
+    def __init__(self, preload=(), workers=RENDER_WORKERS, max_queue=RENDER_QUEUE_SIZE, cache=None):
+        self.preload = list(preload)
+        self.workers = workers
+        self.max_queue = max_queue
+        self.cache = cache
+        self.pool = self._start_pool()
+        self._inflight = {}
+        self._queues = OrderedDict()
+        self._waiting = 0
+        self._running = 0
+        self.done = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_time = Histogram()
+        self.render_time = Histogram()
+
+    def _start_pool(self):
+        # spawn, forking the bot would copy its threads' locks in whatever state they are
+        return ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(self.preload, )
+        )
+
+    async def render(self, guild_id, func, *args, key=None):
+        """
+        Run func(templates, *args) in a worker and return its bytes.
+        @param {Int} guild_id - fairness key, None for direct messages
+        @param {Function} func - module level function, it is pickled to the worker
+        @param {String} key - render_key of the output, enables the cache
+        """
+        loop = asyncio.get_running_loop()
+        if key is not None and self.cache is not None:
+            data = self.cache.get(key)
+            if data is None and self.cache.disk_dir:
+                data = await loop.run_in_executor(None, self.cache.load, key)
+            if data is not None:
+                return data
+            self.cache.miss()
+            if key in self._inflight:
+                return await asyncio.shield(self._inflight[key])
+
+        if self._waiting >= self.max_queue:
+            self.rejected += 1
+            raise RenderBusy('Too many images are being drawn right now, try again in a moment', expire_in=10)
+
+        future = loop.create_future()
+        self._queues.setdefault(guild_id, deque()).append((func, args, future, time.perf_counter()))
+        self._waiting += 1
+        if key is not None and self.cache is not None:
+            self._inflight[key] = future
+        self._dispatch()
+        try:
+            data = await asyncio.shield(future)
+        finally:
+            self._inflight.pop(key, None)
+
+        if key is not None and self.cache is not None:
+            if self.cache.disk_dir:
+                await loop.run_in_executor(None, self.cache.put, key, data)
+            else:
+                self.cache.put(key, data)
+        return data
+
+    def _dispatch(self):
+        while self._running < self.workers and self._queues:
+            guild_id, queue = next(iter(self._queues.items()))
+            func, args, future, queued_at = queue.popleft()
+            if queue:
+                # Round robin, this guild goes behind the others
+                self._queues.move_to_end(guild_id)
+            else:
+                del self._queues[guild_id]
+            self._waiting -= 1
+            if future.cancelled():
+                continue
+
+            self.wait_time.observe((time.perf_counter() - queued_at) * 1000)
+            pool = self.pool
+            try:
+                job = pool.submit(_run_render, func, args)
+            except BrokenProcessPool:
+                # Broken before a render of it noticed
+                self._replace_pool(pool)
+                pool = self.pool
+                job = pool.submit(_run_render, func, args)
+            self._running += 1
+            job = asyncio.wrap_future(job)
+            job.add_done_callback(lambda job, future=future, pool=pool: self._finished(job, future, pool))
+
+    def _finished(self, job, future, pool):
+        self._running -= 1
+        try:
+            data, seconds = job.result()
+        except Exception as err:
+            self.failed += 1
+            if isinstance(err, BrokenProcessPool):
+                self._replace_pool(pool)
+            if not future.done():
+                future.set_exception(err)
+        else:
+            self.done += 1
+            self.render_time.observe(seconds * 1000)
+            if not future.done():
+                future.set_result(data)
+        self._dispatch()
+
+    def _replace_pool(self, pool):
+        """Reload once per broken pool, each of its running renders fails with it"""
+        if pool is self.pool:
+            LOG.warning('A render worker died, starting new workers')
+            self.reload()
+
+    def reload(self, preload=None):
+        """Start fresh workers, e.g. after the template files changed"""
+        if preload is not None:
+            self.preload = list(preload)
+        old, self.pool = self.pool, self._start_pool()
+        old.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'waiting': self._waiting,
+            'running': self._running,
+            'done': self.done,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'wait': self.wait_time.stats(),
+            'render': self.render_time.stats(),
+            'cache': self.cache.stats() if self.cache is not None else None
+        }
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -1,24 +1,40 @@
 # from https://github.com/NNTin/discord-twitter-bot
+import re
 import time
 import json
+import random
 import requests
 import logging
 
 from time import gmtime, strftime
-from threading import Thread
+from datetime import datetime, timedelta, timezone
+from threading import Thread, Timer, Lock
+from concurrent.futures import ThreadPoolExecutor
 
-from tweepy import StreamingClient
+from tweepy import StreamingClient, StreamRule, TweepyException
+
+from .metrics import DeliveryTrace, parse_created_at
+from .filters import TweetMatcher
+from .constants import (
+    DISCORD_MSG_CHAR_LIMIT, DISCORD_WEBHOOK_BATCH_LIMIT, TWITTER_RULE_MAX_LENGTH, TWITTER_RULE_TAG_PREFIX,
+    TWITTER_BACKFILL_MAX_PAGES, TWITTER_USER_FIELDS, TWITTER_TWEET_FIELDS, TWITTER_EXPANSIONS, TWITTER_RECONNECT_BASE,
+    TWITTER_RECONNECT_CAP, TWITTER_OUTBOX_REPLAY_WORKERS
+)
 
 LOG = logging.getLogger(__name__)
 
+# A quote outside a JSON string always opens or closes one, so this only matches author_id keys
+AUTHOR_ID_PATTERN = re.compile(rb'"author_id"\s*:\s*"(\d+)"')
+
 
 def webhook_post(url, data):
     """
     Send the JSON formated object to the url.
+    Rate limits are waited out and retried, returns the final HTTP status code.
     """
     result = requests.post(url, data=data)
     if 200 <= result.status_code <= 299 or result.text == "ok":
-        return True
+        return 200
     else:
         try:
             jsonResult = json.loads(result.text)
@@ -27,74 +43,515 @@ def webhook_post(url, data):
                 wait = int(jsonResult['retry_after'])
                 wait = wait / 1000 + 0.1
                 time.sleep(wait)
-                webhook_post(url, data)
+                return webhook_post(url, data)
             else:
                 LOG.warning('{}\n{}\n{}\n'.format(str(result.text), type(result.text), result.text))
         except Exception:
             LOG.warning('Unhandled Error! Look into this {}\n{}\n{}\n'.format(str(result.text), type(result.text), result.text))
+        return result.status_code
+
+
+def reconnect_delay(failures, base=TWITTER_RECONNECT_BASE, cap=TWITTER_RECONNECT_CAP):
+    """Capped exponential backoff with jitter, 0 when the last connection was fine"""
+    if not failures:
+        return 0
+    delay = min(cap, base * 2**(failures - 1))
+    return random.uniform(delay / 2, delay)
+
+
+def pack_rule_values(twitter_ids, max_length=TWITTER_RULE_MAX_LENGTH):
+    """
+    OR 'from:<id>' terms together, starting a new rule whenever
+    the next term would push the value over max_length.
+    """
+    values = []
+    terms = []
+    length = 0
+    for twitter_id in twitter_ids:
+        term = 'from:{}'.format(twitter_id)
+        if terms and length + len(term) + 4 > max_length:
+            values.append(' OR '.join(terms))
+            terms = []
+            length = 0
+        length += len(term) + (4 if terms else 0)
+        terms.append(term)
+    if terms:
+        values.append(' OR '.join(terms))
+    return values
+
+
+def rule_ids(value):
+    """Twitter ids referenced by a rule value"""
+    return re.findall(r'from:(\d+)', value)
+
+
+def plan_rule_sync(rules, twitter_ids, max_length=TWITTER_RULE_MAX_LENGTH):
+    """
+    Diff active stream rules against the followed twitter ids.
+    Our rules which only cover followed ids are kept untouched, any other
+    rule is deleted and the ids it still needs are packed into new shards.
+    While that leaves more shards than packing every id would, the smallest
+    kept shards are merged into the new ones, so adding ids one at a time
+    does not use up the rule cap.
+    Returns (rules to add, rule ids to delete, {tag: [twitter ids]}).
+    """
+    wanted = set(twitter_ids)
+    covered = set()
+    shards = {}
+    kept = {}
+    to_delete = []
+    for rule in rules:
+        ids = rule_ids(rule.value)
+        if rule.tag and rule.tag.startswith(TWITTER_RULE_TAG_PREFIX) and ids and len(rule.value) <= max_length \
+                and wanted.issuperset(ids) and covered.isdisjoint(ids) and rule.tag not in shards:
+            covered.update(ids)
+            shards[rule.tag] = ids
+            kept[rule.tag] = rule.id
+        else:
+            to_delete.append(rule.id)
+
+    twitter_ids = list(dict.fromkeys(twitter_ids))
+    least = len(pack_rule_values(twitter_ids, max_length))
+    while True:
+        values = pack_rule_values([x for x in twitter_ids if x not in covered], max_length)
+        if len(shards) + len(values) <= least or not shards:
+            break
+        tag = min(shards, key=lambda x: (len(shards[x]), x))
+        covered.difference_update(shards.pop(tag))
+        to_delete.append(kept.pop(tag))
+
+    to_add = []
+    index = 0
+    for value in values:
+        while '{}{}'.format(TWITTER_RULE_TAG_PREFIX, index) in shards:
+            index += 1
+        tag = '{}{}'.format(TWITTER_RULE_TAG_PREFIX, index)
+        shards[tag] = rule_ids(value)
+        to_add.append(StreamRule(value=value, tag=tag))
+    return to_add, to_delete, shards
+
+
+def sync_rules(client, twitter_ids, max_length=TWITTER_RULE_MAX_LENGTH):
+    """
+    Bring the stream rules of client in line with twitter_ids.
+    New shards are added before stale ones are deleted so the followed
+    accounts keep matching during the sync, unless the rule cap of the
+    access level leaves no room for both.
+    """
+    response = client.get_rules()
+    to_add, to_delete, shards = plan_rule_sync(response.data or [], [str(x) for x in twitter_ids], max_length)
+    if to_add and not add_rules(client, to_add) and to_delete:
+        client.delete_rules(to_delete)
+        to_delete = []
+        add_rules(client, to_add)
+    if to_delete:
+        client.delete_rules(to_delete)
+    LOG.debug(
+        'Twitter stream rules synced, {} added, {} deleted, {} active'.format(len(to_add), len(to_delete), len(shards))
+    )
+    return shards
+
+
+def add_rules(client, rules):
+    """True when every rule was added"""
+    try:
+        response = client.add_rules(rules)
+    except TweepyException as err:
+        LOG.warning('Add twitter stream rules failed: {}'.format(err))
+        return False
+    for error in response.errors:
+        LOG.warning('Add twitter stream rule failed: {}'.format(error))
+    return not response.errors
+
+
+def followed_ids(data):
+    """twitter_ids of a webhook file, every id its subscriptions use, once"""
+    return list(dict.fromkeys(dataD['twitter_id'] for dataD in data.get('Discord', [])))
+
+
+def snowflake_time(tweet_id):
+    """Creation time encoded in a tweet id"""
+    return datetime.fromtimestamp(((int(tweet_id) >> 22) + 1288834974657) / 1000, timezone.utc)
+
+
+def fetch_backfill(
+    client, checkpoints, max_age, max_length=TWITTER_RULE_MAX_LENGTH, max_pages=TWITTER_BACKFILL_MAX_PAGES
+):
+    """
+    Collect tweets newer than each account's checkpoint using recent search.
+    Accounts are batched into 'from:' queries like the stream rules, client
+    should be created with return_type=dict and wait_on_rate_limit=True so
+    paging is paced by the API rate limit.
+    Tweets whose authors are missing from includes, e.g. suspended or withheld,
+    are skipped, a failed query drops only its own accounts.
+    Returns [(tweet data, includes)] oldest first, in the stream payload shape.
+    @param {Client} client
+    @param {Dict} checkpoints - twitter id: newest seen tweet id
+    @param {Int} max_age - seconds, older tweets are skipped
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=max_age)
+    tweets = []
+    for query in pack_rule_values(list(checkpoints), max_length):
+        ids = rule_ids(query)
+        since_id = min((checkpoints[x] for x in ids), key=int)
+        # since_id wins over start_time, only use it inside the max age
+        window = {'since_id': since_id} if snowflake_time(since_id) > cutoff else {'start_time': cutoff}
+        found = []
+        next_token = None
+        try:
+            for _ in range(max_pages):
+                response = client.search_recent_tweets(
+                    query,
+                    max_results=100,
+                    next_token=next_token,
+                    expansions=TWITTER_EXPANSIONS,
+                    user_fields=TWITTER_USER_FIELDS,
+                    tweet_fields=TWITTER_TWEET_FIELDS,
+                    **window
+                )
+                includes = response.get('includes', {})
+                users = {user['id']: user for user in includes.get('users', [])}
+                referenced_tweets = {tweet['id']: tweet for tweet in includes.get('tweets', [])}
+                for data in response.get('data', []):
+                    if int(data['id']) <= int(checkpoints.get(data['author_id'], 0)):
+                        continue
+                    tweet_users = [users.get(data['author_id'])]
+                    originals = []
+                    for referenced in data.get('referenced_tweets', []):
+                        if referenced['type'] == 'retweeted':
+                            originals.append(referenced_tweets.get(referenced['id'], {'id': referenced['id']}))
+                            tweet_users.append(users.get(originals[-1].get('author_id')))
+                    if None in tweet_users:
+                        LOG.warning('Twitter backfill skips tweet {}, its author is not included'.format(data['id']))
+                        continue
+                    found.append((data, {'users': tweet_users, 'tweets': originals}))
+
+                next_token = response.get('meta', {}).get('next_token')
+                if not next_token:
+                    break
+        except Exception as err:
+            # Its checkpoints stay, the next backfill tries these accounts again
+            LOG.warning('Twitter backfill of {} failed {}'.format(query, err))
+            continue
+        tweets.extend(found)
+    tweets.sort(key=lambda tweet: int(tweet[0]['id']))
+    return tweets
+
+
+def combine_posts(posts):
+    """
+    Merge webhook payloads of one webhook into as few messages as Discord previews.
+    Payloads are joined line by line, up to DISCORD_WEBHOOK_BATCH_LIMIT links and
+    DISCORD_MSG_CHAR_LIMIT chars. A message joining several authors, e.g. a burst of
+    retweets, drops username and avatar and goes out as the webhook itself, the link
+    previews still show each author.
+    @param {List} posts - [(outbox record ids, data, delivery traces)]
+    """
+    combined = []
+    for record_ids, post, traces in posts:
+        last = combined[-1][1] if combined else None
+        if last and last['content'].count('\n') + 1 < DISCORD_WEBHOOK_BATCH_LIMIT \
+                and len(last['content']) + len(post['content']) + 1 <= DISCORD_MSG_CHAR_LIMIT:
+            last['content'] += '\n' + post['content']
+            if (last.get('username'), last.get('avatar_url')) != (post.get('username'), post.get('avatar_url')):
+                last.pop('username', None)
+                last.pop('avatar_url', None)
+            combined[-1][0].extend(record_ids)
+            combined[-1][2].extend(traces)
+        else:
+            combined.append((list(record_ids), dict(post), list(traces)))
+    return combined
+
+
+class WebhookSender:
+    """
+    Deliver webhook posts through the outbox.
+    Failed posts are retried with backoff until the outbox dead letters them,
+    webhooks answering 404 are reported to on_gone.
+    Delivery traces are timed and handed to metrics once delivered.
+    """
+
+    def __init__(self, outbox=None, on_gone=None, post=webhook_post, metrics=None):
+        self.outbox = outbox
+        self.on_gone = on_gone
+        self.post = post
+        self.metrics = metrics
+
+    def queue(self, url, data, traces=()):
+        """Persist data before it is sent, returns the record ids for attempt"""
+        record_ids = [self.outbox.append(url, data)] if self.outbox is not None else []
+        enqueued = time.time()
+        for trace in traces:
+            trace.enqueued = enqueued
+        return record_ids
+
+    def send(self, url, data, traces=()):
+        return self.attempt(self.queue(url, data, traces), url, data, traces)
+
+    def attempt(self, record_ids, url, data, traces=()):
+        error = None
+        send_start = time.time()
+        try:
+            status = self.post(url, data)
+        except requests.RequestException as err:
+            status = None
+            error = err
+
+        if status and 200 <= status <= 299:
+            for record_id in record_ids:
+                self.outbox.done(record_id)
+            if self.metrics is not None:
+                response = time.time()
+                for trace in traces:
+                    trace.send_start = send_start
+                    trace.response = response
+                    self.metrics.record(trace)
+            return True
+
+        if self.metrics is not None:
+            self.metrics.error(url.split('/')[-2], error or status)
+
+        if status == 404:
+            LOG.warning('Webhook {} is gone, dropping its subscriptions'.format(url.split('/')[-2]))
+            for record_id in record_ids:
+                self.outbox.done(record_id)
+            if self.on_gone:
+                self.on_gone(url)
+            return False
+
+        error = error or 'HTTP {}'.format(status)
+        attempts = [self.outbox.failed(record_id, error) for record_id in record_ids]
+        if not attempts:
+            return False
+        if None in attempts:
+            LOG.warning(
+                'Webhook {} delivery failed {} times, moved to dead letters'.format(
+                    url.split('/')[-2], self.outbox.max_attempts
+                )
+            )
+            return False
+
+        timer = Timer(reconnect_delay(max(attempts)), self.attempt, args=(record_ids, url, data, traces))
+        timer.daemon = True
+        timer.start()
+        return False
+
+    def replay(self, pending, workers=TWITTER_OUTBOX_REPLAY_WORKERS):
+        """Retry outbox records left over from the last run"""
+        if pending:
+            LOG.info('Replaying {} undelivered webhook posts'.format(len(pending)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for record_id, url, data in pending:
+                pool.submit(self.attempt, [record_id], url, data)
+
+
+class WebhookBatcher:
+    """Hold tweet links per webhook for a short window and send them together."""
+
+    def __init__(self, sender):
+        self.sender = sender
+        self._lock = Lock()
+        self._pending = {}
+
+    def add(self, url, data, window, trace=None):
+        """Queue data for url, the first item of a batch starts its flush timer."""
+        traces = [trace] if trace else []
+        item = (self.sender.queue(url, data, traces), data, traces)
+        with self._lock:
+            pending = self._pending.get(url)
+            if pending is not None:
+                pending.append(item)
+                return
+            self._pending[url] = [item]
+        timer = Timer(window, self.flush, args=(url, ))
+        timer.daemon = True
+        timer.start()
+
+    def flush(self, url):
+        with self._lock:
+            posts = self._pending.pop(url, [])
+        for record_ids, data, traces in combine_posts(posts):
+            self.sender.attempt(record_ids, url, data, traces)
+
+    def flush_all(self):
+        with self._lock:
+            urls = list(self._pending.keys())
+        for url in urls:
+            self.flush(url)
 
 
 class MyStreamingClient(StreamingClient):
 
-    def __init__(self, bearer_token, dataD):
+    def __init__(
+        self, bearer_token, dataD, seen=None, users=None, checkpoints=None, backfill_client=None, backfill_max_age=0,
+        sender=None, on_connected=None
+    ):
         super().__init__(bearer_token, wait_on_rate_limit=True)
-        self.dataD = dataD
+        self.sender = sender or WebhookSender()
+        self.on_connected = on_connected
+        self.metrics = self.sender.metrics
+        self.batcher = WebhookBatcher(self.sender)
+        self.seen = seen
+        self.users = users
+        self.rule_shards = {}
+        self.checkpoints = checkpoints if checkpoints is not None else {}
+        self.backfill_client = backfill_client
+        self.backfill_max_age = backfill_max_age
+        self._checkpoint_lock = Lock()
+        self._backfill_lock = Lock()
+        self.connects = 0
+        self.errors = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_error = None
+        self.last_error_at = None
+        self.reset(dataD)
 
     def reset(self, dataD):
+        """Swap in new subscriptions, takes effect from the next tweet without reconnecting"""
+        subscriptions = {}
+        for dataDiscord in dataD.get('Discord', []):
+            subscriptions.setdefault(dataDiscord['twitter_id'], []).append(dataDiscord)
         self.dataD = dataD
+        self.subscriptions = subscriptions
+        self.matchers = {twitter_id: TweetMatcher(x) for twitter_id, x in subscriptions.items()}
+        self.subscribed = frozenset(twitter_id.encode('utf-8') for twitter_id in subscriptions)
+
+    def skip(self, rawdata):
+        """
+        True when rawdata can be dropped without decoding it, i.e. it names authors
+        and none of them is subscribed. Anything else goes through the full parse.
+        """
+        author_ids = AUTHOR_ID_PATTERN.findall(rawdata)
+        return bool(author_ids) and self.subscribed.isdisjoint(author_ids)
 
     def on_data(self, rawdata):
         """Called when a new status arrives"""
+        received = time.time()
+        if self.skip(rawdata):
+            self.skipped += 1
+            return
         rawdata = json.loads(rawdata.decode('utf-8'))
-        data = rawdata['data']
+        if 'data' not in rawdata:
+            LOG.warning('Twitter stream message without data {}'.format(rawdata.get('errors', rawdata)))
+            return
+        includes = rawdata.get('includes', {})
+        if self.users is not None:
+            for user in includes.get('users', []):
+                self.users.put(user)
+        return self.process(rawdata['data'], includes, received)
 
+    def process(self, data, includes, received=None):
+        """
+        Deliver one tweet to its subscriptions, shared by the stream and backfill.
+        Users are looked up by id in includes, whose users are de-duplicated and unordered.
+        Tweets with a received time are traced when metrics are enabled.
+        """
         # Skip not authored by
-        if data['author_id'] not in self.dataD['twitter_ids']:
+        matcher = self.matchers.get(data['author_id'])
+        if not matcher:
             return
 
-        users = rawdata['includes']['users']
-        user = users[0]
-        name = user['name']
-        profile_image_url = user['profile_image_url']
+        trace = self.metrics is not None and received is not None
+        created_at = parse_created_at(data.get('created_at')) if trace else None
+        self.checkpoint(data['author_id'], data['id'])
+        users = {user['id']: user for user in includes.get('users', [])}
+        user = users.get(data['author_id'])
+        if user is None:
+            LOG.warning('Tweet {} came without its author {}'.format(data['id'], data['author_id']))
+            return
         username = user['username']
-        userid = user['id']
         twitterid = data['id']
 
-        LOG.info(strftime("[%Y-%m-%d %H:%M:%S]", gmtime()) + " " + name + "(" + username + ")" + ' twittered.')
+        LOG.info(strftime("[%Y-%m-%d %H:%M:%S]", gmtime()) + " " + user['name'] + "(" + username + ")" + ' twittered.')
 
-        for dataDiscord in self.dataD.get('Discord', []):
-            if userid != dataDiscord['twitter_id']:
-                continue
+        # This Tweet is a Retweet, link the original
+        # type == 'quoted' Tweet is a Retweet with reply
+        if 'referenced_tweets' in data and data['referenced_tweets'][0]['type'] == 'retweeted':
+            twitterid = data['referenced_tweets'][0]['id']
+            original = next((x for x in includes.get('tweets', []) if x['id'] == twitterid), {})
+            user = users.get(original.get('author_id'))
+            if user is None:
+                LOG.warning('Retweet {} came without the author of {}'.format(data['id'], twitterid))
+                return
+            username = user['username']
+        name = user['name']
+        profile_image_url = user['profile_image_url']
+
+        url = "https://twitter.com/" + \
+            username + \
+            "/status/" + twitterid
 
-            worthPosting = True
-            # your followed Twitter users tweeting to random Twitter users
-            # (relevant if you only want status updates/opt out of conversations)
-
-            if 'referenced_tweets' in data:
-                # This Tweet is a reply
-                if data['referenced_tweets'][0]['type'] == 'replied_to':
-                    if not dataDiscord['includeUserReply']:
-                        worthPosting = False
-                # This Tweet is a Retweet
-                if data['referenced_tweets'][0]['type'] == 'retweeted':
-                    username = users[1]['username']
-                    name = users[1]['name']
-                    profile_image_url = users[1]['profile_image_url']
-                    twitterid = data['referenced_tweets'][0]['id']
-                    if not dataDiscord['includeRetweet']:
-                        worthPosting = False  # retweet
-                # type == 'quoted' Tweet is a Retweet with reply
-
-            if not worthPosting:
+        # Replies, retweets and content filters of every subscriber in one pass
+        for dataDiscord in matcher.match(data):
+            # Same tweet again after a reconnect, or as original and retweet
+            if self.seen is not None and self.seen.seen(dataDiscord['webhook_id'], twitterid):
                 continue
 
-            wh_url = dataDiscord['webhook_url']
-            url = "https://twitter.com/" + \
-                username + \
-                "/status/" + twitterid
-            Thread(target=webhook_post, args=(wh_url, {'username': name, 'avatar_url': profile_image_url, 'content': url})).start()
+            self.deliver(
+                dataDiscord, {'username': name, 'avatar_url': profile_image_url, 'content': url},
+                DeliveryTrace(twitterid, dataDiscord['webhook_id'], created_at, received, time.time())
+                if trace else None
+            )
         return True
 
+    def checkpoint(self, twitter_id, tweet_id):
+        """Remember the newest tweet id seen from twitter_id"""
+        with self._checkpoint_lock:
+            if int(tweet_id) > int(self.checkpoints.get(twitter_id, 0)):
+                self.checkpoints[twitter_id] = tweet_id
+
+    def record_error(self, error):
+        """Count a failure, consecutive ones grow the reconnect backoff until the next connect"""
+        self.errors += 1
+        self.failures += 1
+        self.last_error = str(error)
+        self.last_error_at = time.time()
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'connects': self.connects,
+            'reconnects': max(self.connects - 1, 0),
+            'errors': self.errors,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'last_error': self.last_error,
+            'last_error_at': self.last_error_at
+        }
+
+    def dump_checkpoints(self):
+        with self._checkpoint_lock:
+            return dict(self.checkpoints)
+
+    def backfill(self):
+        """Deliver tweets posted while the stream was down, oldest first"""
+        if not self._backfill_lock.acquire(blocking=False):
+            return
+        try:
+            with self._checkpoint_lock:
+                checkpoints = {x: y for x, y in self.checkpoints.items() if x in self.subscriptions}
+            if not checkpoints:
+                return
+            tweets = fetch_backfill(self.backfill_client, checkpoints, self.backfill_max_age)
+            found = ' Twitter backfill found {} missed tweets'.format(len(tweets))
+            LOG.info(strftime("[%Y-%m-%d %H:%M:%S]", gmtime()) + found)
+            for data, includes in tweets:
+                self.process(data, includes)
+        except Exception as err:
+            LOG.warning('Twitter backfill failed {}'.format(err))
+        finally:
+            self._backfill_lock.release()
+
+    def deliver(self, dataDiscord, data, trace=None):
+        """Post now, or batch when the subscription has a batchWindow"""
+        wh_url = dataDiscord['webhook_url']
+        window = dataDiscord.get('batchWindow', 0)
+        if window:
+            self.batcher.add(wh_url, data, window, trace)
+        else:
+            Thread(target=self.sender.send, args=(wh_url, data, [trace] if trace else [])).start()
+
     def on_connect(self):
         """Called once connected to streaming server.
 
@@ -103,19 +560,35 @@ class MyStreamingClient(StreamingClient):
         to perform some work prior to entering the read loop.
         """
         LOG.info(strftime("[%Y-%m-%d %H:%M:%S]", gmtime()) + ' Twitter stream successful connected')
+        self.connects += 1
+        self.failures = 0
+        if self.on_connected:
+            self.on_connected()
+        if self.backfill_client and self.backfill_max_age:
+            Thread(target=self.backfill, daemon=True).start()
         return
 
-    def on_error(self, status_code):
+    def on_request_error(self, status_code):
         """Called when a non-200 status code is returned"""
         LOG.warning(strftime("[%Y-%m-%d %H:%M:%S]", gmtime()) + f' Twitter stream on error({status_code}) retry in few second.')
+        self.record_error(f'HTTP {status_code}')
+        return
+
+    def on_connection_error(self):
+        """Called when the stream connection errors or times out"""
+        LOG.warning(
+            strftime("[%Y-%m-%d %H:%M:%S]", gmtime()) + ' Twitter stream connection error, retry in few second.'
+        )
+        self.record_error('Connection error')
         return
 
-    def keep_alive(self):
+    def on_keep_alive(self):
         """Called when a keep-alive arrived"""
         LOG.debug(strftime("[%Y-%m-%d %H:%M:%S]", gmtime()) + ' Twitter stream keep-alive')
         return
 
     def on_exception(self, exception):
         """Called when an unhandled exception occurs."""
-        LOG.debug(strftime("[%Y-%m-%d %H:%M:%S]", gmtime()) + exception)
+        LOG.debug(strftime("[%Y-%m-%d %H:%M:%S]", gmtime()) + f' Twitter stream exception {exception!r}')
+        self.record_error(repr(exception))
         return
@@ -0,0 +1,90 @@
+import logging
+import os
+import signal
+import sys
+import time
+from threading import Thread
+
+from kanobot import exceptions
+
+LOG = logging.getLogger('relay')
+
+
+def setup_logging():
+    """Log to stdout and logs/relay.log"""
+    if not os.path.isdir('logs'):
+        os.mkdir('logs')
+
+    for name in ('relay', 'kanobot'):
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.DEBUG)
+
+        sh = logging.StreamHandler(stream=sys.stdout)
+        sh.setFormatter(logging.Formatter(fmt="[%(levelname)s] %(name)s: %(message)s"))
+        sh.setLevel(logging.INFO)
+        logger.addHandler(sh)
+
+        fh = logging.FileHandler("logs/relay.log", mode='a', encoding='utf-8')
+        fh.setFormatter(logging.Formatter(fmt="[%(asctime)s] %(name)s-%(levelname)s: %(message)s"))
+        fh.setLevel(logging.DEBUG)
+        logger.addHandler(fh)
+
+
+def terminate(signum, frame):
+    raise exceptions.TerminateSignal()
+
+
+def main():
+    """
+    Run only the twitter relay, for TwitterRelayMode = external.
+    The bot reaches it on TwitterRelayAddress, either side can restart alone.
+    """
+    setup_logging()
+    signal.signal(signal.SIGTERM, terminate)
+    max_wait_time = 60
+    loops = 0
+
+    while 1:
+        relay = server = None
+        try:
+            from kanobot.config import Config, ConfigDefaults
+            from kanobot.relay import TwitterRelay, RelayServer
+
+            config = Config(ConfigDefaults.config_file)
+            # The control socket is opened here whatever TwitterRelayMode says
+            config.check_relay_token()
+            if not config.twitter_token:
+                LOG.critical("TwitterBearerToken is not set, nothing to relay.")
+                break
+
+            relay = TwitterRelay(config)
+            server = RelayServer(relay, config.twitter_relay_address, config.twitter_relay_token)
+            Thread(target=server.serve_forever, name='Relay control', daemon=True).start()
+            LOG.info("Twitter relay listening on {}:{}".format(*config.twitter_relay_address))
+            relay.serve_forever()
+
+        except exceptions.HelpfulError as e:
+            LOG.info(e.message)
+            break
+        except (exceptions.TerminateSignal, KeyboardInterrupt):
+            break
+        except Exception:
+            LOG.exception("Error running twitter relay")
+
+        finally:
+            if server:
+                server.shutdown()
+                server.server_close()
+            if relay:
+                relay.close()
+            loops += 1
+
+        sleeptime = min(loops * 2, max_wait_time)
+        LOG.info("Restarting in {} seconds...".format(sleeptime))
+        time.sleep(sleeptime)
+    print()
+    LOG.info("All done.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import time
+from types import SimpleNamespace
+
+from kanobot.bot import Kanobot
+from kanobot.cache import RenderCache, ResponseCache, SeenCache, UserCache
+from kanobot.constants import DISCORD_MSG_CHAR_LIMIT
+from kanobot.metrics import RelayMetrics, Histogram
+from kanobot.outbound import OutboundQueue
+
+
+def busy_relay_stats():
+    """Every section of a relay with failing webhooks and slow deliveries"""
+    latency = RelayMetrics().stats()
+    error = 'HTTP 429 ' + 'You are being rate limited. ' * 3
+    latency['webhook_errors'] = {str(10**18 + x): {'errors': 1000 + x, 'last': error} for x in range(8)}
+    latency['slowest'] = [{
+        'tweet_id': str(10**18 + x),
+        'webhook_id': str(10**18 + x),
+        'stages': {name: 12345.0 for name in latency['stages']}
+    } for x in range(5)]
+    stream = {
+        'running': False, 'connects': 120, 'reconnects': 119, 'errors': 300, 'failures': 4, 'skipped': 10**6,
+        'last_error': 'ConnectionError(' + 'Max retries exceeded with url: /2/tweets/search/stream ' * 3 + ')',
+        'last_error_at': time.time() - 30
+    }
+    return {'seen': SeenCache().stats(), 'stream': stream, 'latency': latency}
+
+
+def test_stats_of_a_busy_relay_fit_in_messages():
+    responses = ResponseCache()
+    for command in ('twitter show', 'show_reply', 'help', 'listroles'):
+        responses.get((command, 1))
+    renders = {
+        'workers': 4, 'waiting': 0, 'running': 0, 'done': 0, 'failed': 0, 'rejected': 0,
+        'wait': Histogram().stats(), 'render': Histogram().stats(), 'cache': RenderCache().stats()
+    }
+    bot = SimpleNamespace(
+        renderer=SimpleNamespace(stats=lambda: renders),
+        outbound=OutboundQueue(),
+        response_cache=responses,
+        deletions=SimpleNamespace(
+            stats=lambda: {'pending': 10, 'deleted': 10, 'bulk_calls': 1, 'single_calls': 1, 'failed': 0}
+        ),
+        twitter_users=UserCache()
+    )
+    pages = Kanobot._stats_pages(bot, busy_relay_stats())
+    assert len(pages) > 1
+    assert all(len('```\n{}\n```'.format(page)) <= DISCORD_MSG_CHAR_LIMIT for page in pages)
+    text = '\n'.join(pages)
+    assert 'slow tweet' in text and 'Twitter users' in text
@@ -0,0 +1,29 @@
+import pytest
+
+from kanobot.config import Config, ConfigDefaults
+from kanobot.exceptions import HelpfulError
+
+MINIMAL = '[Credentials]\nToken = abc\n[Permissions]\nOwnerID = 123456789012345678\n[Chat]\n[Bot]\n'
+
+
+def load(tmp_path, bot=''):
+    config_file = tmp_path / 'config.ini'
+    config_file.write_text(MINIMAL + bot)
+    return Config(str(config_file))
+
+
+def test_minimal_config_uses_the_defaults(tmp_path):
+    config = load(tmp_path)
+    assert config.template_dir == ConfigDefaults.template_dir
+    assert config.deletions_file == ConfigDefaults.deletions_file
+
+
+def test_relay_token_is_needed_once_the_relay_is_external(tmp_path):
+    # In-process relays open no socket, a LAN address for a later split is fine
+    config = load(tmp_path, 'TwitterRelayAddress = 192.168.1.2:8765\n')
+    with pytest.raises(HelpfulError):
+        config.check_relay_token()
+    with pytest.raises(HelpfulError):
+        load(tmp_path, 'TwitterRelayAddress = 192.168.1.2:8765\nTwitterRelayMode = external\n')
+    load(tmp_path, 'TwitterRelayAddress = 192.168.1.2:8765\nTwitterRelayMode = external\nTwitterRelayToken = s3cret\n')
+    load(tmp_path, 'TwitterRelayMode = external\n').check_relay_token()
@@ -0,0 +1,87 @@
+import re
+import random
+
+import pytest
+
+from kanobot.filters import LINKS, MEDIA, REPLY, RETWEET, TweetMatcher, keyword_pattern, parse_filters
+
+
+@pytest.mark.parametrize('token', ['-', 'has:gifs', '-#art', '#', '#not a tag'])
+def test_invalid_filters_raise(token):
+    with pytest.raises(ValueError):
+        parse_filters(['has:media', token])
+
+
+def test_filters_are_case_folded():
+    spec = parse_filters(['HAS:Media', '-Has:Links', '#Art', 'Cat', '-SPOILER'])
+    assert spec == {
+        'required': MEDIA, 'forbidden': LINKS, 'hashtags': {'art'}, 'keywords': {'cat'}, 'exclude': {'spoiler'}
+    }
+
+
+def subscription(webhook_id, *filters, reply=True, retweet=True):
+    return {
+        'webhook_id': webhook_id, 'filters': list(filters), 'includeUserReply': reply, 'includeRetweet': retweet
+    }
+
+
+def tweet(text='', media=False, links=False, reference=None, hashtags=None):
+    data = {'id': '1', 'text': text}
+    if media:
+        data['attachments'] = {'media_keys': ['3_1']}
+    if links:
+        data['entities'] = {'urls': [{'url': 'https://t.co/x'}]}
+    if hashtags is not None:
+        data.setdefault('entities', {})['hashtags'] = [{'tag': x} for x in hashtags]
+    if reference:
+        data['referenced_tweets'] = [{'type': reference, 'id': '2'}]
+    return data
+
+
+def matched(matcher, data):
+    return sorted(x['webhook_id'] for x in matcher.match(data))
+
+
+def test_include_and_exclude_masks():
+    matcher = TweetMatcher([
+        subscription(1),
+        subscription(2, 'has:media'),
+        subscription(3, '-has:links', '-spoiler'),
+        subscription(4, reply=False, retweet=False),
+        subscription(5, '#Art', 'cat'),
+    ])
+    assert matched(matcher, tweet('hello')) == [1, 3, 4]
+    assert matched(matcher, tweet('hello', media=True, links=True)) == [1, 2, 4]
+    assert matched(matcher, tweet('Spoiler: a CAT #art')) == [1, 4, 5]
+    assert matched(matcher, tweet('no tags', hashtags=['ART'])) == [1, 3, 4, 5]
+    assert matched(matcher, tweet('a cat', reference='replied_to')) == [1, 3, 5]
+    assert matched(matcher, tweet('a cat', reference='retweeted')) == [1, 3, 5]
+    assert matcher.features(tweet('x', reference='replied_to')) & REPLY
+    assert matcher.features(tweet('x', reference='retweeted')) & RETWEET
+
+
+def test_keywords_match_whole_words():
+    matcher = TweetMatcher([subscription(1, 'cat'), subscription(2, '-rt'), subscription(3, '猫')])
+    assert matched(matcher, tweet('concatenate the start')) == [2]
+    assert matched(matcher, tweet('Cat!')) == [1, 2]
+    assert matched(matcher, tweet('RT @someone: cat')) == [1]
+    # CJK text has no spaces between words
+    assert matched(matcher, tweet('子猫かわいい')) == [2, 3]
+    # The longest keyword at a position wins the combined regex, the shorter one still hits
+    matcher = TweetMatcher([subscription(1, 'art'), subscription(2, 'art!')])
+    assert matched(matcher, tweet('pop art!')) == [1, 2]
+
+
+WORDS = ['cat', 'cats', 'black cat', 'c++', 'rt', 'art', 'art!', 'a.b', '猫', '子猫', 'ねこ', 'café', 'x']
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_combined_keywords_agree_with_a_check_per_keyword(seed):
+    rnd = random.Random(seed)
+    keywords = rnd.sample(WORDS, rnd.randint(len(WORDS) // 2, len(WORDS)))
+    matcher = TweetMatcher([subscription(x, x) for x in keywords])
+    pieces = WORDS + ['con', 'start', 'Black', 'CAT', ' ', ' ', ', ', '!', 'ab', '++']
+    for _ in range(300):
+        text = ''.join(rnd.choice(pieces) for _ in range(rnd.randint(0, 8)))
+        naive = sorted(x for x in keywords if re.search(keyword_pattern(x), text, re.IGNORECASE))
+        assert matched(matcher, tweet(text)) == naive, text
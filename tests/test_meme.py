@@ -0,0 +1,24 @@
+import json
+
+import pytest
+
+from kanobot.meme import TemplateRegistry
+
+
+@pytest.mark.parametrize(
+    'encoding, expected', [
+        (['WEBP', 'png'], ('webp', 'png')),
+        (['bogus', 'png'], ('png', )),
+        (['bogus'], None),
+        (None, None),
+    ]
+)
+def test_sidecar_encodings_are_validated(tmp_path, encoding, expected):
+    (tmp_path / 'cat.png').write_bytes(b'')
+    spec = {'boxes': [{'x': 0, 'y': 0, 'width': 10, 'height': 10}]}
+    if encoding is not None:
+        spec['encoding'] = encoding
+    (tmp_path / 'cat.json').write_text(json.dumps(spec))
+    registry = TemplateRegistry(str(tmp_path), 'font.ttf')
+    # None falls back to the config encodings when rendering
+    assert registry.get('cat')['encoding'] == expected
@@ -0,0 +1,55 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+import discord
+
+from kanobot import moderation
+from kanobot.config import parse_moderation_rates
+from kanobot.moderation import ModerationExecutor
+
+
+class FakeMember:
+
+    def __init__(self, member_id, limited=0):
+        self.id = member_id
+        self.guild = SimpleNamespace(id=1)
+        self.limited = limited
+        self.kicked_at = None
+
+    async def kick(self, reason=None):
+        if self.limited:
+            self.limited -= 1
+            response = SimpleNamespace(status=429, reason='Too Many Requests', headers={'Retry-After': '0.2'})
+            raise discord.HTTPException(response, {'message': 'You are being rate limited.', 'code': 0})
+        self.kicked_at = time.monotonic()
+
+    def __str__(self):
+        return 'member{}'.format(self.id)
+
+
+def test_rate_limited_members_are_retried_after_retry_after(monkeypatch):
+    monkeypatch.setattr(moderation, 'MODERATION_PROGRESS_INTERVAL', 0)
+    members = [FakeMember(0, limited=1), FakeMember(1), FakeMember(2, limited=10)]
+    reports = []
+
+    async def progress(result):
+        reports.append(result.summary())
+
+    async def run():
+        return await ModerationExecutor(concurrency=1).kick(members, progress=progress)
+
+    start = time.monotonic()
+    result = asyncio.run(run())
+    assert [x.id for x in result.done] == [0, 1]
+    assert [(x.id, reason) for x, reason in result.failed] == [(2, 'You are being rate limited.')]
+    # The 429 of member0 paused the route for the other members as well
+    assert members[1].kicked_at - start >= 0.2
+    assert reports[0] == 'Kicked 1/3 members in 0s'
+    assert reports[-1].startswith('Kicked 2/3 members, 1 failed')
+
+
+def test_moderation_rates():
+    assert parse_moderation_rates('') == {}
+    assert parse_moderation_rates('kick:1/5, Roles:2') == {'kick': (1.0, 5), 'roles': (2.0, 1)}
+    assert parse_moderation_rates('mute:1/5 ban:x ban:0 kick:1/0 ban:0.5/2') == {'ban': (0.5, 2)}
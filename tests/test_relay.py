@@ -0,0 +1,168 @@
+import time
+from threading import Thread
+from types import SimpleNamespace
+
+from kanobot.config import is_loopback
+from kanobot.jsonIO import JsonIO
+from kanobot.relay import RelayClient, RelayServer, TwitterRelay
+from kanobot.twitter import MyStreamingClient
+
+
+def subscription(guild_id, twitter_id, webhook_id):
+    return {
+        'guild_id': guild_id,
+        'channel_id': webhook_id,
+        'webhook_url': 'https://discord.com/api/webhooks/{}/token'.format(webhook_id),
+        'webhook_id': webhook_id,
+        'twitter_id': twitter_id,
+        'twitter_name': 'user{}'.format(twitter_id)
+    }
+
+
+def relay_with(tmp_path, subscriptions, twitter_ids):
+    filename = str(tmp_path / 'webhook.json')
+    JsonIO().save(filename, {'Discord': subscriptions, 'twitter_ids': twitter_ids, 'Category_ids': {}})
+    return TwitterRelay(SimpleNamespace(twitter_token='token', webhook_file=filename)), filename
+
+
+def test_prune_keeps_ids_other_subscriptions_use(tmp_path):
+    subscriptions = [subscription(1, '10', 100), subscription(2, '10', 200), subscription(2, '20', 201)]
+    relay, filename = relay_with(tmp_path, subscriptions, ['10', '10', '20'])
+    relay.prune_webhook(subscriptions[0]['webhook_url'])
+    data = JsonIO().get(filename)
+    assert data['Discord'] == subscriptions[1:]
+    assert data['twitter_ids'] == ['10', '20']
+    relay.prune_webhook(subscriptions[1]['webhook_url'])
+    assert JsonIO().get(filename)['twitter_ids'] == ['20']
+
+
+def test_prune_of_an_id_already_gone(tmp_path):
+    subscriptions = [subscription(1, '10', 100)]
+    relay, filename = relay_with(tmp_path, subscriptions, [])
+    relay.prune_webhook(subscriptions[0]['webhook_url'])
+    assert JsonIO().get(filename) == {'Discord': [], 'twitter_ids': [], 'Category_ids': {}}
+
+
+def test_prune_waits_for_a_concurrent_edit(tmp_path):
+    subscriptions = [subscription(1, '10', 100)]
+    relay, filename = relay_with(tmp_path, subscriptions, ['10'])
+    jsonIO = JsonIO()
+    with jsonIO.lock(filename):
+        data = jsonIO.get(filename)
+        pruning = Thread(target=relay.prune_webhook, args=(subscriptions[0]['webhook_url'], ))
+        pruning.start()
+        time.sleep(0.1)
+        # A !twitter + saving while the delivery thread finds its webhook gone
+        data['Discord'].append(subscription(1, '20', 101))
+        data['twitter_ids'].append('20')
+        jsonIO.save(filename, data)
+    pruning.join()
+    data = jsonIO.get(filename)
+    assert [x['webhook_id'] for x in data['Discord']] == [101]
+    assert data['twitter_ids'] == ['20']
+
+
+def test_update_while_connecting_is_applied(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'webhook.json')
+    jsonIO = JsonIO()
+    jsonIO.save(filename, {'Discord': [subscription(1, '10', 100)], 'twitter_ids': ['10'], 'Category_ids': {}})
+    config = SimpleNamespace(
+        twitter_token='token',
+        webhook_file=filename,
+        seen_file=str(tmp_path / 'seen.json'),
+        checkpoint_file=str(tmp_path / 'checkpoint.json'),
+        outbox_file=str(tmp_path / 'outbox.log'),
+        dead_letter_file=str(tmp_path / 'dead_letter.jsonl'),
+        twitter_backfill_max_age=0
+    )
+    relay = TwitterRelay(config)
+    synced = []
+    monkeypatch.setattr(relay, '_sync_rules', lambda twitter_ids: synced.append(list(twitter_ids)))
+    connects = []
+
+    def fake_filter(stream, **kwargs):
+        # Like tweepy, running is set when connecting starts, the update lands just before
+        if not connects:
+            data = jsonIO.get(filename)
+            data['Discord'].append(subscription(1, '20', 101))
+            data['twitter_ids'].append('20')
+            jsonIO.save(filename, data)
+            relay.update()
+        connects.append(sorted(stream.subscriptions))
+        stream.running = True
+        stream.on_connect()
+        while stream.running:
+            time.sleep(0.01)
+
+    monkeypatch.setattr(MyStreamingClient, 'filter', fake_filter)
+    Thread(target=relay.run, daemon=True).start()
+    deadline = time.time() + 5
+    while synced[-1:] != [['10', '20']] and time.time() < deadline:
+        time.sleep(0.01)
+    assert connects == [['10']]
+    assert sorted(relay.stream.subscriptions) == ['10', '20']
+    assert synced == [['10'], ['10', '20']]
+
+    # Following nobody closes the connection instead of streaming on no rules
+    jsonIO.save(filename, {'Discord': [], 'twitter_ids': [], 'Category_ids': {}})
+    relay.update()
+    while relay.stream.running and time.time() < deadline:
+        time.sleep(0.01)
+    assert not relay.stream.running
+    relay.close()
+    assert connects == [['10']]
+
+
+def test_state_is_saved_only_when_changed(tmp_path, monkeypatch):
+    config = SimpleNamespace(
+        twitter_token='token', seen_file=str(tmp_path / 'seen.json'), checkpoint_file=str(tmp_path / 'checkpoint.json')
+    )
+    relay = TwitterRelay(config)
+    checkpoints = {'10': '100'}
+    relay.stream = SimpleNamespace(dump_checkpoints=lambda: dict(checkpoints))
+    saved = []
+    monkeypatch.setattr(relay.jsonIO, 'save', lambda filename, data: saved.append(filename))
+    relay.save_state()
+    relay.save_state()
+    assert saved == [config.seen_file, config.checkpoint_file]
+    relay.seen.seen(100, 1)
+    relay.seen.seen(100, 1)
+    relay.save_state()
+    checkpoints['10'] = '101'
+    relay.save_state()
+    relay.save_state()
+    assert saved[2:] == [config.seen_file, config.checkpoint_file]
+
+
+class FakeRelay:
+
+    def __init__(self):
+        self.cleared = False
+
+    def dead_letters(self):
+        return [{'url': 'https://discord.com/api/webhooks/1/secret'}]
+
+    def clear_dead_letters(self):
+        self.cleared = True
+
+
+def test_control_requests_need_the_token():
+    relay = FakeRelay()
+    server = RelayServer(relay, ('127.0.0.1', 0), token='s3cret')
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        address = server.server_address
+        assert RelayClient(address).dead_letters() == []
+        RelayClient(address, token='wrong').clear_dead_letters()
+        assert not relay.cleared
+        assert RelayClient(address, token='s3cret').dead_letters() == relay.dead_letters()
+        RelayClient(address, token='s3cret').clear_dead_letters()
+        assert relay.cleared
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_is_loopback():
+    assert is_loopback('127.0.0.1') and is_loopback('localhost') and is_loopback('[::1]')
+    assert not is_loopback('0.0.0.0') and not is_loopback('192.168.1.2') and not is_loopback('relay.example')
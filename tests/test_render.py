@@ -0,0 +1,44 @@
+import os
+import random
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from PIL import Image
+
+from kanobot.render import RenderService, encode_image, image_extension
+
+
+def echo(templates, data):
+    return data
+
+
+def crash(templates):
+    os._exit(1)
+
+
+def test_dead_worker_is_replaced():
+
+    async def run():
+        renderer = RenderService(workers=1)
+        try:
+            broken = renderer.pool
+            with pytest.raises(BrokenProcessPool):
+                await renderer.render(None, crash)
+            assert renderer.pool is not broken
+            assert await renderer.render(None, echo, b'ok') == b'ok'
+            assert renderer.stats()['failed'] == 1
+        finally:
+            renderer.close()
+
+    asyncio.run(run())
+
+
+def test_small_image_gets_the_first_encoding_after_a_large_one():
+    rnd = random.Random(0)
+    noisy = Image.frombytes('RGB', (200, 200), bytes(rnd.randrange(256) for _ in range(200 * 200 * 3)))
+    flat = Image.new('RGB', (200, 200), (255, 255, 255))
+    max_bytes = len(encode_image(noisy, ['jpeg']))
+    assert image_extension(encode_image(noisy, ['png', 'jpeg'], max_bytes)) == 'jpg'
+    # Same size, but a plain caption compresses well
+    assert image_extension(encode_image(flat, ['png', 'jpeg'], max_bytes)) == 'png'
@@ -0,0 +1,419 @@
+import json
+import time
+import random
+
+import pytest
+from tweepy import Response, StreamRule, TweepyException
+
+from kanobot.cache import SeenCache, UserCache
+from kanobot.twitter import MyStreamingClient, combine_posts, fetch_backfill, pack_rule_values, rule_ids, sync_rules
+from kanobot.constants import DISCORD_MSG_CHAR_LIMIT, DISCORD_WEBHOOK_BATCH_LIMIT, TWITTER_RULE_TAG_PREFIX
+
+
+class FakeRulesAPI:
+    """Stand-in for the stream rules endpoints, with the rule cap and value length of Essential access"""
+
+    def __init__(self, rules=(), cap=5, max_length=512):
+        self.cap = cap
+        self.max_length = max_length
+        self.rules = {}
+        self.peak = 0
+        self.calls = []
+        self._next_id = 1
+        for value, tag in rules:
+            self._store(value, tag)
+
+    def _store(self, value, tag):
+        rule = StreamRule(value=value, tag=tag, id=str(self._next_id))
+        self._next_id += 1
+        self.rules[rule.id] = rule
+        self.peak = max(self.peak, len(self.rules))
+
+    def get_rules(self):
+        self.calls.append('get')
+        return Response(list(self.rules.values()) or None, {}, [], {})
+
+    def add_rules(self, rules):
+        self.calls.append('add')
+        if len(self.rules) + len(rules) > self.cap:
+            return Response(None, {}, [{'title': 'RuleCapEnforcement'}], {})
+        errors = [{'title': 'RuleLengthExceeded', 'value': x.value} for x in rules if len(x.value) > self.max_length]
+        if errors:
+            return Response(None, {}, errors, {})
+        for rule in rules:
+            self._store(rule.value, rule.tag)
+        return Response(None, {}, [], {})
+
+    def delete_rules(self, ids):
+        self.calls.append('delete')
+        for rule_id in ids:
+            del self.rules[rule_id]
+
+    def followed(self):
+        ids = [x for rule in self.rules.values() for x in rule.value.replace('from:', '').split(' OR ')]
+        assert len(ids) == len(set(ids)), 'an id is in more than one rule'
+        return set(ids)
+
+
+def twitter_ids(count, start=1000000000):
+    return [str(start + x) for x in range(count)]
+
+
+def test_incremental_adds_stay_in_one_rule():
+    api = FakeRulesAPI()
+    followed = []
+    for twitter_id in twitter_ids(8):
+        followed.append(twitter_id)
+        shards = sync_rules(api, followed)
+        assert len(api.rules) == 1
+        assert api.followed() == set(followed)
+        assert sorted(x for ids in shards.values() for x in ids) == sorted(followed)
+    assert api.peak <= 2
+
+
+def test_adds_use_the_least_rules():
+    api = FakeRulesAPI(max_length=128)
+    followed = []
+    for twitter_id in twitter_ids(20):
+        followed.append(twitter_id)
+        sync_rules(api, followed, max_length=128)
+        assert len(api.rules) == len(pack_rule_values(followed, 128))
+    assert api.followed() == set(followed)
+
+
+def test_unchanged_ids_keep_their_rules():
+    api = FakeRulesAPI()
+    sync_rules(api, twitter_ids(30))
+    before = dict(api.rules)
+    api.calls = []
+    sync_rules(api, twitter_ids(30))
+    assert api.rules == before
+    assert api.calls == ['get']
+
+
+def test_full_shards_are_not_repacked():
+    api = FakeRulesAPI(max_length=128)
+    followed = twitter_ids(12)
+    sync_rules(api, followed, max_length=128)
+    full = set(api.rules)
+    followed += twitter_ids(1, start=2000000000)
+    sync_rules(api, followed, max_length=128)
+    assert full.issubset(api.rules)
+    assert api.followed() == set(followed)
+
+
+def test_removed_id_is_dropped():
+    api = FakeRulesAPI()
+    followed = twitter_ids(5)
+    sync_rules(api, followed)
+    sync_rules(api, followed[1:])
+    assert api.followed() == set(followed[1:])
+    assert len(api.rules) == 1
+
+
+def test_rules_at_the_cap_are_merged():
+    # One rule per id, as left behind by syncs which never repacked
+    rules = [('from:{}'.format(x), '{}{}'.format(TWITTER_RULE_TAG_PREFIX, i)) for i, x in enumerate(twitter_ids(5))]
+    api = FakeRulesAPI(rules)
+    followed = twitter_ids(6)
+    sync_rules(api, followed)
+    assert len(api.rules) == 1
+    assert api.followed() == set(followed)
+    assert api.peak <= api.cap
+
+
+def test_foreign_rules_are_replaced():
+    api = FakeRulesAPI([('from:1 OR from:2', 'someone else'), ('cats has:images', None)])
+    sync_rules(api, ['1', '3'])
+    assert api.followed() == {'1', '3'}
+    assert all(x.tag.startswith(TWITTER_RULE_TAG_PREFIX) for x in api.rules.values())
+
+
+def subscription(twitter_id='42', webhook_id='7', **options):
+    data = {
+        'twitter_id': twitter_id,
+        'webhook_id': webhook_id,
+        'webhook_url': 'https://discord.com/api/webhooks/{}/token'.format(webhook_id),
+        'includeUserReply': True,
+        'includeRetweet': True
+    }
+    data.update(options)
+    return data
+
+
+def tweet(tweet_id, author_id='42', **fields):
+    data = {'id': str(tweet_id), 'author_id': author_id, 'text': 'tweet {}'.format(tweet_id)}
+    data.update(fields)
+    return data
+
+
+def profile(user_id, username=None):
+    username = username or 'user{}'.format(user_id)
+    return {
+        'id': user_id, 'name': username.title(), 'username': username, 'profile_image_url': 'https://pbs/' + username
+    }
+
+
+def streaming_client(subscriptions, **kwargs):
+    """Client whose deliveries are collected instead of posted"""
+    client = MyStreamingClient('token', {'Discord': subscriptions}, **kwargs)
+    client.delivered = []
+    client.deliver = lambda dataDiscord, data, trace=None: client.delivered.append((dataDiscord['webhook_id'], data))
+    return client
+
+
+def test_replayed_tweet_is_delivered_once():
+    client = streaming_client([subscription(), subscription(webhook_id='8')], seen=SeenCache())
+    includes = {'users': [profile('42')]}
+    client.process(tweet(100), includes)
+    # The stream replays it after a reconnect, backfill may find it as well
+    client.process(tweet(100), includes)
+    client.process(tweet(100), includes)
+    assert sorted(x for x, _ in client.delivered) == ['7', '8']
+    client.process(tweet(101), includes)
+    assert len(client.delivered) == 4
+
+
+def retweet(tweet_id, author_id, original_id):
+    return tweet(tweet_id, author_id, referenced_tweets=[{'type': 'retweeted', 'id': original_id}])
+
+
+def test_self_retweet_with_one_included_user():
+    client = streaming_client([subscription()])
+    # includes.users is de-duplicated, a self retweet has one user
+    rawdata = {
+        'data': retweet(101, '42', '100'),
+        'includes': {'users': [profile('42', 'kano')], 'tweets': [tweet(100)]}
+    }
+    client.on_data(json.dumps(rawdata).encode('utf-8'))
+    assert [data['username'] for _, data in client.delivered] == ['Kano']
+    assert client.delivered[0][1]['content'].endswith('/kano/status/100')
+
+
+def test_retweet_authors_are_looked_up_by_id():
+    client = streaming_client([subscription()])
+    includes = {'users': [profile('9', 'original'), profile('42', 'kano')], 'tweets': [tweet(100, '9')]}
+    client.process(retweet(101, '42', '100'), includes)
+    assert [data['username'] for _, data in client.delivered] == ['Original']
+    # Authors missing from includes skip the tweet instead of raising into the stream
+    client.process(tweet(102, '42'), {'users': [profile('9')]})
+    client.process(retweet(103, '42', '100'), {'users': [profile('42')]})
+    assert len(client.delivered) == 1
+
+
+def test_stream_fills_an_empty_user_cache():
+    users = UserCache()
+    client = streaming_client([subscription()], users=users)
+    rawdata = {'data': tweet(100), 'includes': {'users': [profile('42', 'kano')]}}
+    client.on_data(json.dumps(rawdata).encode('utf-8'))
+    assert users.get('42')['username'] == 'kano'
+    assert users.get(username='Kano')['id'] == '42'
+    assert len(client.delivered) == 1
+
+
+def tweet_id(seconds_ago, sequence=0):
+    """Snowflake of a tweet posted seconds ago"""
+    return str((int((time.time() - seconds_ago) * 1000) - 1288834974657) << 22 | sequence)
+
+
+class FakeSearchAPI:
+    """
+    Stand-in for recent search with return_type=dict: newest first, page_size tweets
+    a page, authors and retweeted tweets expanded unless the author is withheld.
+    """
+
+    def __init__(self, tweets, users, page_size=2, withheld=(), failing=()):
+        self.tweets = sorted(tweets, key=lambda x: int(x['id']), reverse=True)
+        self.users = {x['id']: x for x in users}
+        self.page_size = page_size
+        self.withheld = set(withheld)
+        self.failing = set(failing)
+        self.requests = []
+
+    def search_recent_tweets(self, query, max_results=10, next_token=None, since_id=None, start_time=None, **kwargs):
+        self.requests.append({'query': query, 'next_token': next_token, 'since_id': since_id, 'start_time': start_time})
+        ids = set(rule_ids(query))
+        if ids & self.failing:
+            raise TweepyException('503 Service Unavailable')
+        matched = [
+            x for x in self.tweets if x['author_id'] in ids and (since_id is None or int(x['id']) > int(since_id))
+        ]
+        offset = int(next_token or 0)
+        page = matched[offset:offset + min(max_results, self.page_size)]
+        referenced_ids = set(x['id'] for data in page for x in data.get('referenced_tweets', []))
+        referenced = [x for x in self.tweets if x['id'] in referenced_ids]
+        authors = set(x['author_id'] for x in page + referenced) - self.withheld
+        response = {
+            'includes': {'users': [self.users[x] for x in authors if x in self.users], 'tweets': referenced},
+            'meta': {'result_count': len(page)}
+        }
+        if page:
+            response['data'] = page
+        if offset + len(page) < len(matched):
+            response['meta']['next_token'] = str(offset + len(page))
+        return response
+
+
+def test_backfill_pages_from_the_checkpoints():
+    alice = [tweet(tweet_id(600 - x * 60, 1), '1') for x in range(5)]
+    bob = [tweet(tweet_id(500 - x * 60, 2), '2') for x in range(3)]
+    api = FakeSearchAPI(alice + bob, [profile('1'), profile('2')])
+    # Alice's first tweet and everything of bob up to his second were delivered before
+    checkpoints = {'1': alice[0]['id'], '2': bob[1]['id']}
+    found = fetch_backfill(api, checkpoints, 3600)
+    assert [data['id'] for data, _ in found] == sorted([x['id'] for x in alice[1:] + bob[2:]], key=int)
+    assert all(includes['users'][0]['id'] == data['author_id'] for data, includes in found)
+    assert len(api.requests) == 4
+    assert api.requests[0]['since_id'] == alice[0]['id']
+    assert [x['next_token'] for x in api.requests] == [None, '2', '4', '6']
+
+
+def test_backfill_stops_after_max_pages():
+    tweets = [tweet(tweet_id(600 - x * 10), '1') for x in range(10)]
+    api = FakeSearchAPI(tweets, [profile('1')])
+    found = fetch_backfill(api, {'1': tweet_id(3000)}, 3600, max_pages=3)
+    assert len(api.requests) == 3
+    assert [data['id'] for data, _ in found] == [x['id'] for x in tweets[4:]]
+
+
+def test_backfill_starts_at_max_age_for_old_checkpoints():
+    api = FakeSearchAPI([tweet(tweet_id(60), '1')], [profile('1')])
+    found = fetch_backfill(api, {'1': tweet_id(7200)}, 3600)
+    assert api.requests[0]['since_id'] is None and api.requests[0]['start_time'] is not None
+    assert len(found) == 1
+
+
+def test_backfill_skips_tweets_without_included_authors():
+    tweets = [
+        tweet(tweet_id(300), '1'),
+        tweet(tweet_id(200), '3'),
+        tweet(tweet_id(100), '1', referenced_tweets=[{'type': 'retweeted', 'id': '555'}]),
+        {'id': '555', 'author_id': '3', 'text': 'original'},
+    ]
+    api = FakeSearchAPI(tweets, [profile('1'), profile('3')], page_size=10, withheld=['3'])
+    found = fetch_backfill(api, {'1': tweet_id(3000), '3': tweet_id(3000)}, 3600)
+    assert [data['id'] for data, _ in found] == [tweets[0]['id']]
+
+
+def test_backfill_failed_query_keeps_the_others():
+    tweets = [tweet(tweet_id(100), '1'), tweet(tweet_id(90), '2')]
+    api = FakeSearchAPI(tweets, [profile('1'), profile('2')], failing=['2'])
+    # One account per query
+    found = fetch_backfill(api, {'1': tweet_id(3000), '2': tweet_id(3000)}, 3600, max_length=8)
+    assert [data['author_id'] for data, _ in found] == ['1']
+
+
+@pytest.mark.parametrize('withheld', [(), ('1', )])
+def test_stream_backfill_advances_checkpoints(withheld):
+    tweets = [tweet(tweet_id(300 - x * 60), '1') for x in range(4)]
+    api = FakeSearchAPI(tweets, [profile('1')], withheld=withheld)
+    checkpoints = {'1': tweet_id(3000)}
+    client = streaming_client(
+        [subscription(twitter_id='1')], seen=SeenCache(), checkpoints=checkpoints, backfill_client=api,
+        backfill_max_age=3600
+    )
+    client.backfill()
+    if withheld:
+        assert client.delivered == [] and client.dump_checkpoints() == checkpoints
+        return
+    assert [data['content'].rsplit('/', 1)[1] for _, data in client.delivered] == [x['id'] for x in tweets]
+    assert client.dump_checkpoints() == {'1': tweets[-1]['id']}
+    client.backfill()
+    assert len(client.delivered) == len(tweets)
+
+
+def post(tweet_id, username='kano'):
+    data = {
+        'username': username,
+        'avatar_url': 'https://pbs/' + username,
+        'content': 'https://twitter.com/{}/status/{}'.format(username, tweet_id)
+    }
+    return ([tweet_id], data, [])
+
+
+def test_batch_of_one_author_keeps_its_identity():
+    combined = combine_posts([post(1), post(2)])
+    assert len(combined) == 1
+    record_ids, data, _ = combined[0]
+    assert record_ids == [1, 2] and data['username'] == 'kano'
+
+
+def test_batch_of_mixed_authors_is_sent_as_the_webhook():
+    posts = [post(x, 'user{}'.format(x % 3)) for x in range(DISCORD_WEBHOOK_BATCH_LIMIT * 2 + 1)]
+    combined = combine_posts(posts)
+    assert [len(x[0]) for x in combined] == [DISCORD_WEBHOOK_BATCH_LIMIT, DISCORD_WEBHOOK_BATCH_LIMIT, 1]
+    assert all('username' not in data and 'avatar_url' not in data for _, data, _ in combined[:2])
+    assert combined[2][1]['username'] == posts[-1][1]['username']
+    # Every link is kept, in order
+    links = [line for _, data, _ in combined for line in data['content'].split('\n')]
+    assert links == [data['content'] for _, data, _ in posts]
+    # The payloads queued in the outbox are not touched
+    assert all('username' in data for _, data, _ in posts)
+
+
+def test_batch_stays_under_the_message_limit():
+    long_name = 'x' * 900
+    combined = combine_posts([post(x, long_name) for x in range(3)])
+    assert len(combined) == 2
+    assert all(len(data['content']) <= DISCORD_MSG_CHAR_LIMIT for _, data, _ in combined)
+
+
+def stream_message(rnd, authors):
+    """
+    Raw stream message as the wire format may vary: keys in any order, includes before
+    data, any JSON spacing and escaping, tweet text that looks like JSON.
+    """
+    author_id = rnd.choice(authors)
+    data = {'id': str(rnd.randint(1, 10**18)), 'author_id': author_id, 'text': 'tweet'}
+    payload = {'data': data, 'includes': {'users': [profile(author_id)]}, 'matching_rules': [{'id': '1', 'tag': 'x'}]}
+    roll = rnd.random()
+    if roll < 0.2:
+        # Someone tweets raw JSON naming another account
+        data['text'] = '"author_id":"{0}" {{"author_id": "{0}"}}'.format(rnd.choice(authors))
+    elif roll < 0.35:
+        data['text'] = '\\"author_id\\":\\"{}\\" \u3042\u3044 \\\\ "'.format(rnd.choice(authors))
+    elif roll < 0.5:
+        # Retweets include the original tweet and its author
+        original = rnd.choice(authors)
+        data['referenced_tweets'] = [{'type': 'retweeted', 'id': '1'}]
+        payload['includes']['tweets'] = [{'id': '1', 'author_id': original, 'text': 'original'}]
+        payload['includes']['users'].append(profile(original))
+    elif roll < 0.55:
+        # Errors and operational disconnects have no data
+        payload = {'errors': [{'title': 'operational-disconnect', 'detail': 'author_id "{}"'.format(author_id)}]}
+
+    def shuffled(items):
+        items = list(items)
+        rnd.shuffle(items)
+        return dict(items)
+
+    payload = shuffled(payload.items())
+    if 'data' in payload:
+        payload['data'] = shuffled(payload['data'].items())
+    style = rnd.randrange(4)
+    if style == 0:
+        encoded = json.dumps(payload)
+    elif style == 1:
+        encoded = json.dumps(payload, separators=(',', ':'))
+    elif style == 2:
+        encoded = json.dumps(payload, indent=rnd.choice([1, '\t']), ensure_ascii=False)
+    else:
+        encoded = json.dumps(payload, separators=(' , ', ' :  '), ensure_ascii=rnd.random() < 0.5)
+    return encoded.encode('utf-8')
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_fast_path_only_skips_what_the_full_parse_drops(seed):
+    rnd = random.Random(seed)
+    authors = twitter_ids(20)
+    client = streaming_client([subscription(x) for x in rnd.sample(authors, 5)])
+    skipped = dropped = 0
+    for _ in range(500):
+        rawdata = stream_message(rnd, authors)
+        payload = json.loads(rawdata.decode('utf-8'))
+        drops = 'data' in payload and payload['data']['author_id'] not in client.subscriptions
+        # Skipping a tweet the full parse keeps loses it, the reverse only costs a parse
+        assert not client.skip(rawdata) or drops, rawdata
+        skipped += client.skip(rawdata)
+        dropped += drops
+    assert skipped > dropped / 2